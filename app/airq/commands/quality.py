@@ -3,6 +3,7 @@ import abc
 from flask_babel import ngettext, gettext
 
 from airq import config
+from airq.config import app
 from airq.commands.base import MessageResponse
 from airq.commands.base import RegexCommand
 from airq.lib.geo import kilometers_to_miles
@@ -26,6 +27,9 @@ class BaseQualityCommand(RegexCommand):
                 return self._get_missing_zipcode_message()
             zipcode = self.client.zipcode
 
+        if app.config["HAZEBOT_LAZY_METRICS_ENABLED"]:
+            Zipcode.query.refresh_metrics([zipcode.id])
+
         if not zipcode.pm25 or zipcode.is_pm25_stale:
             return MessageResponse(
                 body=gettext(
@@ -128,7 +132,9 @@ class GetDetails(BaseQualityCommand):
         )
 
         num_desired = 3
-        recommended_zipcodes = self.client.get_recommendations(num_desired)
+        recommended_zipcodes = self.client.get_recommendations(
+            num_desired, refresh_metrics=app.config["HAZEBOT_LAZY_METRICS_ENABLED"]
+        )
         if recommended_zipcodes:
             response.write(
                 gettext("Here are the closest places with better air quality:")
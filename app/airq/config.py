@@ -1,4 +1,5 @@
 import os
+import tempfile
 import typing
 from logging.config import dictConfig
 
@@ -101,6 +102,30 @@ config = {
     "HAZEBOT_SHARE_REQUESTS_ENABLED": bool(
         int(os.getenv("HAZEBOT_SHARE_REQUESTS_ENABLED", 1))
     ),
+    "HAZEBOT_INCREMENTAL_SYNC_ENABLED": bool(
+        int(os.getenv("HAZEBOT_INCREMENTAL_SYNC_ENABLED", 1))
+    ),
+    "HAZEBOT_SHARDED_FETCH_ENABLED": bool(
+        int(os.getenv("HAZEBOT_SHARDED_FETCH_ENABLED", 1))
+    ),
+    "HAZEBOT_DEMAND_DRIVEN_SYNC_ENABLED": bool(
+        int(os.getenv("HAZEBOT_DEMAND_DRIVEN_SYNC_ENABLED", 1))
+    ),
+    "HAZEBOT_REGION_SYNC_ENABLED": bool(
+        int(os.getenv("HAZEBOT_REGION_SYNC_ENABLED", 0))
+    ),
+    "HAZEBOT_LAZY_METRICS_ENABLED": bool(
+        int(os.getenv("HAZEBOT_LAZY_METRICS_ENABLED", 0))
+    ),
+    # Defaults to the number of CPUs.
+    "HAZEBOT_SYNC_PROCESSES": int(os.getenv("HAZEBOT_SYNC_PROCESSES", 0)),
+    # Either "sql" or "numpy".
+    "HAZEBOT_METRICS_ENGINE": os.getenv("HAZEBOT_METRICS_ENGINE", "sql"),
+    # Either "python" or "numpy".
+    "HAZEBOT_ALERTS_ENGINE": os.getenv("HAZEBOT_ALERTS_ENGINE", "python"),
+    "HAZEBOT_SNAPSHOT_DIR": os.getenv(
+        "HAZEBOT_SNAPSHOT_DIR", os.path.join(tempfile.gettempdir(), "hazebot")
+    ),
     "BABEL_DEFAULT_LOCALE": "en",
     "BABEL_TRANSLATION_DIRECTORIES": os.path.join(base_dir, "translations"),
     "SQLALCHEMY_DATABASE_URI": f"postgresql+psycopg2://{PG_USER}:{PG_PASSWORD}@{PG_HOST}:{PG_PORT}/{PG_DB}",
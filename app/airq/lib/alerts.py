@@ -0,0 +1,125 @@
+import numpy as np
+
+from airq.lib.readings import ConversionFactor
+from airq.lib.readings import get_aqi_array
+from airq.lib.readings import get_pm25_array
+from airq.lib.readings import get_pm25_level_array
+
+
+# Clients alerted this recently are only alerted again if the AQI has changed
+# by at least `MIN_RECENT_AQI_CHANGE`.
+RECENT_ALERT_SECONDS = 6 * 60 * 60
+MIN_RECENT_AQI_CHANGE = 50
+
+# Conversion factors are stored in arrays by their index in this list.
+CONVERSION_FACTORS = list(ConversionFactor)
+
+# One row per client who may need an alert. Null readings are NaN.
+ALERT_CANDIDATES_DTYPE = np.dtype(
+    [
+        ("client_id", np.int64),
+        # Index of the client's zipcode in the array of zipcode readings.
+        ("zipcode_index", np.int64),
+        ("is_in_send_window", np.bool_),
+        ("last_alert_sent_at", np.int64),
+        ("alert_frequency", np.int64),
+        ("alert_threshold", np.int64),
+        ("conversion_factor", np.int64),
+        ("last_pm25", np.float64),
+        ("last_pm_cf_1", np.float64),
+        ("last_humidity", np.float64),
+        ("has_last_pm_cf_1", np.bool_),
+        ("has_last_humidity", np.bool_),
+    ]
+)
+
+ZIPCODE_READINGS_DTYPE = np.dtype(
+    [
+        ("pm25", np.float64),
+        ("pm_cf_1", np.float64),
+        ("humidity", np.float64),
+    ]
+)
+
+# One row per alert to send, with the values to put in the message.
+ALERTS_DTYPE = np.dtype(
+    [
+        ("client_id", np.int64),
+        ("pm25", np.float64),
+        ("pm25_level", np.int64),
+        ("aqi", np.int64),
+    ]
+)
+
+
+def get_alerts(
+    candidates: np.ndarray, zipcode_readings: np.ndarray, timestamp: int
+) -> np.ndarray:
+    """Decide which clients to alert, like `Client.maybe_notify`.
+
+    Takes an array of `ALERT_CANDIDATES_DTYPE` and an array of
+    `ZIPCODE_READINGS_DTYPE` which it indexes into. Returns an array of
+    `ALERTS_DTYPE`, in the same order as the candidates.
+    """
+    conversion_factors = candidates["conversion_factor"]
+    zipcode_indices = candidates["zipcode_index"]
+
+    # Each zipcode's readings are only converted once per conversion factor.
+    zipcode_pm25s = np.stack(
+        [
+            get_pm25_array(
+                zipcode_readings["pm25"],
+                zipcode_readings["pm_cf_1"],
+                zipcode_readings["humidity"],
+                conversion_factor,
+            )
+            for conversion_factor in CONVERSION_FACTORS
+        ]
+    )
+    zipcode_levels = get_pm25_level_array(zipcode_pm25s)
+    zipcode_aqis = get_aqi_array(zipcode_pm25s)
+    curr_pm25s = zipcode_pm25s[conversion_factors, zipcode_indices]
+    curr_levels = zipcode_levels[conversion_factors, zipcode_indices]
+    curr_aqis = zipcode_aqis[conversion_factors, zipcode_indices]
+
+    last_pm25s = np.choose(
+        conversion_factors,
+        [
+            get_pm25_array(
+                candidates["last_pm25"],
+                candidates["last_pm_cf_1"],
+                candidates["last_humidity"],
+                conversion_factor,
+                candidates["has_last_pm_cf_1"],
+                candidates["has_last_humidity"],
+            )
+            for conversion_factor in CONVERSION_FACTORS
+        ],
+    )
+    last_levels = get_pm25_level_array(last_pm25s)
+    last_aqis = get_aqi_array(last_pm25s)
+
+    thresholds = candidates["alert_threshold"]
+    last_alert_sent_at = candidates["last_alert_sent_at"]
+    was_alerted_recently = last_alert_sent_at > timestamp - RECENT_ALERT_SECONDS
+    should_alert = (
+        candidates["is_in_send_window"]
+        & (last_alert_sent_at < timestamp - candidates["alert_frequency"] * 60 * 60)
+        # `maybe_notify` raises for readings without an AQI, so never alerts.
+        & ~np.isnan(curr_aqis)
+        & ~np.isnan(last_aqis)
+        & (curr_levels != last_levels)
+        & ~((curr_levels < thresholds) & (last_levels <= thresholds))
+        & ~((curr_levels == thresholds) & (last_levels < thresholds))
+        & ~(
+            was_alerted_recently
+            & (np.abs(curr_aqis - last_aqis) < MIN_RECENT_AQI_CHANGE)
+        )
+    )
+
+    alerts = np.empty(np.count_nonzero(should_alert), dtype=ALERTS_DTYPE)
+    alerts["client_id"] = candidates["client_id"][should_alert]
+    alerts["pm25"] = curr_pm25s[should_alert]
+    alerts["pm25_level"] = curr_levels[should_alert]
+    alerts["aqi"] = curr_aqis[should_alert]
+    return alerts
@@ -46,13 +46,18 @@ class ClientPreference(abc.ABC, typing.Generic[TPreferenceValue]):
         self, instance: "Client", owner: typing.Type["Client"]
     ) -> TPreferenceValue:
         if instance is not None:
-            preferences = instance.preferences or {}
-            value = preferences.get(self.name)
-            if value is not None:
-                return self._cast(value)
-            return self.default
+            return self.get_value(instance.preferences)
         return self
 
+    def get_value(
+        self, preferences: typing.Optional[typing.Dict[str, typing.Any]]
+    ) -> TPreferenceValue:
+        """The value of this pref in a client's raw preferences."""
+        value = (preferences or {}).get(self.name)
+        if value is not None:
+            return self._cast(value)
+        return self.default
+
     def __set__(self, client: "Client", value: TPreferenceValue):
         self._set(client, value)
 
@@ -1,4 +1,19 @@
+import dataclasses
+import itertools
 import math
+import numpy as np
+import numpy.typing as npt
+import typing
+
+
+# Matches `haversine_distance`.
+EARTH_RADIUS_KM = 6371
+
+# The length of a degree of latitude, or of longitude at the equator.
+KM_PER_DEGREE = math.radians(1) * EARTH_RADIUS_KM
+
+# Added to paddings so that rounding never leaves out a point on the edge.
+_PADDING_EPSILON_DEGREES = 1e-6
 
 
 def haversine_distance(lon1: float, lat1: float, lon2: float, lat2: float) -> float:
@@ -30,3 +45,131 @@ def kilometers_to_miles(kilometers: float) -> float:
 
     # calculate miles
     return kilometers * conv_fac
+
+
+@dataclasses.dataclass(frozen=True)
+class BoundingBox:
+    """A latitude/longitude rectangle, given by its northwest and southeast corners."""
+
+    nwlat: float
+    nwlng: float
+    selat: float
+    selng: float
+
+    def split(self, rows: int, cols: int) -> typing.List["BoundingBox"]:
+        """Split this box into a grid of `rows` by `cols` smaller boxes."""
+        lat_step = (self.nwlat - self.selat) / rows
+        lng_step = (self.selng - self.nwlng) / cols
+        return [
+            BoundingBox(
+                nwlat=self.nwlat - lat_step * row,
+                nwlng=self.nwlng + lng_step * col,
+                selat=self.nwlat - lat_step * (row + 1),
+                selng=self.nwlng + lng_step * (col + 1),
+            )
+            for row in range(rows)
+            for col in range(cols)
+        ]
+
+    def contains(self, latitudes: typing.Any, longitudes: typing.Any) -> typing.Any:
+        """Which of the given points are in this box.
+
+        Works elementwise on NumPy arrays and SQLAlchemy columns alike. The
+        north and east edges are excluded, so that the boxes from `split`
+        don't overlap.
+        """
+        return (
+            (latitudes >= self.selat)
+            & (latitudes < self.nwlat)
+            & (longitudes >= self.nwlng)
+            & (longitudes < self.selng)
+        )
+
+    def intersection(self, other: "BoundingBox") -> typing.Optional["BoundingBox"]:
+        """The part of this box which is also in `other`, if any."""
+        box = BoundingBox(
+            nwlat=min(self.nwlat, other.nwlat),
+            nwlng=max(self.nwlng, other.nwlng),
+            selat=max(self.selat, other.selat),
+            selng=min(self.selng, other.selng),
+        )
+        if box.nwlat <= box.selat or box.selng <= box.nwlng:
+            return None
+        return box
+
+
+def _get_padding_epsilon(km: float) -> float:
+    # Nothing is within zero kilometers of a point but the point itself.
+    return _PADDING_EPSILON_DEGREES if km > 0 else 0.0
+
+
+def get_latitude_padding(km: float) -> float:
+    """Degrees of latitude which cover everything within `km` of a point."""
+    return math.degrees(km / EARTH_RADIUS_KM) + _get_padding_epsilon(km)
+
+
+def get_longitude_padding(max_abs_latitudes: npt.ArrayLike, km: float) -> np.ndarray:
+    """Degrees of longitude which cover everything within `km` of a point.
+
+    Works elementwise on the largest absolute latitude of the points and of
+    everything within `km` of them. Returns infinity where that could be any
+    longitude at all.
+    """
+    # Two points no further from the equator than latitude φ which are d
+    # apart are at most 2 * asin(sin(d / 2R) / cos(φ)) apart in longitude.
+    cos_latitudes = np.cos(np.radians(np.minimum(max_abs_latitudes, 90)))
+    ratios = math.sin(min(km / EARTH_RADIUS_KM / 2, math.pi / 2)) / np.maximum(
+        cos_latitudes, np.finfo(np.float64).tiny
+    )
+    return np.where(
+        ratios < 1,
+        np.degrees(2 * np.arcsin(np.minimum(ratios, 1))) + _get_padding_epsilon(km),
+        np.inf,
+    )
+
+
+def get_covering_bounding_boxes(
+    points: typing.Iterable[typing.Tuple[float, float]],
+    radius_km: float,
+    cell_degrees: float = 1.0,
+) -> typing.List[BoundingBox]:
+    """Cover everything within `radius_km` of the given (lat, lng) points.
+
+    Points are bucketed into a grid of `cell_degrees` cells, and runs of
+    adjacent cells in each row of the grid are merged into a single box which
+    is then padded by the radius. Boxes may overlap.
+    """
+    cells = sorted(
+        {
+            (math.floor(lat / cell_degrees), math.floor(lng / cell_degrees))
+            for lat, lng in points
+        }
+    )
+    lat_padding = get_latitude_padding(radius_km)
+    bounding_boxes = []
+    for row, row_cells in itertools.groupby(cells, key=lambda cell: cell[0]):
+        selat = row * cell_degrees
+        nwlat = selat + cell_degrees
+        # Degrees of longitude are shortest on the side closest to the pole.
+        lng_padding = min(
+            float(
+                get_longitude_padding(
+                    max(abs(selat), abs(nwlat)) + lat_padding, radius_km
+                )
+            ),
+            180.0,
+        )
+        # Consecutive columns minus their position are constant within a run.
+        for _, run in itertools.groupby(
+            enumerate(col for _, col in row_cells), key=lambda t: t[1] - t[0]
+        ):
+            cols = [col for _, col in run]
+            bounding_boxes.append(
+                BoundingBox(
+                    nwlat=min(nwlat + lat_padding, 90.0),
+                    nwlng=cols[0] * cell_degrees - lng_padding,
+                    selat=max(selat - lat_padding, -90.0),
+                    selng=(cols[-1] + 1) * cell_degrees + lng_padding,
+                )
+            )
+    return bounding_boxes
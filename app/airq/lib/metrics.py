@@ -0,0 +1,154 @@
+import numpy as np
+import typing
+
+from airq.lib.parallel import map_in_processes
+
+
+# Try to get at least 8 readings per zipcode.
+DESIRED_NUM_READINGS = 8
+
+# Allow any number of readings within 2.5km from the zipcode centroid.
+DESIRED_READING_DISTANCE_KM = 2.5
+
+# Zipcode metrics only use sensors which have reported this recently.
+SENSOR_FRESHNESS_SECONDS = 30 * 60
+
+# One row per relation between a recently updated sensor and a zipcode.
+RELATIONS_DTYPE = np.dtype(
+    [
+        ("zipcode_id", np.int64),
+        ("sensor_id", np.int64),
+        ("distance", np.float64),
+        ("latest_reading", np.float64),
+        ("humidity", np.float64),
+        ("pm_cf_1", np.float64),
+    ]
+)
+
+ZIPCODE_METRICS_DTYPE = np.dtype(
+    [
+        ("zipcode_id", np.int64),
+        ("pm25", np.float64),
+        ("humidity", np.float64),
+        ("pm_cf_1", np.float64),
+        ("num_sensors", np.int64),
+        ("min_sensor_distance", np.float64),
+        ("max_sensor_distance", np.float64),
+    ]
+)
+
+# Smaller partitions aren't worth the cost of sending them to another process.
+_MIN_RELATIONS_PER_PARTITION = 50000
+
+
+def _round(values: np.ndarray) -> np.ndarray:
+    # Python's round is correctly rounded, where np.round can be off by one
+    # in the last digit.
+    return np.array([round(value, 3) for value in values.tolist()], dtype=np.float64)
+
+
+def compute_zipcode_metrics(
+    relations: np.ndarray,
+    desired_num_readings: int,
+    desired_reading_distance_km: float,
+) -> typing.Tuple[np.ndarray, typing.List[np.ndarray]]:
+    """Average the readings of each zipcode's nearby sensors.
+
+    Each zipcode uses its `desired_num_readings` closest sensors, plus any
+    others within `desired_reading_distance_km`, with ties broken by sensor
+    id. Returns an array of `ZIPCODE_METRICS_DTYPE` sorted by zipcode id,
+    and the ids of the sensors each zipcode used, sorted by distance.
+    """
+    if not len(relations):
+        return np.empty(0, dtype=ZIPCODE_METRICS_DTYPE), []
+
+    order = np.lexsort(
+        (relations["sensor_id"], relations["distance"], relations["zipcode_id"])
+    )
+    relations = relations[order]
+
+    # Each sensor's rank by distance within its zipcode.
+    is_first = np.ones(len(relations), dtype=bool)
+    is_first[1:] = relations["zipcode_id"][1:] != relations["zipcode_id"][:-1]
+    starts = np.flatnonzero(is_first)
+    counts = np.diff(np.append(starts, len(relations)))
+    ranks = np.arange(len(relations)) - np.repeat(starts, counts)
+    relations = relations[
+        (ranks < desired_num_readings)
+        | (relations["distance"] < desired_reading_distance_km)
+    ]
+
+    is_first = np.ones(len(relations), dtype=bool)
+    is_first[1:] = relations["zipcode_id"][1:] != relations["zipcode_id"][:-1]
+    starts = np.flatnonzero(is_first)
+    ends = np.append(starts[1:], len(relations))
+    # Unlike np.add.reduceat, bincount sums each group in order, so the
+    # averages match summing the readings one by one.
+    groups = np.cumsum(is_first) - 1
+    counts = ends - starts
+
+    metrics = np.empty(len(starts), dtype=ZIPCODE_METRICS_DTYPE)
+    metrics["zipcode_id"] = relations["zipcode_id"][starts]
+    for field, name in [
+        ("pm25", "latest_reading"),
+        ("humidity", "humidity"),
+        ("pm_cf_1", "pm_cf_1"),
+    ]:
+        sums = np.bincount(groups, weights=relations[name], minlength=len(starts))
+        metrics[field] = _round(sums / counts)
+    metrics["num_sensors"] = counts
+    metrics["min_sensor_distance"] = _round(relations["distance"][starts])
+    metrics["max_sensor_distance"] = _round(relations["distance"][ends - 1])
+    sensor_ids = np.split(relations["sensor_id"], starts[1:])
+    return metrics, sensor_ids
+
+
+def partition_relations(
+    relations: np.ndarray, num_partitions: int
+) -> typing.List[np.ndarray]:
+    """Split relations into ranges of zipcode ids of roughly equal size.
+
+    All of the relations of a zipcode end up in the same partition, and the
+    partitions are in order of zipcode id.
+    """
+    relations = relations[np.argsort(relations["zipcode_id"], kind="stable")]
+    boundaries = np.linspace(0, len(relations), num_partitions + 1)[1:-1]
+    # Move each boundary back to the first relation of its zipcode.
+    splits = np.searchsorted(
+        relations["zipcode_id"],
+        relations["zipcode_id"][boundaries.astype(np.intp)],
+        side="left",
+    )
+    return [p for p in np.split(relations, np.unique(splits)) if len(p)]
+
+
+def compute_zipcode_metrics_in_processes(
+    relations: np.ndarray,
+    desired_num_readings: int,
+    desired_reading_distance_km: float,
+    num_processes: int,
+) -> typing.Tuple[np.ndarray, typing.List[np.ndarray]]:
+    """Like `compute_zipcode_metrics`, but spread across a process pool.
+
+    Each process handles a range of zipcode ids, so the results are the
+    same as computing them all at once.
+    """
+    num_partitions = min(
+        num_processes, -(-len(relations) // _MIN_RELATIONS_PER_PARTITION)
+    )
+    if num_partitions <= 1:
+        return compute_zipcode_metrics(
+            relations, desired_num_readings, desired_reading_distance_km
+        )
+
+    results = map_in_processes(
+        compute_zipcode_metrics,
+        [
+            (partition, desired_num_readings, desired_reading_distance_km)
+            for partition in partition_relations(relations, num_partitions)
+        ],
+        num_processes,
+    )
+    metrics = np.concatenate([result[0] for result in results])
+    sensor_ids = [ids for result in results for ids in result[1]]
+    return metrics, sensor_ids
@@ -0,0 +1,48 @@
+import billiard
+import os
+import typing
+
+from airq.config import app
+
+
+T = typing.TypeVar("T")
+
+
+def get_num_processes() -> int:
+    """The number of processes CPU-bound sync work should be spread across."""
+    return app.config["HAZEBOT_SYNC_PROCESSES"] or os.cpu_count() or 1
+
+
+def map_in_processes(
+    fn: typing.Callable[..., T],
+    args: typing.Sequence[typing.Sequence[typing.Any]],
+    num_processes: int,
+    initializer: typing.Optional[typing.Callable[..., None]] = None,
+    initargs: typing.Sequence[typing.Any] = (),
+) -> typing.List[T]:
+    """Call `fn` with each of the given sets of arguments across a process pool.
+
+    Results are returned in the same order as `args`, however the calls are
+    scheduled. `initializer` is called with `initargs` once in each process
+    before any calls to `fn`. Runs everything in this process if there's
+    only one process or one set of arguments.
+
+    The pool comes from billiard, Celery's fork of multiprocessing, since
+    the standard library won't start children from a daemonic process such
+    as a Celery pool worker, which is where scheduled syncs run.
+    """
+    if num_processes <= 1 or len(args) <= 1:
+        if initializer:
+            initializer(*initargs)
+        return [fn(*a) for a in args]
+
+    pool = billiard.Pool(
+        processes=min(num_processes, len(args)),
+        initializer=initializer,
+        initargs=tuple(initargs),
+    )
+    try:
+        return pool.starmap(fn, args, chunksize=1)
+    finally:
+        pool.terminate()
+        pool.join()
@@ -0,0 +1,243 @@
+import csv
+import io
+import math
+import numpy as np
+import re
+import typing
+
+from sqlalchemy import Table
+
+from airq.config import db
+
+
+def _format_value(value: typing.Any) -> typing.Any:
+    if value is None:
+        return None
+    if isinstance(value, float) and math.isnan(value):
+        return "NaN"
+    if isinstance(value, list):
+        return "{" + ",".join(str(_format_value(v)) for v in value) + "}"
+    return value
+
+
+def _to_csv(rows: typing.Iterable[typing.Sequence[typing.Any]]) -> io.StringIO:
+    buf = io.StringIO()
+    writer = csv.writer(buf)
+    for row in rows:
+        writer.writerow([_format_value(value) for value in row])
+    buf.seek(0)
+    return buf
+
+
+def copy_to_staging_table(
+    table: Table,
+    columns: typing.Sequence[str],
+    rows: typing.Iterable[typing.Sequence[typing.Any]],
+) -> str:
+    """Stream rows into a temporary copy of the given columns of `table`.
+
+    The staging table lives until the end of the current transaction and
+    isn't written to the WAL. Returns the name of the staging table.
+    """
+    staging_table = f"{table.name}_staging"
+    column_names = ", ".join(columns)
+    buf = _to_csv(rows)
+
+    cursor = db.session.connection().connection.cursor()
+    cursor.execute(f"DROP TABLE IF EXISTS {staging_table}")
+    cursor.execute(
+        f"CREATE TEMPORARY TABLE {staging_table} ON COMMIT DROP AS "
+        f"SELECT {column_names} FROM {table.name} WITH NO DATA"
+    )
+    cursor.copy_expert(
+        f"COPY {staging_table} ({column_names}) FROM STDIN WITH (FORMAT csv)", buf
+    )
+    return staging_table
+
+
+def copy_to_array(
+    query: str, params: typing.Dict[str, typing.Any], dtype: np.dtype
+) -> np.ndarray:
+    """Stream the results of `query` into an array of `dtype`.
+
+    The query's columns must be in the same order as the fields of `dtype`.
+    Parameters use psycopg2's `%(name)s` style.
+    """
+    buf = io.StringIO()
+    cursor = db.session.connection().connection.cursor()
+    cursor.copy_expert(
+        cursor.mogrify(f"COPY ({query}) TO STDOUT WITH (FORMAT csv)", params).decode(),
+        buf,
+    )
+    if not buf.tell():
+        return np.empty(0, dtype=dtype)
+    buf.seek(0)
+    return np.loadtxt(buf, dtype=dtype, delimiter=",", ndmin=1)
+
+
+def bulk_insert(
+    table: Table,
+    columns: typing.Sequence[str],
+    rows: typing.Iterable[typing.Sequence[typing.Any]],
+) -> int:
+    """Insert rows into `table`.
+
+    Does not commit. Returns the number of rows inserted.
+    """
+    staging_table = copy_to_staging_table(table, columns, rows)
+    column_names = ", ".join(columns)
+    cursor = db.session.connection().connection.cursor()
+    cursor.execute(
+        f"INSERT INTO {table.name} ({column_names}) "
+        f"SELECT {column_names} FROM {staging_table}"
+    )
+    return cursor.rowcount
+
+
+def bulk_upsert(
+    table: Table,
+    columns: typing.Sequence[str],
+    rows: typing.Iterable[typing.Sequence[typing.Any]],
+    index_elements: typing.Sequence[str] = ("id",),
+) -> int:
+    """Insert rows into `table`, or update the existing rows where they differ.
+
+    Does not commit. Returns the number of rows inserted or updated.
+    """
+    staging_table = copy_to_staging_table(table, columns, rows)
+    updated_columns = [c for c in columns if c not in index_elements]
+    column_names = ", ".join(columns)
+    cursor = db.session.connection().connection.cursor()
+    cursor.execute(
+        f"INSERT INTO {table.name} ({column_names}) "
+        f"SELECT {column_names} FROM {staging_table} "
+        f"ON CONFLICT ({', '.join(index_elements)}) DO UPDATE SET "
+        + ", ".join(f"{c} = EXCLUDED.{c}" for c in updated_columns)
+        + " WHERE "
+        + _is_distinct_from(table.name, "EXCLUDED", updated_columns)
+    )
+    return cursor.rowcount
+
+
+def bulk_update(
+    table: Table,
+    columns: typing.Sequence[str],
+    rows: typing.Iterable[typing.Sequence[typing.Any]],
+    index_elements: typing.Sequence[str] = ("id",),
+    touch: typing.Optional[typing.Dict[str, typing.Any]] = None,
+) -> int:
+    """Update the existing rows of `table` where they differ.
+
+    Unlike `bulk_upsert`, rows only need to include the columns being
+    updated, and rows which aren't already in the table are ignored. The
+    columns in `touch` are set to the given values on every row, whether or
+    not the row differs, but each row is still only written once. Does not
+    commit. Returns the number of rows which differed.
+    """
+    staging_table = copy_to_staging_table(table, columns, rows)
+    updated_columns = [c for c in columns if c not in index_elements]
+    touch = touch or {}
+    join_condition = " AND ".join(
+        f"{table.name}.{c} = {staging_table}.{c}" for c in index_elements
+    )
+    cursor = db.session.connection().connection.cursor()
+    cursor.execute(
+        f"UPDATE {table.name} SET "
+        + ", ".join(
+            [f"{c} = {staging_table}.{c}" for c in updated_columns]
+            + [f"{c} = %({c})s" for c in touch]
+        )
+        + f" FROM {staging_table} WHERE {join_condition} AND "
+        + _is_distinct_from(table.name, staging_table, updated_columns),
+        touch,
+    )
+    num_updated = cursor.rowcount
+    if touch:
+        # The rows we just updated already have these values.
+        cursor.execute(
+            f"UPDATE {table.name} SET "
+            + ", ".join(f"{c} = %({c})s" for c in touch)
+            + f" FROM {staging_table} WHERE {join_condition} AND ("
+            + ", ".join(f"{table.name}.{c}" for c in touch)
+            + ") IS DISTINCT FROM ("
+            + ", ".join(f"%({c})s" for c in touch)
+            + ")",
+            touch,
+        )
+    return num_updated
+
+
+def replace_table(
+    table: Table,
+    columns: typing.Sequence[str],
+    rows: typing.Iterable[typing.Sequence[typing.Any]],
+):
+    """Replace every row of `table` with the given rows, and commit.
+
+    The rows are loaded into a shadow copy of the table which is then swapped
+    in, so readers see either all of the old rows or all of the new ones and
+    aren't blocked while the new rows load. Constraints and indexes are
+    copied over once the rows are loaded, which is much faster than
+    maintaining them row by row.
+    """
+    shadow_table = f"{table.name}_shadow"
+    old_table = f"{table.name}_old"
+    column_names = ", ".join(columns)
+    buf = _to_csv(rows)
+
+    cursor = db.session.connection().connection.cursor()
+    cursor.execute(f"DROP TABLE IF EXISTS {shadow_table}")
+    cursor.execute(
+        f"CREATE TABLE {shadow_table} (LIKE {table.name} INCLUDING DEFAULTS)"
+    )
+    cursor.copy_expert(
+        f"COPY {shadow_table} ({column_names}) FROM STDIN WITH (FORMAT csv)", buf
+    )
+
+    # Give everything a temporary name, since index names share a namespace.
+    cursor.execute(
+        "SELECT conname, pg_get_constraintdef(oid) FROM pg_constraint "
+        "WHERE conrelid = %s::regclass",
+        (table.name,),
+    )
+    constraints = cursor.fetchall()
+    for name, definition in constraints:
+        cursor.execute(
+            f"ALTER TABLE {shadow_table} ADD CONSTRAINT {name}_shadow {definition}"
+        )
+    cursor.execute(
+        "SELECT indexname, indexdef FROM pg_indexes WHERE tablename = %s "
+        "AND indexname NOT IN "
+        "(SELECT conname FROM pg_constraint WHERE conrelid = %s::regclass)",
+        (table.name, table.name),
+    )
+    indexes = cursor.fetchall()
+    for name, definition in indexes:
+        cursor.execute(
+            re.sub(
+                rf"INDEX {name} ON (\S+\.)?{table.name} ",
+                f"INDEX {name}_shadow ON {shadow_table} ",
+                definition,
+            )
+        )
+
+    cursor.execute(f"ALTER TABLE {table.name} RENAME TO {old_table}")
+    cursor.execute(f"ALTER TABLE {shadow_table} RENAME TO {table.name}")
+    cursor.execute(f"DROP TABLE {old_table}")
+    for name, _ in constraints:
+        cursor.execute(
+            f"ALTER TABLE {table.name} RENAME CONSTRAINT {name}_shadow TO {name}"
+        )
+    for name, _ in indexes:
+        cursor.execute(f"ALTER INDEX {name}_shadow RENAME TO {name}")
+    db.session.commit()
+
+
+def _is_distinct_from(left: str, right: str, columns: typing.Sequence[str]) -> str:
+    return (
+        "("
+        + ", ".join(f"{left}.{c}" for c in columns)
+        + ") IS DISTINCT FROM ("
+        + ", ".join(f"{right}.{c}" for c in columns)
+        + ")"
+    )
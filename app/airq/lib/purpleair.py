@@ -1,30 +1,552 @@
+import codecs
+import concurrent.futures
+import dataclasses
+import hashlib
+import json
+import logging
+import numpy as np
+import random
 import requests
+import time
 import typing
 
 from airq.config import PURPLEAIR_API_KEY
+from airq.lib.geo import BoundingBox
+
+
+logger = logging.getLogger(__name__)
+
+T = typing.TypeVar("T")
 
 
 PURPLEAIR_SENSORS_API_URL = "https://api.purpleair.com/v1/sensors"
 
+# Fields which change with every reading.
+PURPLEAIR_READINGS_FIELDS = [
+    "pm2.5",
+    "last_seen",
+    "channel_flags",
+    "humidity",
+    "pm2.5_cf_1",
+]
+
+# Fields which describe where a sensor is. These almost never change.
+PURPLEAIR_LOCATION_FIELDS = ["latitude", "longitude"]
+
+PURPLEAIR_SENSORS_FIELDS = PURPLEAIR_READINGS_FIELDS + PURPLEAIR_LOCATION_FIELDS
+
+# Regions covering everywhere we have zipcodes for. The contiguous US is split
+# into a grid so that no single request has to return most of the sensors.
+PURPLEAIR_REGIONS = {
+    **{
+        f"contiguous-{i}": box
+        for i, box in enumerate(
+            BoundingBox(nwlat=49.5, nwlng=-125.0, selat=24.5, selng=-66.5).split(3, 4)
+        )
+    },
+    "alaska": BoundingBox(nwlat=71.5, nwlng=-180.0, selat=51.0, selng=-129.0),
+    "hawaii": BoundingBox(nwlat=22.5, nwlng=-160.5, selat=18.5, selng=-154.5),
+}
+
+PURPLEAIR_SHARDS = list(PURPLEAIR_REGIONS.values())
+
+# Some PurpleAir field names aren't valid identifiers, so we rename them.
+_RENAMED_FIELDS = {"pm2.5": "pm25", "pm2.5_cf_1": "pm_cf_1"}
+
+_INTEGER_FIELDS = {"sensor_index"}
+
+# Number of rows to accumulate before transposing them into columns.
+_ROWS_PER_BLOCK = 4096
+
+_CHUNK_SIZE = 64 * 1024
+
+
+class SensorsBatch:
+    """A columnar batch of sensors returned by the PurpleAir API.
+
+    Each field is stored as a single array with one entry per sensor. Float
+    fields use NaN for missing values and `channel_flags` holds the decoded
+    flag names (or None if PurpleAir sent a code we don't recognize).
+    """
+
+    def __init__(
+        self, columns: typing.Dict[str, np.ndarray], timestamp: int = 0
+    ) -> None:
+        self._columns = columns
+        self.timestamp = timestamp
+
+    def __repr__(self) -> str:
+        return f"<SensorsBatch {len(self)} sensors: {', '.join(self.fields)}>"
+
+    def __len__(self) -> int:
+        if "sensor_index" not in self._columns:
+            return 0
+        return len(self._columns["sensor_index"])
+
+    def __contains__(self, field: str) -> bool:
+        return field in self._columns
+
+    def __getitem__(self, field: str) -> np.ndarray:
+        return self._columns[field]
+
+    @property
+    def fields(self) -> typing.List[str]:
+        return list(self._columns)
+
+    @classmethod
+    def empty(cls) -> "SensorsBatch":
+        columns = {"sensor_index": np.empty(0, dtype=np.int64)}
+        for field in PURPLEAIR_SENSORS_FIELDS:
+            dtype = np.object_ if field == "channel_flags" else np.float64
+            columns[_RENAMED_FIELDS.get(field, field)] = np.empty(0, dtype=dtype)
+        return cls(columns)
+
+    def digest(self) -> str:
+        """A hash of this batch's data, ignoring when it was fetched."""
+        h = hashlib.sha1()
+        for field, column in sorted(self._columns.items()):
+            h.update(field.encode())
+            if column.dtype == np.object_:
+                h.update(repr(column.tolist()).encode())
+            else:
+                h.update(np.ascontiguousarray(column).tobytes())
+        return h.hexdigest()
+
+    @classmethod
+    def concatenate(cls, batches: typing.Sequence["SensorsBatch"]) -> "SensorsBatch":
+        """Merge batches into one, sorted by sensor_index without duplicates.
+
+        The timestamp of the result is the earliest timestamp of the batches.
+        """
+        timestamp = min(
+            (batch.timestamp for batch in batches if batch.timestamp), default=0
+        )
+        batches = [batch for batch in batches if len(batch)]
+        if not batches:
+            return cls(cls.empty()._columns, timestamp=timestamp)
+        columns = {
+            field: np.concatenate([batch[field] for batch in batches])
+            for field in batches[0].fields
+        }
+        _, indices = np.unique(columns["sensor_index"], return_index=True)
+        return cls(columns, timestamp=timestamp).take(indices)
+
+    def take(self, indices: np.ndarray) -> "SensorsBatch":
+        """Select a subset of rows by boolean mask or index array."""
+        return SensorsBatch(
+            {field: column[indices] for field, column in self._columns.items()},
+            timestamp=self.timestamp,
+        )
+
+
+class _JSONStream:
+    """Incrementally decodes JSON values from an iterable of byte chunks."""
+
+    def __init__(self, chunks: typing.Iterable[bytes]):
+        self._chunks = iter(chunks)
+        self._decoder = json.JSONDecoder()
+        self._text_decoder = codecs.getincrementaldecoder("utf-8")()
+        self._buffer = ""
+        self._pos = 0
+        self._exhausted = False
+
+    def _error(self, msg: str) -> json.JSONDecodeError:
+        return json.JSONDecodeError(msg, self._buffer, self._pos)
+
+    def _fill(self) -> bool:
+        if self._exhausted:
+            return False
+        # Drop whatever we've already consumed so the buffer stays small.
+        self._buffer = self._buffer[self._pos :]
+        self._pos = 0
+        for chunk in self._chunks:
+            text = self._text_decoder.decode(chunk)
+            if text:
+                self._buffer += text
+                return True
+        self._buffer += self._text_decoder.decode(b"", final=True)
+        self._exhausted = True
+        return False
+
+    def peek(self) -> str:
+        """Return the next non-whitespace character without consuming it."""
+        while True:
+            while self._pos < len(self._buffer) and self._buffer[self._pos].isspace():
+                self._pos += 1
+            if self._pos < len(self._buffer):
+                return self._buffer[self._pos]
+            if not self._fill():
+                raise self._error("Unexpected end of input")
+
+    def expect(self, char: str):
+        if self.peek() != char:
+            raise self._error(f"Expected {char!r}")
+        self._pos += 1
+
+    def consume(self, char: str) -> bool:
+        if self.peek() == char:
+            self._pos += 1
+            return True
+        return False
+
+    def decode(self) -> typing.Any:
+        """Decode the next complete JSON value."""
+        self.peek()
+        while True:
+            try:
+                value, end = self._decoder.raw_decode(self._buffer, self._pos)
+            except json.JSONDecodeError:
+                if not self._fill():
+                    raise
+                continue
+            # A number at the very end of the buffer may have been cut off
+            # mid-chunk, so make sure something follows it before accepting.
+            if end < len(self._buffer) or not self._fill():
+                self._pos = end
+                return value
+
+    def iter_array(self) -> typing.Iterator[typing.Any]:
+        """Decode the elements of the next JSON array one at a time."""
+        self.expect("[")
+        if self.consume("]"):
+            return
+        while True:
+            yield self.decode()
+            if self.consume("]"):
+                return
+            self.expect(",")
+
+    def iter_object(self) -> typing.Iterator[str]:
+        """Yield the keys of the next JSON object.
+
+        The caller must consume each key's value before advancing.
+        """
+        self.expect("{")
+        if self.consume("}"):
+            return
+        while True:
+            key = self.decode()
+            if not isinstance(key, str):
+                raise self._error("Expected an object key")
+            self.expect(":")
+            yield key
+            if self.consume("}"):
+                return
+            self.expect(",")
+
+
+def _to_array(field: str, values: typing.List[typing.Any]) -> np.ndarray:
+    if field in _INTEGER_FIELDS:
+        return np.array(values, dtype=np.int64)
+    try:
+        # Numpy maps None to NaN for float arrays.
+        return np.array(values, dtype=np.float64)
+    except (TypeError, ValueError):
+        return np.array(values, dtype=np.object_)
+
+
+def _decode_channel_flags(
+    codes: np.ndarray, channel_flags: typing.List[str]
+) -> np.ndarray:
+    # Unknown codes (including missing ones) map onto a trailing None.
+    table: typing.List[typing.Optional[str]] = [*channel_flags, None]
+    indices = np.full(len(codes), len(channel_flags), dtype=np.int64)
+    known = ~np.isnan(codes) & (codes >= 0) & (codes < len(channel_flags))
+    indices[known] = codes[known].astype(np.int64)
+    return np.array(table, dtype=np.object_)[indices]
+
+
+def parse_sensors_response(chunks: typing.Iterable[bytes]) -> SensorsBatch:
+    """Parse a PurpleAir sensors response into a columnar batch.
+
+    Rows are read off the stream as they arrive, so neither the full decoded
+    response nor a dict per sensor is ever held in memory.
+    """
+    stream = _JSONStream(chunks)
+    fields: typing.Optional[typing.List[str]] = None
+    channel_flags: typing.List[str] = []
+    timestamp = 0
+    columns: typing.List[typing.List[typing.Any]] = []
+    for key in stream.iter_object():
+        if key == "data":
+            if fields is None:
+                # PurpleAir always sends `fields` before `data`.
+                raise json.JSONDecodeError("Received data before fields", "", 0)
+            block = []
+            for row in stream.iter_array():
+                block.append(row)
+                if len(block) >= _ROWS_PER_BLOCK:
+                    for column, values in zip(columns, zip(*block)):
+                        column.extend(values)
+                    block = []
+            for column, values in zip(columns, zip(*block)):
+                column.extend(values)
+        else:
+            value = stream.decode()
+            if key == "fields":
+                fields = value
+                columns = [[] for _ in value]
+            elif key == "channel_flags":
+                channel_flags = value
+            elif key == "data_time_stamp":
+                timestamp = value
+
+    arrays = {}
+    for field, values in zip(fields or [], columns):
+        arrays[_RENAMED_FIELDS.get(field, field)] = _to_array(field, values)
+    if "channel_flags" in arrays:
+        arrays["channel_flags"] = _decode_channel_flags(
+            arrays["channel_flags"], channel_flags
+        )
+    if "sensor_index" not in arrays:
+        return SensorsBatch.empty()
+
+    return SensorsBatch(arrays, timestamp=timestamp)
+
+
+class PurpleAirClient:
+    """A client for the PurpleAir API.
+
+    Requests share a single keep-alive session. Transient failures are
+    retried with jittered exponential backoff, and we track PurpleAir's rate
+    limit headers so that we can wait out the limit rather than get throttled.
+    """
+
+    # (connect, read) timeouts in seconds
+    TIMEOUT = (5, 60)
+
+    MAX_ATTEMPTS = 4
+
+    # Never sleep longer than this between attempts.
+    MAX_BACKOFF_SECONDS = 60
+
+    # Number of shards fetched at once.
+    MAX_WORKERS = 8
+
+    RETRY_STATUS_CODES = {429, 500, 502, 503, 504}
+
+    def __init__(self, api_key: str):
+        self._session = requests.Session()
+        # Keep a connection around for each worker fetching shards.
+        adapter = requests.adapters.HTTPAdapter(pool_maxsize=self.MAX_WORKERS)
+        self._session.mount("https://", adapter)
+        self._session.headers.update(
+            {"X-API-Key": api_key, "Accept-Encoding": "gzip, deflate"}
+        )
+        self._rate_limit_remaining: typing.Optional[int] = None
+        self._rate_limit_reset_at = 0.0
+
+    def call_sensors_api(
+        self,
+        stream: bool = False,
+        modified_since: typing.Optional[int] = None,
+        max_age: typing.Optional[int] = None,
+        fields: typing.Sequence[str] = PURPLEAIR_SENSORS_FIELDS,
+        bounding_box: typing.Optional[BoundingBox] = None,
+    ) -> requests.Response:
+        params: typing.Dict[str, typing.Union[int, float, str]] = {
+            "fields": ",".join(fields),
+            "location_type": 0,  # 0 is for outdoors
+        }
+        if bounding_box is not None:
+            params.update(dataclasses.asdict(bounding_box))
+        if modified_since is not None:
+            # Only return sensors whose data changed after this timestamp.
+            params["modified_since"] = modified_since
+        if max_age is not None:
+            # Only return sensors which reported within this many seconds.
+            params["max_age"] = max_age
+        return self._get(PURPLEAIR_SENSORS_API_URL, params, stream)
+
+    def get_sensors(
+        self,
+        modified_since: typing.Optional[int] = None,
+        max_age: typing.Optional[int] = None,
+        fields: typing.Sequence[str] = PURPLEAIR_SENSORS_FIELDS,
+        bounding_box: typing.Optional[BoundingBox] = None,
+    ) -> SensorsBatch:
+        # The connection can also drop while we're streaming the body, so
+        # retry the download and the parse together.
+        return self._with_retries(
+            lambda: self._parse_sensors(
+                self.call_sensors_api(
+                    stream=True,
+                    modified_since=modified_since,
+                    max_age=max_age,
+                    fields=fields,
+                    bounding_box=bounding_box,
+                )
+            )
+        )
+
+    def get_sensors_sharded(
+        self,
+        bounding_boxes: typing.Sequence[BoundingBox],
+        modified_since: typing.Optional[int] = None,
+        max_age: typing.Optional[int] = None,
+        fields: typing.Sequence[str] = PURPLEAIR_SENSORS_FIELDS,
+    ) -> SensorsBatch:
+        """Fetch the sensors in each bounding box concurrently and merge them.
+
+        A shard which fails is logged and skipped, so it only costs us the
+        sensors in its own region. If any shard fails the result has no
+        timestamp, since it doesn't cover everything up to any point in time.
+        Raises if every shard fails.
+        """
+        batches = []
+        errors: typing.List[Exception] = []
+        with concurrent.futures.ThreadPoolExecutor(
+            max_workers=self.MAX_WORKERS
+        ) as executor:
+            futures = {
+                executor.submit(
+                    self.get_sensors,
+                    modified_since=modified_since,
+                    max_age=max_age,
+                    fields=fields,
+                    bounding_box=bounding_box,
+                ): bounding_box
+                for bounding_box in bounding_boxes
+            }
+            for future in concurrent.futures.as_completed(futures):
+                try:
+                    batches.append(future.result())
+                except (requests.RequestException, json.JSONDecodeError) as e:
+                    logger.warning(
+                        "%s fetching purpleair sensors in %s: %s",
+                        type(e).__name__,
+                        futures[future],
+                        e,
+                    )
+                    errors.append(e)
+
+        if errors and not batches:
+            raise errors[0]
+        batch = SensorsBatch.concatenate(batches)
+        if errors:
+            batch.timestamp = 0
+        return batch
+
+    def _parse_sensors(self, resp: requests.Response) -> SensorsBatch:
+        try:
+            return parse_sensors_response(resp.iter_content(chunk_size=_CHUNK_SIZE))
+        finally:
+            resp.close()
+
+    def _get(
+        self,
+        url: str,
+        params: typing.Dict[str, typing.Union[int, float, str]],
+        stream: bool,
+    ) -> requests.Response:
+        self._wait_for_rate_limit()
+        resp = self._session.get(
+            url, params=params, stream=stream, timeout=self.TIMEOUT
+        )
+        self._update_rate_limit(resp)
+        resp.raise_for_status()
+        return resp
+
+    def _with_retries(self, func: typing.Callable[[], T]) -> T:
+        attempt = 1
+        while True:
+            try:
+                return func()
+            except requests.RequestException as e:
+                if attempt >= self.MAX_ATTEMPTS or not self._is_transient(e):
+                    raise
+                backoff = self._get_retry_after(e)
+                if backoff is None:
+                    backoff = random.uniform(0, 2**attempt)
+                backoff = min(backoff, self.MAX_BACKOFF_SECONDS)
+                logger.warning(
+                    "%s calling purpleair (attempt %s), retrying in %.1f seconds: %s",
+                    type(e).__name__,
+                    attempt,
+                    backoff,
+                    e,
+                )
+                time.sleep(backoff)
+                attempt += 1
+
+    def _is_transient(self, e: requests.RequestException) -> bool:
+        if isinstance(e, requests.HTTPError):
+            return (
+                e.response is not None
+                and e.response.status_code in self.RETRY_STATUS_CODES
+            )
+        return isinstance(
+            e,
+            (
+                requests.ConnectionError,
+                requests.Timeout,
+                requests.exceptions.ChunkedEncodingError,
+            ),
+        )
+
+    def _get_retry_after(self, e: requests.RequestException) -> typing.Optional[float]:
+        if e.response is None:
+            return None
+        try:
+            return float(e.response.headers["Retry-After"])
+        except (KeyError, ValueError):
+            return None
+
+    def _update_rate_limit(self, resp: requests.Response):
+        try:
+            self._rate_limit_remaining = int(resp.headers["X-RateLimit-Remaining"])
+            reset = float(resp.headers["X-RateLimit-Reset"])
+        except (KeyError, ValueError):
+            return
+        # Some APIs send seconds until the reset, others an epoch timestamp.
+        self._rate_limit_reset_at = reset if reset > 10**9 else time.time() + reset
+
+    def _wait_for_rate_limit(self):
+        if self._rate_limit_remaining is None or self._rate_limit_remaining > 0:
+            return
+        wait = min(self._rate_limit_reset_at - time.time(), self.MAX_BACKOFF_SECONDS)
+        if wait > 0:
+            logger.warning("Waiting %.1f seconds for purpleair rate limit", wait)
+            time.sleep(wait)
+        self._rate_limit_remaining = None
+
+
+_client: typing.Optional[PurpleAirClient] = None
+
+
+def get_purpleair_client() -> PurpleAirClient:
+    global _client
+    if _client is None:
+        _client = PurpleAirClient(PURPLEAIR_API_KEY)
+    return _client
+
+
+def call_purpleair_sensors_api(
+    stream: bool = False,
+    modified_since: typing.Optional[int] = None,
+    max_age: typing.Optional[int] = None,
+) -> requests.Response:
+    return get_purpleair_client().call_sensors_api(
+        stream=stream, modified_since=modified_since, max_age=max_age
+    )
+
+
+def get_purpleair_sensors(
+    modified_since: typing.Optional[int] = None,
+    max_age: typing.Optional[int] = None,
+    fields: typing.Sequence[str] = PURPLEAIR_SENSORS_FIELDS,
+) -> SensorsBatch:
+    return get_purpleair_client().get_sensors(
+        modified_since=modified_since, max_age=max_age, fields=fields
+    )
+
 
-def call_purpleair_sensors_api() -> requests.Response:
-    fields = [
-        "pm2.5",
-        "latitude",
-        "longitude",
-        "last_seen",
-        "channel_flags",
-        "humidity",
-        "pm2.5_cf_1",
-    ]
-    params: typing.Dict[str, typing.Union[int, str]] = {
-        "fields": ",".join(fields),
-        "location_type": 0,  # 0 is for outdoors
-    }
-    resp = requests.get(
-        PURPLEAIR_SENSORS_API_URL,
-        params=params,
-        headers={"X-API-Key": PURPLEAIR_API_KEY},
+def get_purpleair_sensors_sharded(
+    bounding_boxes: typing.Sequence[BoundingBox] = PURPLEAIR_SHARDS,
+    modified_since: typing.Optional[int] = None,
+    max_age: typing.Optional[int] = None,
+    fields: typing.Sequence[str] = PURPLEAIR_SENSORS_FIELDS,
+) -> SensorsBatch:
+    return get_purpleair_client().get_sensors_sharded(
+        bounding_boxes, modified_since=modified_since, max_age=max_age, fields=fields
     )
-    resp.raise_for_status()
-    return resp
@@ -1,9 +1,14 @@
 import dataclasses
 import enum
 import math
+import numpy as np
 import typing
 
 from flask_babel import gettext
+from sqlalchemy import and_
+from sqlalchemy import case
+from sqlalchemy import null
+from sqlalchemy.sql import ColumnElement
 
 from airq.lib.choices import IntChoicesEnum
 from airq.lib.choices import StrChoicesEnum
@@ -123,21 +128,112 @@ class Readings:
         return _pm25_to_aqi(self.get_pm25(conversion_stragy))
 
 
+def get_pm25_sql(
+    pm25: ColumnElement,
+    pm_cf_1: ColumnElement,
+    humidity: ColumnElement,
+    conversion_factor: ColumnElement,
+) -> ColumnElement:
+    """SQL for the pm25 of the given readings, like `Readings.get_pm25`."""
+    return case(
+        [
+            (
+                and_(
+                    conversion_factor == ConversionFactor.US_EPA.value,
+                    pm_cf_1.isnot(None),
+                    humidity.isnot(None),
+                ),
+                _us_epa_conv(pm_cf_1, humidity),
+            )
+        ],
+        else_=pm25,
+    )
+
+
+def get_pm25_level_sql(measurement: ColumnElement) -> ColumnElement:
+    """SQL for the value of `Pm25.from_measurement(measurement)`.
+
+    Null measurements have a null level.
+    """
+    levels = list(Pm25)
+    return case(
+        [(measurement.is_(None), null())]
+        + [
+            (measurement < upper.value, level.value)
+            for level, upper in zip(levels, levels[1:])
+        ],
+        else_=levels[-1].value,
+    )
+
+
+def get_pm25_array(
+    pm25: np.ndarray,
+    pm_cf_1: np.ndarray,
+    humidity: np.ndarray,
+    conversion_factor: ConversionFactor,
+    has_pm_cf_1: typing.Union[bool, np.ndarray] = True,
+    has_humidity: typing.Union[bool, np.ndarray] = True,
+) -> np.ndarray:
+    """Like `Readings.get_pm25`, for arrays of readings.
+
+    Null readings can't be told apart from NaN in an array, so `has_pm_cf_1`
+    and `has_humidity` say which of those readings aren't null.
+    """
+    if conversion_factor == ConversionFactor.US_EPA:
+        return np.where(
+            has_pm_cf_1 & has_humidity, _us_epa_conv(pm_cf_1, humidity), pm25
+        )
+    return pm25
+
+
+def get_pm25_level_array(measurements: np.ndarray) -> np.ndarray:
+    """Like `Pm25.from_measurement`, for an array of measurements."""
+    levels = np.array([level.value for level in Pm25])
+    return levels[np.searchsorted(levels[1:], measurements, side="right")]
+
+
+def get_aqi_array(concentrations: np.ndarray) -> np.ndarray:
+    """Like `Readings.get_aqi`, for an array of concentrations.
+
+    Returns floats, which are NaN where `Readings.get_aqi` would raise
+    because the concentration isn't finite.
+    """
+    concentrations = np.asarray(concentrations, dtype=np.float64)
+    aqis = np.empty(concentrations.shape, dtype=np.float64)
+    is_set = np.zeros(concentrations.shape, dtype=bool)
+    for i, (aqi_high, aqi_low, conc_high, conc_low) in enumerate(_AQI_RANGES):
+        is_in_range = ~is_set
+        if i < len(_AQI_RANGES) - 1:
+            is_in_range &= conc_low < concentrations
+        aqis[is_in_range] = np.ceil(
+            ((concentrations[is_in_range] - conc_low) / (conc_high - conc_low))
+            * (aqi_high - aqi_low)
+            + aqi_low
+        )
+        is_set |= is_in_range
+    aqis[~np.isfinite(aqis)] = np.nan
+    return aqis
+
+
+# The (aqi_high, aqi_low, conc_high, conc_low) of each AQI range, from highest
+# to lowest. Each range covers concentrations above its `conc_low`, except
+# for the lowest which covers everything else.
+_AQI_RANGES = [
+    (500, 401, 500, 350.5),
+    (400, 301, 350.4, 250.5),
+    (300, 201, 250.4, 150.5),
+    (200, 151, 150.4, 55.5),
+    (150, 101, 55.4, 35.5),
+    (100, 51, 35.4, 12.1),
+    (50, 0, 12, 0),
+]
+
+
 def _pm25_to_aqi(concentration: float) -> int:
-    if 350.5 < concentration:
-        return _linear(500, 401, 500, 350.5, concentration)
-    elif 250.5 < concentration:
-        return _linear(400, 301, 350.4, 250.5, concentration)
-    elif 150.5 < concentration:
-        return _linear(300, 201, 250.4, 150.5, concentration)
-    elif 55.5 < concentration:
-        return _linear(200, 151, 150.4, 55.5, concentration)
-    elif 35.5 < concentration:
-        return _linear(150, 101, 55.4, 35.5, concentration)
-    elif 12.1 < concentration:
-        return _linear(100, 51, 35.4, 12.1, concentration)
-    else:
-        return _linear(50, 0, 12, 0, concentration)
+    for aqi_high, aqi_low, conc_high, conc_low in _AQI_RANGES[:-1]:
+        if conc_low < concentration:
+            return _linear(aqi_high, aqi_low, conc_high, conc_low, concentration)
+    return _linear(*_AQI_RANGES[-1], concentration)
 
 
 def _linear(
@@ -149,6 +245,9 @@ def _linear(
     )
 
 
-def _us_epa_conv(pm_cf_1: float, humidity: float) -> float:
+TReading = typing.TypeVar("TReading", float, np.ndarray)
+
+
+def _us_epa_conv(pm_cf_1: TReading, humidity: TReading) -> TReading:
     # See https://cfpub.epa.gov/si/si_public_record_report.cfm?dirEntryId=349513&Lab=CEMM
     return (0.534 * pm_cf_1) - (0.0844 * humidity) + 5.604
@@ -0,0 +1,120 @@
+import json
+import numpy as np
+import os
+import typing
+
+
+SENSORS_SNAPSHOT_DTYPE = np.dtype(
+    [
+        ("id", np.int64),
+        ("latitude", np.float64),
+        ("longitude", np.float64),
+        ("latest_reading", np.float64),
+        ("humidity", np.float64),
+        ("pm_cf_1", np.float64),
+        ("updated_at", np.int64),
+    ]
+)
+
+_ROWS_FILENAME = "sensors.npy"
+_METADATA_FILENAME = "sensors.json"
+
+
+class SensorsSnapshot:
+    """A compact, array-backed copy of the `sensors` table.
+
+    Rows are kept sorted by id so they can be looked up with a binary search.
+    The generation identifies the version of the table this copy was taken
+    from, and the digest identifies the PurpleAir payload it was built from.
+    """
+
+    def __init__(self, rows: np.ndarray, generation: str, digest: str = ""):
+        self.rows = rows
+        self.generation = generation
+        self.digest = digest
+
+    def __repr__(self) -> str:
+        return f"<SensorsSnapshot {self.generation}: {len(self)} sensors>"
+
+    def __len__(self) -> int:
+        return len(self.rows)
+
+    @classmethod
+    def from_rows(
+        cls, rows: np.ndarray, generation: str, digest: str = ""
+    ) -> "SensorsSnapshot":
+        return cls(np.sort(rows, order="id"), generation, digest)
+
+    @classmethod
+    def load(cls, directory: str) -> typing.Optional["SensorsSnapshot"]:
+        """Memory-map the snapshot saved in the given directory, if any."""
+        try:
+            with open(os.path.join(directory, _METADATA_FILENAME)) as f:
+                metadata = json.load(f)
+            rows = np.load(os.path.join(directory, _ROWS_FILENAME), mmap_mode="r")
+        except (OSError, ValueError):
+            return None
+        if rows.dtype != SENSORS_SNAPSHOT_DTYPE:
+            return None
+        return cls(rows, metadata["generation"], metadata["digest"])
+
+    def save(self, directory: str):
+        # Write to temporary files first so a crash can't leave a torn snapshot.
+        os.makedirs(directory, exist_ok=True)
+        rows_path = os.path.join(directory, _ROWS_FILENAME)
+        with open(rows_path + ".tmp", "wb") as f:
+            np.save(f, self.rows)
+        os.replace(rows_path + ".tmp", rows_path)
+        metadata_path = os.path.join(directory, _METADATA_FILENAME)
+        with open(metadata_path + ".tmp", "w") as f:
+            json.dump({"generation": self.generation, "digest": self.digest}, f)
+        os.replace(metadata_path + ".tmp", metadata_path)
+
+    def locate(self, ids: np.ndarray) -> typing.Tuple[np.ndarray, np.ndarray]:
+        """Find the given sensor ids in this snapshot.
+
+        Returns the index of each id in `rows` and a mask of which ids were
+        found. The index of an id which wasn't found is meaningless.
+        """
+        if not len(self.rows):
+            return np.zeros(len(ids), dtype=np.intp), np.zeros(len(ids), dtype=bool)
+        indices = np.searchsorted(self.rows["id"], ids)
+        indices[indices == len(self.rows)] = 0
+        return indices, self.rows["id"][indices] == ids
+
+    def diff(
+        self, rows: np.ndarray
+    ) -> typing.Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+        """Compare the given rows to this snapshot.
+
+        Returns four masks over `rows`: which sensors are new, which have
+        moved (including new sensors), which have changed in any way
+        (including moved sensors) and which have moved or have a different
+        reading, ignoring when it was taken.
+        """
+        if not len(self.rows):
+            is_new = np.ones(len(rows), dtype=bool)
+            return is_new, is_new, is_new, is_new
+
+        indices, is_known = self.locate(rows["id"])
+        previous = self.rows[indices]
+        is_new = ~is_known
+        is_moved = (
+            is_new
+            | (previous["latitude"] != rows["latitude"])
+            | (previous["longitude"] != rows["longitude"])
+        )
+        has_new_reading = is_moved
+        for field in ("latest_reading", "humidity", "pm_cf_1"):
+            has_new_reading = has_new_reading | (previous[field] != rows[field])
+        is_changed = has_new_reading | (previous["updated_at"] != rows["updated_at"])
+        return is_new, is_moved, is_changed, has_new_reading
+
+    def update(
+        self, rows: np.ndarray, generation: str, digest: str
+    ) -> "SensorsSnapshot":
+        """Build a new snapshot with the given rows added or replaced."""
+        is_kept = ~np.isin(self.rows["id"], rows["id"])
+        return self.from_rows(
+            np.concatenate([self.rows[is_kept], rows]), generation, digest
+        )
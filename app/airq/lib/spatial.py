@@ -0,0 +1,218 @@
+import math
+import numpy as np
+import numpy.typing as npt
+import typing
+
+from airq.lib.geo import EARTH_RADIUS_KM
+from airq.lib.geo import get_latitude_padding
+from airq.lib.geo import get_longitude_padding
+from airq.lib.geo import KM_PER_DEGREE
+
+# Half the circumference of the earth; no two points are farther apart.
+MAX_DISTANCE_KM = math.pi * EARTH_RADIUS_KM
+
+
+def _to_unit_vectors(latitudes: np.ndarray, longitudes: np.ndarray) -> np.ndarray:
+    latitudes = np.radians(latitudes)
+    longitudes = np.radians(longitudes)
+    cos_latitudes = np.cos(latitudes)
+    return np.stack(
+        [
+            cos_latitudes * np.cos(longitudes),
+            cos_latitudes * np.sin(longitudes),
+            np.sin(latitudes),
+        ],
+        axis=-1,
+    )
+
+
+def _expand_ranges(
+    starts: np.ndarray, counts: np.ndarray
+) -> typing.Tuple[np.ndarray, np.ndarray]:
+    """Concatenate `np.arange(start, start + count)` for each start and count.
+
+    Returns the index of the range each value came from, and the values.
+    """
+    ranges = np.repeat(np.arange(len(starts)), counts)
+    offsets = np.arange(len(ranges)) - np.repeat(np.cumsum(counts) - counts, counts)
+    return ranges, starts[ranges] + offsets
+
+
+class SpatialIndex:
+    """An in-memory index of points on the earth for proximity queries.
+
+    Points are bucketed into a grid of `cell_degrees` latitude/longitude cells,
+    so a query only looks at the cells which could contain a match. Distances
+    are measured exactly between unit vectors, and agree with
+    `haversine_distance`.
+    """
+
+    def __init__(
+        self,
+        ids: npt.ArrayLike,
+        latitudes: npt.ArrayLike,
+        longitudes: npt.ArrayLike,
+        cell_degrees: float = 0.5,
+    ):
+        self._cell_degrees = cell_degrees
+        self._num_rows = math.ceil(180 / cell_degrees)
+        self._num_cols = math.ceil(360 / cell_degrees)
+
+        ids_array = np.asarray(ids, dtype=np.int64)
+        latitudes_array = np.asarray(latitudes, dtype=np.float64)
+        longitudes_array = np.asarray(longitudes, dtype=np.float64)
+        cells = (
+            self._get_rows(latitudes_array) * self._num_cols
+            + self._get_cols(longitudes_array) % self._num_cols
+        )
+        order = np.argsort(cells, kind="stable")
+        self._cells = cells[order]
+        self._ids = ids_array[order]
+        self._vectors = _to_unit_vectors(
+            latitudes_array[order], longitudes_array[order]
+        )
+
+    def __repr__(self) -> str:
+        return f"<SpatialIndex {len(self)} points>"
+
+    def __len__(self) -> int:
+        return len(self._ids)
+
+    def _get_rows(self, latitudes: np.ndarray) -> np.ndarray:
+        rows = np.floor((latitudes + 90) / self._cell_degrees).astype(np.int64)
+        return np.clip(rows, 0, self._num_rows - 1)
+
+    def _get_cols(self, longitudes: np.ndarray) -> np.ndarray:
+        # Not wrapped, so that callers can tell when a range crosses 180°.
+        return np.floor((longitudes + 180) / self._cell_degrees).astype(np.int64)
+
+    def _get_candidates(
+        self, latitudes: np.ndarray, longitudes: np.ndarray, km: float
+    ) -> typing.Tuple[np.ndarray, np.ndarray]:
+        """Pairs of query and point indices for every point in a cell which may
+        be within `km` of each query point."""
+        num_cols = self._num_cols
+        lat_padding = get_latitude_padding(km)
+        first_rows = self._get_rows(latitudes - lat_padding)
+        last_rows = self._get_rows(latitudes + lat_padding)
+
+        # Degrees of longitude are shortest on the side closest to the pole.
+        lng_paddings = get_longitude_padding(np.abs(latitudes) + lat_padding, km)
+        spans_all_cols = ~np.isfinite(lng_paddings) | (lng_paddings >= 180)
+        lng_paddings[spans_all_cols] = 0
+        first_cols = self._get_cols(longitudes - lng_paddings)
+        last_cols = self._get_cols(longitudes + lng_paddings)
+        spans_all_cols |= last_cols - first_cols + 1 >= num_cols
+        first_cols[spans_all_cols] = 0
+        last_cols[spans_all_cols] = num_cols - 1
+
+        # Ranges which cross 180° are split in two, one on each side.
+        wraps_west = first_cols < 0
+        wraps_east = last_cols >= num_cols
+        wraps = wraps_west | wraps_east
+        query_indices = np.arange(len(latitudes))
+        range_queries = np.concatenate([query_indices, query_indices[wraps]])
+        range_first_cols = np.concatenate(
+            [
+                np.where(wraps_west, first_cols + num_cols, first_cols),
+                np.zeros(np.count_nonzero(wraps), dtype=np.int64),
+            ]
+        )
+        range_last_cols = np.concatenate(
+            [
+                np.where(wraps, num_cols - 1, last_cols),
+                np.where(wraps_west, last_cols, last_cols - num_cols)[wraps],
+            ]
+        )
+
+        # Cells in a row are contiguous, so each range of columns in each row
+        # is a single slice of the sorted points.
+        ranges, rows = _expand_ranges(
+            first_rows[range_queries],
+            last_rows[range_queries] - first_rows[range_queries] + 1,
+        )
+        starts = np.searchsorted(
+            self._cells, rows * num_cols + range_first_cols[ranges], side="left"
+        )
+        ends = np.searchsorted(
+            self._cells, rows * num_cols + range_last_cols[ranges], side="right"
+        )
+        slices, point_indices = _expand_ranges(starts, ends - starts)
+        return range_queries[ranges[slices]], point_indices
+
+    def within_radius_many(
+        self, latitudes: npt.ArrayLike, longitudes: npt.ArrayLike, km: float
+    ) -> typing.Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """Find every point within `km` of each of the given points at once.
+
+        Returns the index of the query point each match belongs to, the ids of
+        the matching points and their distances in kilometers, sorted by query
+        point and then by distance.
+        """
+        latitudes_array = np.asarray(latitudes, dtype=np.float64).reshape(-1)
+        longitudes_array = np.asarray(longitudes, dtype=np.float64).reshape(-1)
+        query_indices, point_indices = self._get_candidates(
+            latitudes_array, longitudes_array, km
+        )
+        query_vectors = _to_unit_vectors(latitudes_array, longitudes_array)
+        chords = np.linalg.norm(
+            self._vectors[point_indices] - query_vectors[query_indices], axis=-1
+        )
+        distances = 2 * EARTH_RADIUS_KM * np.arcsin(np.minimum(chords / 2, 1.0))
+        is_within = distances <= km
+        query_indices = query_indices[is_within]
+        point_indices = point_indices[is_within]
+        distances = distances[is_within]
+        order = np.lexsort((distances, query_indices))
+        return query_indices[order], self._ids[point_indices[order]], distances[order]
+
+    def within_radius(
+        self, latitude: float, longitude: float, km: float
+    ) -> typing.Tuple[np.ndarray, np.ndarray]:
+        """Find every point within `km` of the given point.
+
+        Returns the ids of the points and their distances in kilometers,
+        sorted by distance.
+        """
+        _, ids, distances = self.within_radius_many([latitude], [longitude], km)
+        return ids, distances
+
+    def k_nearest_many(
+        self, latitudes: npt.ArrayLike, longitudes: npt.ArrayLike, k: int, max_km: float
+    ) -> typing.Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """Find the `k` points within `max_km` nearest to each of the given points.
+
+        Returns the same as `within_radius_many`, limited to `k` points per
+        query point.
+        """
+        query_indices, ids, distances = self.within_radius_many(
+            latitudes, longitudes, max_km
+        )
+        ranks = np.arange(len(query_indices)) - np.searchsorted(
+            query_indices, query_indices, side="left"
+        )
+        is_nearest = ranks < k
+        return query_indices[is_nearest], ids[is_nearest], distances[is_nearest]
+
+    def k_nearest(
+        self,
+        latitude: float,
+        longitude: float,
+        k: int,
+        max_km: typing.Optional[float] = None,
+    ) -> typing.Tuple[np.ndarray, np.ndarray]:
+        """Find the `k` points nearest to the given point.
+
+        Optionally only considers points within `max_km`. Returns the ids of
+        the points and their distances in kilometers, sorted by distance.
+        """
+        if max_km is None:
+            max_km = MAX_DISTANCE_KM
+        km = min(self._cell_degrees * KM_PER_DEGREE, max_km)
+        while True:
+            ids, distances = self.within_radius(latitude, longitude, km)
+            # Every point within the radius was found, so if there are at
+            # least k of them then they include the k nearest.
+            if len(ids) >= k or km >= max_km:
+                return ids[:k], distances[:k]
+            km = min(km * 2, max_km)
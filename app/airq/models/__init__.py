@@ -3,5 +3,6 @@ from . import clients
 from . import events
 from . import relations
 from . import sensors
+from . import syncs
 from . import users
 from . import zipcodes
@@ -8,17 +8,23 @@ from flask_babel import lazy_gettext
 from flask_sqlalchemy import BaseQuery
 from sqlalchemy import and_
 from sqlalchemy import func
-from sqlalchemy.orm import joinedload
+from sqlalchemy import or_
+from sqlalchemy.orm import contains_eager
 from twilio.base.exceptions import TwilioRestException
 
 from airq import config
 from airq.config import db
+from airq.lib.alerts import MIN_RECENT_AQI_CHANGE
+from airq.lib.alerts import RECENT_ALERT_SECONDS
+from airq.lib.client_preferences import ClientPreferencesRegistry
 from airq.lib.client_preferences import IntegerChoicesPreference
 from airq.lib.client_preferences import IntegerPreference
 from airq.lib.client_preferences import StringChoicesPreference
 from airq.lib.clock import now
 from airq.lib.clock import timestamp
 from airq.lib.readings import ConversionFactor
+from airq.lib.readings import get_pm25_level_sql
+from airq.lib.readings import get_pm25_sql
 from airq.lib.readings import Pm25
 from airq.lib.readings import Readings
 from airq.lib.sms import coerce_phone_number
@@ -89,14 +95,89 @@ class ClientQuery(BaseQuery):
         return query
 
     def filter_eligible_for_sending(self) -> "ClientQuery":
+        """Clients subscribed to alerts, joined with their zipcodes."""
         return (
             self.filter_phones()
-            .options(joinedload(Client.zipcode))
+            .join(Zipcode, Client.zipcode_id == Zipcode.id)
+            .options(contains_eager(Client.zipcode))
             .filter(Client.alerts_disabled_at == 0)
-            .filter(Client.zipcode_id.isnot(None))
         )
 
-    def filter_eligible_for_share_requests(self) -> "ClientQuery":
+    def filter_in_send_window(
+        self, timezones: typing.Set[typing.Optional[str]]
+    ) -> "ClientQuery":
+        """Clients whose zipcodes are in one of the given timezones.
+
+        The query must already be joined with the zipcodes table. See
+        `Client.get_timezones_in_send_window`.
+        """
+        conditions = [Zipcode.timezone.in_([tz for tz in timezones if tz is not None])]
+        if None in timezones:
+            conditions.append(Zipcode.timezone.is_(None))
+        return self.filter(or_(*conditions))
+
+    def filter_alert_candidates(
+        self,
+        timezones_in_send_window: typing.Optional[
+            typing.Set[typing.Optional[str]]
+        ] = None,
+    ) -> "ClientQuery":
+        """Clients eligible for sending who may need an alert right now.
+
+        These are the clients in their send window, outside of their alert
+        frequency, and whose current pm25 level differs from the one they were
+        last alerted about. `Client.maybe_notify` makes the final decision.
+        """
+        if timezones_in_send_window is None:
+            timezones_in_send_window = Client.get_timezones_in_send_window()
+        conversion_factor = func.coalesce(
+            Client.preferences["conversion_factor"].as_string(),
+            ConversionFactor(
+                ClientPreferencesRegistry.get_default("conversion_factor")
+            ).value,
+        )
+        alert_frequency = func.coalesce(
+            Client.preferences["alert_frequency"].as_integer(),
+            ClientPreferencesRegistry.get_default("alert_frequency"),
+        )
+        curr_pm25_level = get_pm25_level_sql(
+            get_pm25_sql(
+                Zipcode.pm25, Zipcode.pm_cf_1, Zipcode.humidity, conversion_factor
+            )
+        )
+        last_pm25_level = get_pm25_level_sql(
+            get_pm25_sql(
+                Client.last_pm25,
+                Client.last_pm_cf_1,
+                Client.last_humidity,
+                conversion_factor,
+            )
+        )
+        return (
+            self.filter_eligible_for_sending()
+            .filter_in_send_window(timezones_in_send_window)
+            .filter(Client.last_alert_sent_at < timestamp() - alert_frequency * 60 * 60)
+            .filter(curr_pm25_level.is_distinct_from(last_pm25_level))
+        )
+
+    def filter_in_demand(self, active_since: float) -> "ClientQuery":
+        """Clients who need up-to-date readings for their zipcode.
+
+        These are clients subscribed to alerts and clients who have been active
+        since the given timestamp.
+        """
+        return self.filter(Client.zipcode_id.isnot(None)).filter(
+            or_(Client.alerts_disabled_at == 0, Client.last_activity_at > active_since)
+        )
+
+    def filter_eligible_for_share_requests(
+        self,
+        timezones_in_send_window: typing.Optional[
+            typing.Set[typing.Optional[str]]
+        ] = None,
+    ) -> "ClientQuery":
+        if timezones_in_send_window is None:
+            timezones_in_send_window = Client.get_timezones_in_send_window()
         subq = (
             Event.query.filter(Event.type_code == EventType.SHARE_REQUEST)
             .filter(Event.timestamp > Client.get_share_request_cutoff())
@@ -106,6 +187,9 @@ class ClientQuery(BaseQuery):
         share_window_start, share_window_end = Client.get_share_window()
         return (
             self.filter_phones()
+            .join(Zipcode, Client.zipcode_id == Zipcode.id)
+            .options(contains_eager(Client.zipcode))
+            .filter_in_send_window(timezones_in_send_window)
             .outerjoin(subq, and_(subq.c.client_id == Client.id))
             .filter(subq.c.timestamp == None)
             # Client must have signed up more than 7 days ago
@@ -305,9 +389,13 @@ class Client(db.Model):  # type: ignore
         """Last Pm25 level for this client as determined by its chosen strategy."""
         return self.get_last_readings().get_pm25_level(self.conversion_factor)
 
-    def get_recommendations(self, num_desired: int) -> typing.List[Zipcode]:
+    def get_recommendations(
+        self, num_desired: int, refresh_metrics: bool = False
+    ) -> typing.List[Zipcode]:
         """Recommended zipcodes for this client."""
-        return self.zipcode.get_recommendations(num_desired, self.conversion_factor)
+        return self.zipcode.get_recommendations(
+            num_desired, self.conversion_factor, refresh_metrics=refresh_metrics
+        )
 
     #
     # Alerting
@@ -351,12 +439,28 @@ class Client(db.Model):  # type: ignore
     def is_in_send_window(self) -> bool:
         if self.zipcode_id is None:
             return False
+        return self.is_timezone_in_send_window(self.zipcode.timezone)
+
+    @classmethod
+    def is_timezone_in_send_window(cls, timezone: typing.Optional[str]) -> bool:
         # Timezone can be null since our data is incomplete.
-        timezone = self.zipcode.timezone or "America/Los_Angeles"
-        dt = now(timezone=timezone)
-        send_start, send_end = self.SEND_WINDOW_HOURS
+        dt = now(timezone=timezone or "America/Los_Angeles")
+        send_start, send_end = cls.SEND_WINDOW_HOURS
         return send_start <= dt.hour < send_end
 
+    @classmethod
+    def get_timezones_in_send_window(cls) -> typing.Set[typing.Optional[str]]:
+        """The timezones of zipcodes which are currently in the send window.
+
+        Includes None if zipcodes without a timezone are. Each timezone is
+        only checked once, so this is much cheaper than checking each client.
+        """
+        return {
+            timezone
+            for timezone, in Zipcode.query.with_entities(Zipcode.timezone).distinct()
+            if cls.is_timezone_in_send_window(timezone)
+        }
+
     def send_message(self, message: str, media: typing.Optional[str] = None) -> bool:
         if self.type_code == ClientIdentifierType.PHONE_NUMBER:
             try:
@@ -413,11 +517,21 @@ class Client(db.Model):  # type: ignore
             return False
 
         # Do not alert clients who received an alert recently unless AQI has changed markedly.
-        was_alerted_recently = self.last_alert_sent_at > timestamp() - (60 * 60 * 6)
+        was_alerted_recently = (
+            self.last_alert_sent_at > timestamp() - RECENT_ALERT_SECONDS
+        )
         last_aqi = self.get_last_aqi()
-        if was_alerted_recently and abs(curr_aqi - last_aqi) < 50:
+        if was_alerted_recently and abs(curr_aqi - last_aqi) < MIN_RECENT_AQI_CHANGE:
             return False
 
+        return self.send_alert(curr_pm25, curr_aqi_level, curr_aqi)
+
+    def send_alert(self, curr_pm25: float, curr_aqi_level: Pm25, curr_aqi: int) -> bool:
+        """Alert this client to the current readings in its zipcode.
+
+        Doesn't check whether the client should be alerted; see `maybe_notify`
+        and `airq.lib.alerts.get_alerts`.
+        """
         message = gettext(
             'AQI is now %(curr_aqi)s in zipcode %(zipcode)s (level: %(curr_aqi_level)s).\n\nReply "M" for Menu or "E" to end alerts.',
             zipcode=self.zipcode.zipcode,
@@ -1,14 +1,130 @@
+import dataclasses
+import numpy as np
+import typing
+
+from flask_sqlalchemy import BaseQuery
+from sqlalchemy import text
+
 from airq.config import db
+from airq.lib.geo import BoundingBox
+from airq.lib.metrics import RELATIONS_DTYPE
+from airq.lib.postgres import copy_to_array
+
+
+def _in_bounding_box(table: str) -> str:
+    # Matches `BoundingBox.contains`.
+    return (
+        f"{table}.latitude >= :selat AND {table}.latitude < :nwlat "
+        f"AND {table}.longitude >= :nwlng AND {table}.longitude < :selng"
+    )
+
+
+class SensorZipcodeRelationQuery(BaseQuery):
+    def get_affected_zipcode_ids(
+        self,
+        sensor_ids: typing.List[int],
+        updated_since: float,
+        previously_updated_since: float,
+        refreshed_before: int,
+        bounding_box: typing.Optional[BoundingBox] = None,
+    ) -> typing.List[int]:
+        """Find the zipcodes whose metrics may be out of date.
+
+        Those are the zipcodes related to any of the given sensors, to a
+        sensor which was updated after `previously_updated_since` but not
+        after `updated_since`, or to a sensor updated after `updated_since`
+        if the zipcode's readings were computed before `refreshed_before`.
+
+        If a bounding box is given, sensors which went stale and zipcodes
+        due a refresh are only found within it.
+        """
+        sensors_in_box = zipcodes_in_box = "TRUE"
+        params: typing.Dict[str, typing.Any] = {}
+        if bounding_box is not None:
+            sensors_in_box = _in_bounding_box("sensors")
+            zipcodes_in_box = _in_bounding_box("zipcodes")
+            params = dataclasses.asdict(bounding_box)
+        result = db.session.execute(
+            text(
+                """
+                SELECT DISTINCT sensors_zipcodes.zipcode_id
+                FROM sensors_zipcodes
+                JOIN sensors ON sensors.id = sensors_zipcodes.sensor_id
+                JOIN zipcodes ON zipcodes.id = sensors_zipcodes.zipcode_id
+                WHERE
+                    sensors.id = ANY(:sensor_ids)
+                    OR (
+                        sensors.updated_at > :previously_updated_since
+                        AND sensors.updated_at <= :updated_since
+                        AND {sensors_in_box}
+                    )
+                    OR (
+                        sensors.updated_at > :updated_since
+                        AND zipcodes.pm25_updated_at < :refreshed_before
+                        AND {zipcodes_in_box}
+                    )
+                """.format(
+                    sensors_in_box=sensors_in_box, zipcodes_in_box=zipcodes_in_box
+                )
+            ),
+            {
+                **params,
+                "sensor_ids": sensor_ids,
+                "updated_since": updated_since,
+                "previously_updated_since": previously_updated_since,
+                "refreshed_before": refreshed_before,
+            },
+        )
+        return [row[0] for row in result]
+
+    def get_fresh_relations(
+        self,
+        updated_since: float,
+        zipcode_ids: typing.Optional[typing.List[int]] = None,
+    ) -> np.ndarray:
+        """Relations of sensors updated after `updated_since`, with readings.
+
+        Optionally only includes relations to the given zipcodes. Returns an
+        array of `RELATIONS_DTYPE`.
+        """
+        zipcodes_filter = ""
+        if zipcode_ids is not None:
+            zipcodes_filter = "AND sensors_zipcodes.zipcode_id = ANY(%(zipcode_ids)s)"
+        return copy_to_array(
+            """
+            SELECT
+                sensors_zipcodes.zipcode_id,
+                sensors_zipcodes.sensor_id,
+                sensors_zipcodes.distance,
+                sensors.latest_reading,
+                sensors.humidity,
+                sensors.pm_cf_1
+            FROM sensors_zipcodes
+            JOIN sensors ON sensors.id = sensors_zipcodes.sensor_id
+            WHERE sensors.updated_at > %(updated_since)s
+            {zipcodes_filter}
+            """.format(
+                zipcodes_filter=zipcodes_filter
+            ),
+            {"updated_since": updated_since, "zipcode_ids": zipcode_ids},
+            RELATIONS_DTYPE,
+        )
 
 
 class SensorZipcodeRelation(db.Model):  # type: ignore
     __tablename__ = "sensors_zipcodes"
 
+    query_class = SensorZipcodeRelationQuery
+
     sensor_id = db.Column(
         db.Integer(), db.ForeignKey("sensors.id"), nullable=False, primary_key=True
     )
     zipcode_id = db.Column(
-        db.Integer(), db.ForeignKey("zipcodes.id"), nullable=False, primary_key=True
+        db.Integer(),
+        db.ForeignKey("zipcodes.id"),
+        nullable=False,
+        primary_key=True,
+        index=True,
     )
     distance = db.Column(db.Float(), nullable=False)
 
@@ -1,4 +1,7 @@
+import geohash
+
 from flask_sqlalchemy import BaseQuery
+from sqlalchemy import or_
 
 from airq.config import db
 
@@ -14,6 +17,16 @@ class SensorQuery(BaseQuery):
             return result[0]
         return 0
 
+    def filter_by_geohash_prefix(self, prefix: str) -> "SensorQuery":
+        """Sensors within the geohash cell `prefix`."""
+        return self.filter(Sensor.geohash.like(f"{prefix}%"))
+
+    def filter_by_geohash_neighbors(self, prefix: str) -> "SensorQuery":
+        """Sensors within the geohash cell `prefix` or the eight around it."""
+        return self.filter(
+            or_(*(Sensor.geohash.like(f"{cell}%") for cell in geohash.expand(prefix)))
+        )
+
 
 class Sensor(db.Model):  # type: ignore
     __tablename__ = "sensors"
@@ -27,22 +40,15 @@ class Sensor(db.Model):  # type: ignore
     updated_at = db.Column(db.Integer(), nullable=False)
     latitude = db.Column(db.Float(), nullable=False)
     longitude = db.Column(db.Float(), nullable=False)
-    geohash_bit_1 = db.Column(db.String(), nullable=False)
-    geohash_bit_2 = db.Column(db.String(), nullable=False)
-    geohash_bit_3 = db.Column(db.String(), nullable=False)
-    geohash_bit_4 = db.Column(db.String(), nullable=False)
-    geohash_bit_5 = db.Column(db.String(), nullable=False)
-    geohash_bit_6 = db.Column(db.String(), nullable=False)
-    geohash_bit_7 = db.Column(db.String(), nullable=False)
-    geohash_bit_8 = db.Column(db.String(), nullable=False)
-    geohash_bit_9 = db.Column(db.String(), nullable=False)
-    geohash_bit_10 = db.Column(db.String(), nullable=False)
-    geohash_bit_11 = db.Column(db.String(), nullable=False)
-    geohash_bit_12 = db.Column(db.String(), nullable=False)
+    geohash = db.Column(db.String(), nullable=False)
+
+    __table_args__ = (
+        db.Index(
+            "idx_sensors_geohash",
+            "geohash",
+            postgresql_ops={"geohash": "text_pattern_ops"},
+        ),
+    )
 
     def __repr__(self) -> str:
         return f"<Sensor {self.id}: {self.latest_reading}>"
-
-    @property
-    def geohash(self) -> str:
-        return "".join([getattr(self, f"geohash_bit_{i}") for i in range(1, 13)])
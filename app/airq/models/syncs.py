@@ -0,0 +1,95 @@
+import enum
+import typing
+import uuid
+
+from flask_sqlalchemy import BaseQuery
+from sqlalchemy.dialects.postgresql import insert
+
+from airq.config import db
+
+
+@enum.unique
+class SyncType(enum.IntEnum):
+    PURPLEAIR = 1
+    PURPLEAIR_METADATA = 2
+    PURPLEAIR_SWEEP = 3
+    GEONAMES = 4
+    METRICS = 5
+    REGION_DISPATCHED = 6
+    REGION_COMPLETED = 7
+
+
+class SyncQuery(BaseQuery):
+    def get_generation(
+        self, type_code: SyncType, region: str = ""
+    ) -> typing.Optional[str]:
+        sync = self.get((type_code, region))
+        if sync:
+            return sync.generation
+        return None
+
+    def get_last_synced_at(self, type_code: SyncType, region: str = "") -> int:
+        sync = self.get((type_code, region))
+        if sync:
+            return sync.last_synced_at
+        return 0
+
+    def set_last_synced_at(
+        self, type_code: SyncType, last_synced_at: int, region: str = ""
+    ):
+        stmt = insert(Sync.__table__).values(
+            type_code=type_code,
+            region=region,
+            generation=uuid.uuid4().hex,
+            last_synced_at=last_synced_at,
+        )
+        stmt = stmt.on_conflict_do_update(
+            index_elements=["type_code", "region"],
+            set_={"last_synced_at": last_synced_at},
+        )
+        db.session.execute(stmt)
+        db.session.commit()
+
+    def reset_last_synced_at(self, type_code: SyncType):
+        """Forget when every region was last synced."""
+        self.filter_by(type_code=type_code).update(
+            {"last_synced_at": 0}, synchronize_session=False
+        )
+        db.session.commit()
+
+    def bump_generation(self, type_code: SyncType, region: str = "") -> str:
+        """Mark the tables written by this sync as changed.
+
+        Returns a new generation which local caches of those tables can be
+        validated against.
+        """
+        generation = uuid.uuid4().hex
+        stmt = insert(Sync.__table__).values(
+            type_code=type_code, region=region, generation=generation
+        )
+        stmt = stmt.on_conflict_do_update(
+            index_elements=["type_code", "region"], set_={"generation": generation}
+        )
+        db.session.execute(stmt)
+        db.session.commit()
+        return generation
+
+
+class Sync(db.Model):  # type: ignore
+    __tablename__ = "syncs"
+
+    query_class = SyncQuery
+
+    type_code = db.Column(db.Integer(), nullable=False, primary_key=True)
+
+    # Syncs which run separately for each region (see `PURPLEAIR_REGIONS`)
+    # are tracked separately. Everything else uses the empty string.
+    region = db.Column(db.String(), nullable=False, primary_key=True, server_default="")
+    generation = db.Column(db.String(), nullable=False)
+
+    # Timestamp of the upstream data most recently synced, according to the
+    # upstream's clock. Syncs of our own data use our clock.
+    last_synced_at = db.Column(db.Integer(), nullable=False, server_default="0")
+
+    def __repr__(self) -> str:
+        return f"<Sync {self.type_code}: {self.generation}>"
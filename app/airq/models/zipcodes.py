@@ -1,23 +1,37 @@
 import dataclasses
+import geohash
 import typing
 
 from flask_sqlalchemy import BaseQuery
-from sqlalchemy import func
+from sqlalchemy import or_
+from sqlalchemy import text
+from sqlalchemy.dialects import postgresql
 from geoalchemy2 import Geometry
 
 from airq.lib.clock import timestamp
 from airq.lib.geo import haversine_distance
+from airq.lib.metrics import DESIRED_NUM_READINGS
+from airq.lib.metrics import DESIRED_READING_DISTANCE_KM
+from airq.lib.metrics import SENSOR_FRESHNESS_SECONDS
 from airq.lib.readings import ConversionFactor
 from airq.lib.readings import Pm25
 from airq.lib.readings import Readings
+from airq.lib.spatial import SpatialIndex
 from airq.config import db
+from airq.models.syncs import Sync
+from airq.models.syncs import SyncType
+
+
+# Built once per process, and rebuilt when the zipcodes change.
+_spatial_index: typing.Optional[SpatialIndex] = None
+_spatial_index_generation: typing.Optional[str] = None
 
 
 @dataclasses.dataclass
 class ZipcodeMetrics:
     num_sensors: int
-    min_sensor_distance: int
-    max_sensor_distance: int
+    min_sensor_distance: float
+    max_sensor_distance: float
     sensor_ids: typing.List[int]
 
 
@@ -25,11 +39,226 @@ class ZipcodeQuery(BaseQuery):
     def get_by_zipcode(self, zipcode: str) -> typing.Optional["Zipcode"]:
         return self.filter_by(zipcode=zipcode).first()
 
-    def order_by_distance(self, zipcode: "Zipcode") -> "ZipcodeQuery":
-        return self.order_by(
-            func.ST_DistanceSphere(Zipcode.coordinates, zipcode.coordinates)
+    def get_spatial_index(self) -> SpatialIndex:
+        """An index of the locations of all zipcodes, keyed by id."""
+        global _spatial_index, _spatial_index_generation
+
+        generation = Sync.query.get_generation(SyncType.GEONAMES)
+        if (
+            _spatial_index is None
+            or generation is None
+            or generation != _spatial_index_generation
+        ):
+            if generation is None:
+                generation = Sync.query.bump_generation(SyncType.GEONAMES)
+            rows = Zipcode.query.with_entities(
+                Zipcode.id, Zipcode.latitude, Zipcode.longitude
+            ).all()
+            _spatial_index = SpatialIndex(
+                [row[0] for row in rows],
+                [float(row[1]) for row in rows],
+                [float(row[2]) for row in rows],
+            )
+            _spatial_index_generation = generation
+        return _spatial_index
+
+    def filter_by_geohash_prefix(self, prefix: str) -> "ZipcodeQuery":
+        """Zipcodes within the geohash cell `prefix`."""
+        return self.filter(Zipcode.geohash.like(f"{prefix}%"))
+
+    def filter_by_geohash_neighbors(self, prefix: str) -> "ZipcodeQuery":
+        """Zipcodes within the geohash cell `prefix` or the eight around it."""
+        return self.filter(
+            or_(*(Zipcode.geohash.like(f"{cell}%") for cell in geohash.expand(prefix)))
         )
 
+    def update_metrics(
+        self,
+        updated_since: float,
+        updated_at: int,
+        desired_num_readings: int,
+        desired_reading_distance_km: float,
+        zipcode_ids: typing.Optional[typing.List[int]] = None,
+    ) -> int:
+        """Recompute the readings of each zipcode from its nearby sensors.
+
+        Only sensors updated after `updated_since` are used. Each zipcode
+        averages its `desired_num_readings` closest sensors, plus any others
+        within `desired_reading_distance_km`. Zipcodes without any such
+        sensors are left alone, as are zipcodes not in `zipcode_ids` if it's
+        given.
+
+        Like `bulk_update`, only zipcodes whose readings changed are
+        rewritten in full; the rest just get the new timestamps. Does not
+        commit. Returns the number of zipcodes whose
+        readings changed.
+        """
+        zipcodes_filter = ""
+        if zipcode_ids is not None:
+            zipcodes_filter = "AND sensors_zipcodes.zipcode_id = ANY(:zipcode_ids)"
+        result = db.session.execute(
+            text(
+                """
+                WITH metrics AS (
+                    SELECT
+                        zipcode_id,
+                        round(avg(latest_reading)::numeric, 3)::float AS pm25,
+                        round(avg(humidity)::numeric, 3)::float AS humidity,
+                        round(avg(pm_cf_1)::numeric, 3)::float AS pm_cf_1,
+                        count(*) AS num_sensors,
+                        round(min(distance)::numeric, 3)::float AS min_sensor_distance,
+                        round(max(distance)::numeric, 3)::float AS max_sensor_distance,
+                        array_agg(sensor_id ORDER BY distance, sensor_id) AS sensor_ids
+                    FROM (
+                        SELECT
+                            sensors_zipcodes.zipcode_id,
+                            sensors_zipcodes.sensor_id,
+                            sensors_zipcodes.distance,
+                            sensors.latest_reading,
+                            sensors.humidity,
+                            sensors.pm_cf_1,
+                            row_number() OVER (
+                                PARTITION BY sensors_zipcodes.zipcode_id
+                                ORDER BY
+                                    sensors_zipcodes.distance,
+                                    sensors_zipcodes.sensor_id
+                            ) AS rank
+                        FROM sensors_zipcodes
+                        JOIN sensors ON sensors.id = sensors_zipcodes.sensor_id
+                        WHERE sensors.updated_at > :updated_since
+                        {zipcodes_filter}
+                    ) AS ranked
+                    WHERE
+                        rank <= :desired_num_readings
+                        OR distance < :desired_reading_distance_km
+                    GROUP BY zipcode_id
+                ),
+                changed AS (
+                    UPDATE zipcodes
+                    SET
+                        pm25 = metrics.pm25,
+                        humidity = metrics.humidity,
+                        pm_cf_1 = metrics.pm_cf_1,
+                        pm25_updated_at = :updated_at,
+                        num_sensors = metrics.num_sensors,
+                        min_sensor_distance = metrics.min_sensor_distance,
+                        max_sensor_distance = metrics.max_sensor_distance,
+                        sensor_ids = metrics.sensor_ids,
+                        metrics_checked_at = :updated_at
+                    FROM metrics
+                    WHERE
+                        zipcodes.id = metrics.zipcode_id
+                        AND (
+                            zipcodes.pm25,
+                            zipcodes.humidity,
+                            zipcodes.pm_cf_1,
+                            zipcodes.num_sensors,
+                            zipcodes.min_sensor_distance,
+                            zipcodes.max_sensor_distance,
+                            zipcodes.sensor_ids
+                        ) IS DISTINCT FROM (
+                            metrics.pm25,
+                            metrics.humidity,
+                            metrics.pm_cf_1,
+                            metrics.num_sensors,
+                            metrics.min_sensor_distance,
+                            metrics.max_sensor_distance,
+                            metrics.sensor_ids
+                        )
+                    RETURNING zipcodes.id
+                ),
+                -- Both updates see the same snapshot, so the zipcodes updated
+                -- above have to be left out here.
+                touched AS (
+                    UPDATE zipcodes
+                    SET
+                        pm25_updated_at = :updated_at,
+                        metrics_checked_at = :updated_at
+                    FROM metrics
+                    WHERE
+                        zipcodes.id = metrics.zipcode_id
+                        AND zipcodes.id NOT IN (SELECT id FROM changed)
+                )
+                SELECT count(*) FROM changed
+                """.format(
+                    zipcodes_filter=zipcodes_filter
+                )
+            ),
+            {
+                "zipcode_ids": zipcode_ids,
+                "updated_since": updated_since,
+                "updated_at": updated_at,
+                "desired_num_readings": desired_num_readings,
+                "desired_reading_distance_km": desired_reading_distance_km,
+            },
+        )
+        return result.scalar()
+
+    def refresh_metrics(self, zipcode_ids: typing.List[int]) -> int:
+        """Recompute the given zipcodes if their sensors changed since last time.
+
+        With `HAZEBOT_LAZY_METRICS_ENABLED`, syncs only keep zipcodes in
+        demand up to date, and the rest are refreshed when someone asks about
+        them. A zipcode is only recomputed if one of its sensors has reported,
+        or has gone stale, since its metrics were last checked. Commits.
+        Returns the number of zipcodes recomputed.
+        """
+        if not zipcode_ids:
+            return 0
+
+        checked_at = timestamp()
+        updated_since = checked_at - SENSOR_FRESHNESS_SECONDS
+        # A reading stored after the check, but reported before it, is picked
+        # up along with the next reading from any of the zipcode's sensors.
+        result = db.session.execute(
+            text(
+                """
+                SELECT zipcodes.id
+                FROM zipcodes
+                WHERE
+                    zipcodes.id = ANY(:zipcode_ids)
+                    AND EXISTS (
+                        SELECT 1
+                        FROM sensors_zipcodes
+                        JOIN sensors ON sensors.id = sensors_zipcodes.sensor_id
+                        WHERE
+                            sensors_zipcodes.zipcode_id = zipcodes.id
+                            AND (
+                                sensors.updated_at > zipcodes.metrics_checked_at
+                                OR (
+                                    sensors.updated_at
+                                        > zipcodes.metrics_checked_at - :freshness_seconds
+                                    AND sensors.updated_at <= :updated_since
+                                )
+                            )
+                    )
+                """
+            ),
+            {
+                "zipcode_ids": zipcode_ids,
+                "freshness_seconds": SENSOR_FRESHNESS_SECONDS,
+                "updated_since": updated_since,
+            },
+        )
+        outdated_zipcode_ids = [row[0] for row in result]
+        if not outdated_zipcode_ids:
+            return 0
+
+        self.update_metrics(
+            updated_since=updated_since,
+            updated_at=checked_at,
+            desired_num_readings=DESIRED_NUM_READINGS,
+            desired_reading_distance_km=DESIRED_READING_DISTANCE_KM,
+            zipcode_ids=outdated_zipcode_ids,
+        )
+        # Zipcodes without any fresh sensors aren't updated above, but there's
+        # no point checking them again until their sensors change.
+        Zipcode.query.filter(Zipcode.id.in_(outdated_zipcode_ids)).update(
+            {Zipcode.metrics_checked_at: checked_at}, synchronize_session=False
+        )
+        db.session.commit()
+        return len(outdated_zipcode_ids)
+
 
 class Zipcode(db.Model):  # type: ignore
     __tablename__ = "zipcodes"
@@ -42,19 +271,7 @@ class Zipcode(db.Model):  # type: ignore
     latitude = db.Column(db.Float(asdecimal=True), nullable=False)
     longitude = db.Column(db.Float(asdecimal=True), nullable=False)
     timezone = db.Column(db.String(), nullable=True)
-
-    geohash_bit_1 = db.Column(db.String(), nullable=False)
-    geohash_bit_2 = db.Column(db.String(), nullable=False)
-    geohash_bit_3 = db.Column(db.String(), nullable=False)
-    geohash_bit_4 = db.Column(db.String(), nullable=False)
-    geohash_bit_5 = db.Column(db.String(), nullable=False)
-    geohash_bit_6 = db.Column(db.String(), nullable=False)
-    geohash_bit_7 = db.Column(db.String(), nullable=False)
-    geohash_bit_8 = db.Column(db.String(), nullable=False)
-    geohash_bit_9 = db.Column(db.String(), nullable=False)
-    geohash_bit_10 = db.Column(db.String(), nullable=False)
-    geohash_bit_11 = db.Column(db.String(), nullable=False)
-    geohash_bit_12 = db.Column(db.String(), nullable=False)
+    geohash = db.Column(db.String(), nullable=False)
     coordinates = db.Column(Geometry("POINT"), nullable=True)
 
     pm25 = db.Column(db.Float(), nullable=False, index=True, server_default="0")
@@ -64,10 +281,30 @@ class Zipcode(db.Model):  # type: ignore
         db.Integer(), nullable=False, index=True, server_default="0"
     )
 
-    metrics_data = db.Column(db.JSON(), nullable=True)
+    num_sensors = db.Column(
+        db.Integer(), nullable=False, index=True, server_default="0"
+    )
+    min_sensor_distance = db.Column(db.Float(), nullable=False, server_default="0")
+    max_sensor_distance = db.Column(db.Float(), nullable=False, server_default="0")
+    sensor_ids = db.Column(
+        postgresql.ARRAY(db.Integer()), nullable=False, server_default="{}"
+    )
+
+    # When the metrics above were last brought up to date. With
+    # `HAZEBOT_LAZY_METRICS_ENABLED`, zipcodes whose sensors haven't changed
+    # since aren't recomputed when someone asks about them.
+    metrics_checked_at = db.Column(db.Integer(), nullable=False, server_default="0")
 
     city = db.relationship("City")
 
+    __table_args__ = (
+        db.Index(
+            "idx_zipcodes_geohash",
+            "geohash",
+            postgresql_ops={"geohash": "text_pattern_ops"},
+        ),
+    )
+
     def __repr__(self) -> str:
         return f"<Zipcode {self.zipcode}>"
 
@@ -77,35 +314,16 @@ class Zipcode(db.Model):  # type: ignore
         return obj
 
     def get_metrics(self) -> ZipcodeMetrics:
-        if not hasattr(self, "_metrics"):
-            self._metrics = ZipcodeMetrics(
-                num_sensors=self.metrics_data["num_sensors"],
-                max_sensor_distance=self.metrics_data["max_sensor_distance"],
-                min_sensor_distance=self.metrics_data["min_sensor_distance"],
-                sensor_ids=self.metrics_data["sensor_ids"],
-            )
-        return self._metrics
+        return ZipcodeMetrics(
+            num_sensors=self.num_sensors,
+            max_sensor_distance=self.max_sensor_distance,
+            min_sensor_distance=self.min_sensor_distance,
+            sensor_ids=self.sensor_ids,
+        )
 
     def get_readings(self) -> Readings:
         return Readings(pm25=self.pm25, pm_cf_1=self.pm_cf_1, humidity=self.humidity)
 
-    @property
-    def num_sensors(self) -> int:
-        return self.get_metrics().num_sensors
-
-    @property
-    def max_sensor_distance(self) -> int:
-        return self.get_metrics().max_sensor_distance
-
-    @property
-    def min_sensor_distance(self) -> int:
-        return self.get_metrics().min_sensor_distance
-
-    @property
-    def geohash(self) -> str:
-        """This zipcode's geohash."""
-        return "".join([getattr(self, f"geohash_bit_{i}") for i in range(1, 13)])
-
     @classmethod
     def pm25_stale_cutoff(cls) -> float:
         """Timestamp before which pm25 measurements are considered stale."""
@@ -143,22 +361,51 @@ class Zipcode(db.Model):  # type: ignore
         return self.get_readings().get_pm25_level(conversion_factor)
 
     def get_recommendations(
-        self, num_desired: int, conversion_factor: ConversionFactor
+        self,
+        num_desired: int,
+        conversion_factor: ConversionFactor,
+        refresh_metrics: bool = False,
     ) -> typing.List["Zipcode"]:
-        """Get n recommended zipcodes near this zipcode, sorted by distance."""
+        """Get n recommended zipcodes near this zipcode, sorted by distance.
+
+        With `refresh_metrics`, candidates are refreshed before they're
+        considered, for when syncs don't keep every zipcode up to date.
+        """
         if self.is_pm25_stale:
             return []
 
         cutoff = self.pm25_stale_cutoff()
-
-        # TODO: Make this faster somehow?
         curr_pm25_level = self.get_pm25_level(conversion_factor)
-        zipcodes = [
-            z
-            for z in Zipcode.query.filter(
-                Zipcode.pm25_updated_at > cutoff
-            ).order_by_distance(self)
-            if z.get_pm25_level(conversion_factor) < curr_pm25_level
-        ]
-
-        return zipcodes[:num_desired]
+        index = Zipcode.query.get_spatial_index()
+
+        # Look at ever larger sets of nearby zipcodes until we find enough.
+        recommendations: typing.List[Zipcode] = []
+        num_seen = 0
+        k = max(num_desired * 10, 50)
+        while True:
+            zipcode_ids, _ = index.k_nearest(
+                float(self.latitude), float(self.longitude), k
+            )
+            candidate_ids = zipcode_ids[num_seen:].tolist()
+            if refresh_metrics:
+                Zipcode.query.refresh_metrics(candidate_ids)
+            zipcodes_by_id = {
+                z.id: z
+                for z in Zipcode.query.filter(Zipcode.id.in_(candidate_ids)).filter(
+                    Zipcode.pm25_updated_at > cutoff
+                )
+            }
+            for zipcode_id in candidate_ids:
+                zipcode = zipcodes_by_id.get(zipcode_id)
+                if (
+                    zipcode
+                    and zipcode.get_pm25_level(conversion_factor) < curr_pm25_level
+                ):
+                    recommendations.append(zipcode)
+                    if len(recommendations) == num_desired:
+                        return recommendations
+            if len(zipcode_ids) < k:
+                # There are no more zipcodes.
+                return recommendations
+            num_seen = len(zipcode_ids)
+            k *= 4
@@ -7,7 +7,9 @@ from airq.config import app
 from airq.models.sensors import Sensor
 from airq.models.zipcodes import Zipcode
 from airq.sync.geonames import geonames_sync
+from airq.sync.purpleair import dispatch_region_syncs
 from airq.sync.purpleair import purpleair_sync
+from airq.sync.relations import rebuild_relations
 
 
 logger = logging.getLogger(__name__)
@@ -34,6 +36,10 @@ def models_sync(
     start_ts = time.perf_counter()
     updated = False
 
+    # Asking for the geography to be rebuilt (e.g., `flask sync --geography`)
+    # also rebuilds every relation, even if no zipcodes changed.
+    should_rebuild_relations = bool(force_rebuild_geography)
+
     num_zipcodes = Zipcode.query.count()
     if only_if_empty or num_zipcodes == 0:
         force_rebuild_geography = num_zipcodes == 0
@@ -42,11 +48,19 @@ def models_sync(
 
     if force_rebuild_geography:
         updated = True
-        geonames_sync()
+        if geonames_sync() or should_rebuild_relations:
+            # Sensors near new or moved zipcodes need new relations. Do this
+            # before syncing purpleair so that metrics use them right away.
+            rebuild_relations()
 
     if not only_if_empty or Sensor.query.count() == 0:
         updated = True
-        purpleair_sync()
+        if app.config["HAZEBOT_REGION_SYNC_ENABLED"]:
+            # Each region is synced by its own task, on whichever worker
+            # picks it up.
+            dispatch_region_syncs()
+        else:
+            purpleair_sync()
 
     duration = time.perf_counter() - start_ts
     if duration > 60 * 5:
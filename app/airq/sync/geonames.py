@@ -10,6 +10,8 @@ from airq.config import db
 from airq.lib.http import chunked_download
 from airq.lib.util import chunk_list
 from airq.models.cities import City
+from airq.models.syncs import Sync
+from airq.models.syncs import SyncType
 from airq.models.zipcodes import Zipcode
 
 
@@ -104,13 +106,17 @@ def _zipcodes_sync(
     geonames_data: TGeonamesData,
     cities_map: TCitiesMap,
     timezones_map: typing.Dict[str, str],
-):
+) -> bool:
+    """Sync zipcodes. Returns whether any zipcodes were added or moved."""
     existing_zipcodes = {zipcode.zipcode: zipcode for zipcode in Zipcode.query.all()}
     updates = []
     new_zipcodes = []
+    has_moved_zipcodes = False
     for zipcode, city_name, state_code, latitude, longitude in geonames_data:
         obj = existing_zipcodes.get(zipcode)
         timezone = timezones_map.get(zipcode)
+        if obj and (obj.latitude != latitude or obj.longitude != longitude):
+            has_moved_zipcodes = True
         if (
             not obj
             or obj.latitude != latitude
@@ -118,7 +124,6 @@ def _zipcodes_sync(
             or timezone != obj.timezone
             or obj.coordinates is None
         ):
-            gh = geohash.encode(latitude, longitude)
             data = dict(
                 zipcode=zipcode,
                 city_id=cities_map[state_code][city_name].id,
@@ -126,7 +131,7 @@ def _zipcodes_sync(
                 longitude=longitude,
                 timezone=timezone,
                 coordinates=f"POINT({longitude} {latitude})",
-                **{f"geohash_bit_{i}": c for i, c in enumerate(gh, start=1)},
+                geohash=geohash.encode(latitude, longitude),
             )
             if obj:
                 data["id"] = obj.id
@@ -146,10 +151,17 @@ def _zipcodes_sync(
             db.session.bulk_update_mappings(Zipcode, mappings)
             db.session.commit()
 
+    if new_zipcodes or updates:
+        # Invalidate any spatial indexes built from the old zipcodes.
+        Sync.query.bump_generation(SyncType.GEONAMES)
+
     # TODO: Should we delete zipcodes not in the GeoNames data?
 
+    return bool(new_zipcodes) or has_moved_zipcodes
+
 
-def geonames_sync():
+def geonames_sync() -> bool:
+    """Sync cities and zipcodes. Returns whether any zipcodes were added or moved."""
     logger.info("Retrieving timezone data from sourceforge")
     timezones_map = _get_timezones_data()
 
@@ -160,4 +172,4 @@ def geonames_sync():
     cities_map = _build_cities_map(geonames_data)
 
     logger.info("Syncing zipcodes from %s entries", len(geonames_data))
-    _zipcodes_sync(geonames_data, cities_map, timezones_map)
+    return _zipcodes_sync(geonames_data, cities_map, timezones_map)
@@ -1,8 +1,8 @@
-import collections
 import geohash
 import json
 import logging
-import math
+import numpy as np
+import os
 import requests
 import typing
 
@@ -13,33 +13,219 @@ from airq.config import app
 from airq.config import db
 from airq.lib.clock import now
 from airq.lib.clock import timestamp
-from airq.lib.geo import haversine_distance
-from airq.lib.purpleair import call_purpleair_sensors_api
-from airq.lib.trie import Trie
+from airq.lib.alerts import ALERT_CANDIDATES_DTYPE
+from airq.lib.alerts import CONVERSION_FACTORS
+from airq.lib.alerts import get_alerts
+from airq.lib.alerts import ZIPCODE_READINGS_DTYPE
+from airq.lib.client_preferences import ClientPreferencesRegistry
+from airq.lib.geo import BoundingBox
+from airq.lib.geo import get_covering_bounding_boxes
+from airq.lib.metrics import compute_zipcode_metrics_in_processes
+from airq.lib.metrics import DESIRED_NUM_READINGS
+from airq.lib.metrics import DESIRED_READING_DISTANCE_KM
+from airq.lib.metrics import SENSOR_FRESHNESS_SECONDS
+from airq.lib.parallel import get_num_processes
+from airq.lib.postgres import bulk_update
+from airq.lib.postgres import bulk_upsert
+from airq.lib.purpleair import get_purpleair_sensors
+from airq.lib.purpleair import get_purpleair_sensors_sharded
+from airq.lib.purpleair import PURPLEAIR_READINGS_FIELDS
+from airq.lib.purpleair import PURPLEAIR_REGIONS
+from airq.lib.purpleair import PURPLEAIR_SENSORS_FIELDS
+from airq.lib.purpleair import PURPLEAIR_SHARDS
+from airq.lib.purpleair import SensorsBatch
+from airq.lib.readings import Pm25
+from airq.lib.snapshot import SENSORS_SNAPSHOT_DTYPE
+from airq.lib.snapshot import SensorsSnapshot
 from airq.lib.util import chunk_list
 from airq.models.clients import Client
+from airq.models.clients import ClientQuery
 from airq.models.relations import SensorZipcodeRelation
 from airq.models.sensors import Sensor
+from airq.models.syncs import Sync
+from airq.models.syncs import SyncType
 from airq.models.zipcodes import Zipcode
-
-
-# Try to get at least 8 readings per zipcode.
-DESIRED_NUM_READINGS = 8
-
-# Allow any number of readings within 2.5km from the zipcode centroid.
-DESIRED_READING_DISTANCE_KM = 2.5
-
-
-def _get_purpleair_sensors_data() -> typing.List[typing.Dict[str, typing.Any]]:
+from airq.sync.relations import MAX_RELATION_DISTANCE_KM
+from airq.sync.relations import rebuild_relations_for_sensors
+
+
+# Sensors which haven't reported in this long are out of date / maybe dead.
+SENSOR_MAX_AGE_SECONDS = 60 * 60
+
+# Zipcodes whose sensors haven't changed are still recomputed this often, so
+# that they don't look stale (see `Zipcode.pm25_stale_cutoff`).
+ZIPCODE_REFRESH_SECONDS = 40 * 60
+
+# Sensor locations rarely change, so we only pull them this often. Syncs in
+# between only pull readings.
+METADATA_SYNC_INTERVAL_SECONDS = 60 * 60
+
+# Syncs in between full sweeps only pull sensors near zipcodes which clients
+# need readings for, so sweeps keep the rest of the country reasonably fresh.
+#
+# Sweeps run on the first sync after this interval has passed, and syncs run
+# every ten minutes, so this sweeps every 20 minutes. Keeping it to half of
+# the freshness window means a sweep which is late or fails still leaves
+# time to refresh sensors before they drop out of the zipcode metrics.
+SWEEP_INTERVAL_SECONDS = 15 * 60
+
+# Clients active this recently need readings even if they aren't subscribed.
+DEMAND_ACTIVITY_WINDOW_SECONDS = 24 * 60 * 60
+
+# If demand is spread across more boxes than this, sweep instead.
+MAX_DEMAND_BOUNDING_BOXES = 64
+
+
+# Columns written by `_sensors_sync`, in the order of `SENSORS_SNAPSHOT_DTYPE`
+# followed by the sensor's geohash.
+_SENSOR_COLUMNS = [
+    "id",
+    "latitude",
+    "longitude",
+    "latest_reading",
+    "humidity",
+    "pm_cf_1",
+    "updated_at",
+    "geohash",
+]
+
+# Columns written by `_sensors_sync` when we only have readings.
+_READINGS_COLUMNS = ["id", "latest_reading", "humidity", "pm_cf_1", "updated_at"]
+
+# Columns written by `_update_metrics_with_numpy`, in the order of
+# `ZIPCODE_METRICS_DTYPE` followed by the zipcode's sensor ids.
+_METRICS_COLUMNS = [
+    "id",
+    "pm25",
+    "humidity",
+    "pm_cf_1",
+    "num_sensors",
+    "min_sensor_distance",
+    "max_sensor_distance",
+    "sensor_ids",
+]
+
+# Region syncs which haven't finished after this long are assumed to be stuck.
+REGION_SYNC_TIMEOUT_SECONDS = 20 * 60
+
+# Zipcodes with clients subscribed to alerts are recomputed in batches of this
+# many, so that their alerts don't wait on the rest of the country.
+SUBSCRIBED_ZIPCODES_BATCH_SIZE = 1000
+
+# Cached between runs so that we only need to load the snapshots from
+# disk when the worker starts. Keyed by region.
+_sensors_snapshots: typing.Dict[str, SensorsSnapshot] = {}
+
+
+def _get_region_bounding_box(region: str) -> typing.Optional[BoundingBox]:
+    if not region:
+        return None
+    return PURPLEAIR_REGIONS[region]
+
+
+def _get_modified_since(
+    type_code: SyncType = SyncType.PURPLEAIR, region: str = ""
+) -> typing.Optional[int]:
+    if not app.config["HAZEBOT_INCREMENTAL_SYNC_ENABLED"]:
+        return None
+    # If the last sync is older than the max age we need every sensor anyway,
+    # since sensors it didn't cover may have gone stale in the meantime.
+    last_synced_at = Sync.query.get_last_synced_at(type_code, region)
+    if last_synced_at < timestamp() - SENSOR_MAX_AGE_SECONDS:
+        return None
+    return last_synced_at
+
+
+def _should_sync_metadata(snapshot: SensorsSnapshot, region: str = "") -> bool:
+    if not len(snapshot):
+        return True
+    last_synced_at = Sync.query.get_last_synced_at(SyncType.PURPLEAIR_METADATA, region)
+    return last_synced_at < timestamp() - METADATA_SYNC_INTERVAL_SECONDS
+
+
+def _should_sweep(region: str = "") -> bool:
+    if not app.config["HAZEBOT_DEMAND_DRIVEN_SYNC_ENABLED"]:
+        return True
+    last_synced_at = Sync.query.get_last_synced_at(SyncType.PURPLEAIR_SWEEP, region)
+    return last_synced_at < timestamp() - SWEEP_INTERVAL_SECONDS
+
+
+def _get_demand_bounding_boxes(region: str = "") -> typing.List[BoundingBox]:
+    """Bounding boxes covering every sensor related to a zipcode in demand.
+
+    If a region is given, only covers the part of those sensors in it.
+    """
+    zipcode_ids = Client.query.filter_in_demand(
+        timestamp() - DEMAND_ACTIVITY_WINDOW_SECONDS
+    ).with_entities(Client.zipcode_id)
+    bounding_boxes = get_covering_bounding_boxes(
+        (
+            (float(latitude), float(longitude))
+            for latitude, longitude in Zipcode.query.filter(Zipcode.id.in_(zipcode_ids))
+            .with_entities(Zipcode.latitude, Zipcode.longitude)
+            .all()
+        ),
+        MAX_RELATION_DISTANCE_KM,
+    )
+    region_bounding_box = _get_region_bounding_box(region)
+    if region_bounding_box is None:
+        return bounding_boxes
+    # Zipcodes near the edge of the region can have sensors in it.
+    return [
+        box
+        for box in (b.intersection(region_bounding_box) for b in bounding_boxes)
+        if box is not None
+    ]
+
+
+def _get_purpleair_sensors_data(
+    sync_metadata: bool, sweep: bool, region: str = ""
+) -> SensorsBatch:
     logger = get_celery_logger()
+    # None means every sensor (in the region, if any)
+    bounding_boxes: typing.Optional[typing.List[BoundingBox]] = None
+    if sync_metadata:
+        # Pull every sensor so that the metadata sync also picks up anything
+        # the readings syncs since the last one might have missed.
+        fields = PURPLEAIR_SENSORS_FIELDS
+        modified_since = None
+    elif sweep:
+        fields = PURPLEAIR_READINGS_FIELDS
+        modified_since = _get_modified_since(SyncType.PURPLEAIR_SWEEP, region)
+    else:
+        fields = PURPLEAIR_READINGS_FIELDS
+        modified_since = _get_modified_since(region=region)
+        bounding_boxes = _get_demand_bounding_boxes(region)
+        logger.info("Found %s regions in demand", len(bounding_boxes))
+        if len(bounding_boxes) > MAX_DEMAND_BOUNDING_BOXES:
+            # Fetching every sensor in bigger pieces is cheaper than this.
+            bounding_boxes = None
+
+    region_bounding_box = _get_region_bounding_box(region)
+    if bounding_boxes is None and region_bounding_box is not None:
+        bounding_boxes = [region_bounding_box]
+    elif bounding_boxes is None and app.config["HAZEBOT_SHARDED_FETCH_ENABLED"]:
+        bounding_boxes = PURPLEAIR_SHARDS
+
     try:
-        response_dict = call_purpleair_sensors_api().json()
+        # Sensors not in the response keep whatever readings we already have.
+        if bounding_boxes is not None:
+            return get_purpleair_sensors_sharded(
+                bounding_boxes,
+                modified_since=modified_since,
+                max_age=SENSOR_MAX_AGE_SECONDS,
+                fields=fields,
+            )
+        return get_purpleair_sensors(
+            modified_since=modified_since,
+            max_age=SENSOR_MAX_AGE_SECONDS,
+            fields=fields,
+        )
     except (requests.RequestException, json.JSONDecodeError) as e:
-        # Send an email to an admin if data lags by more than 30 minutes.
-        # Otherwise, just log a warning as most of these errors are
-        # transient. In the future we might choose to retry on transient
-        # failures, but it's not urgent since we will rerun the sync
-        # every ten minutes anyway.
+        # The client has already retried transient failures, so this one
+        # outlasted them (in every shard, if sharding). Send an email to an
+        # admin if data lags by more than 30 minutes. Otherwise, just log a
+        # warning since we will rerun the sync in ten minutes anyway.
         last_updated_at = Sensor.query.get_last_updated_at()
         seconds_since_last_update = timestamp() - last_updated_at
         if seconds_since_last_update > 30 * 60:
@@ -53,264 +239,444 @@ def _get_purpleair_sensors_data() -> typing.List[typing.Dict[str, typing.Any]]:
             e,
             exc_info=True,
         )
-        return []
-    else:
-        fields = response_dict["fields"]
-        channel_flags = response_dict["channel_flags"]
-        data = []
-        for sensor_data in response_dict["data"]:
-            sensor_data = dict(zip(fields, sensor_data))
-            try:
-                sensor_data["channel_flags"] = channel_flags[
-                    sensor_data["channel_flags"]
-                ]
-            except KeyError:
-                pass
-            # Rename `pm2.5_cf_1`
-            sensor_data["pm_cf_1"] = sensor_data.pop("pm2.5_cf_1")
-            data.append(sensor_data)
-        return data
-
-
-def _is_valid_reading(sensor_data: typing.Dict[str, typing.Any]) -> bool:
-    if sensor_data["last_seen"] < timestamp() - (60 * 60):
-        # Out of date / maybe dead
-        return False
-    if sensor_data["channel_flags"] != "Normal":
-        # Flagged for an unusually high reading
-        return False
-    try:
-        pm25 = float(sensor_data["pm2.5"])
-    except (TypeError, ValueError):
-        return False
-    if math.isnan(pm25):
-        # Purpleair can occasionally return NaN.
-        # I wonder if this is a bug on their end.
-        return False
-    if pm25 <= 0 or pm25 > 1000:
-        # Something is very wrong
-        return False
-    try:
-        humidity = float(sensor_data["humidity"])
-    except (TypeError, ValueError):
-        return False
-    if math.isnan(humidity):
-        return False
-    latitude = sensor_data["latitude"]
-    longitude = sensor_data["longitude"]
-    if latitude is None or longitude is None:
-        return False
-
-    return True
+        return SensorsBatch.empty()
 
 
-def _sensors_sync(
-    purpleair_data: typing.List[typing.Dict[str, typing.Any]],
-) -> typing.List[int]:
+def _filter_valid_sensors(purpleair_data: SensorsBatch) -> SensorsBatch:
     logger = get_celery_logger()
 
-    existing_sensor_map = {s.id: s for s in Sensor.query.all()}
-
-    updates = []
-    new_sensors = []
-    moved_sensor_ids = []
-    for result in purpleair_data:
-        if _is_valid_reading(result):
-            sensor = existing_sensor_map.get(result["sensor_index"])
-            latitude = result["latitude"]
-            longitude = result["longitude"]
-            pm25 = float(result["pm2.5"])
-            humidity = float(result["humidity"])
-            pm_cf_1 = float(result["pm_cf_1"])
-
-            data: typing.Dict[str, typing.Any] = {
-                "id": result["sensor_index"],
-                "latest_reading": pm25,
-                "humidity": humidity,
-                "updated_at": result["last_seen"],
-                "pm_cf_1": pm_cf_1,
-            }
-
-            if (
-                not sensor
-                or sensor.latitude != latitude
-                or sensor.longitude != longitude
-            ):
-                gh = geohash.encode(latitude, longitude)
-                data.update(
-                    latitude=latitude,
-                    longitude=longitude,
-                    **{f"geohash_bit_{i}": c for i, c in enumerate(gh, start=1)},
-                )
-                moved_sensor_ids.append(result["sensor_index"])
-
-            if sensor:
-                updates.append(data)
-            else:
-                new_sensors.append(Sensor(**data))
-
-    if new_sensors:
-        logger.info("Creating %s sensors", len(new_sensors))
-        db.session.bulk_save_objects(new_sensors)
-        db.session.commit()
+    last_seen = purpleair_data["last_seen"]
+    pm25 = purpleair_data["pm25"]
+    pm_cf_1 = purpleair_data["pm_cf_1"]
+    humidity = purpleair_data["humidity"]
+
+    # Comparisons against NaN are always false, so each check is written
+    # such that a missing value is rejected.
+    with np.errstate(invalid="ignore"):
+        checks = [
+            # Out of date / maybe dead
+            ("stale", ~(last_seen >= timestamp() - SENSOR_MAX_AGE_SECONDS)),
+            # Flagged for an unusually high reading
+            ("flagged", purpleair_data["channel_flags"] != "Normal"),
+            # Purpleair can occasionally return NaN, and anything outside
+            # of this range means something is very wrong.
+            ("invalid_pm25", ~((pm25 > 0) & (pm25 <= 1000))),
+            ("invalid_pm_cf_1", np.isnan(pm_cf_1)),
+            ("invalid_humidity", np.isnan(humidity)),
+        ]
+        if "latitude" in purpleair_data:
+            # Readings-only batches rely on the locations we already have.
+            latitude = purpleair_data["latitude"]
+            longitude = purpleair_data["longitude"]
+            checks.append(
+                ("missing_coordinates", np.isnan(latitude) | np.isnan(longitude))
+            )
 
-    if updates:
-        logger.info("Updating %s sensors", len(updates))
-        db.session.bulk_update_mappings(Sensor, updates)
-        db.session.commit()
+    # Attribute each rejected sensor to the first check it fails.
+    is_valid = np.ones(len(purpleair_data), dtype=bool)
+    rejections = []
+    for reason, is_rejected in checks:
+        rejections.append((reason, np.count_nonzero(is_valid & is_rejected)))
+        is_valid &= ~is_rejected
 
-    return moved_sensor_ids
+    logger.info(
+        "Rejected %s of %s sensors (%s)",
+        len(purpleair_data) - np.count_nonzero(is_valid),
+        len(purpleair_data),
+        ", ".join(f"{reason}: {count}" for reason, count in rejections),
+    )
 
+    return purpleair_data.take(is_valid)
 
-def _relations_sync(moved_sensor_ids: typing.List[int]):
+
+def _get_snapshot_dir(region: str) -> str:
+    return os.path.join(app.config["HAZEBOT_SNAPSHOT_DIR"], region)
+
+
+def _get_sensors_snapshot(region: str = "") -> SensorsSnapshot:
     logger = get_celery_logger()
+    generation = Sync.query.get_generation(SyncType.PURPLEAIR, region)
+    snapshot = _sensors_snapshots.get(region)
+    if snapshot is None or snapshot.generation != generation:
+        snapshot = SensorsSnapshot.load(_get_snapshot_dir(region))
+
+    if generation is None or snapshot is None or snapshot.generation != generation:
+        # The snapshot is missing or someone else has written to the sensors
+        # table since it was taken, so rebuild it from scratch.
+        logger.info("Rebuilding sensors snapshot")
+        query = Sensor.query
+        region_bounding_box = _get_region_bounding_box(region)
+        if region_bounding_box is not None:
+            query = query.filter(
+                region_bounding_box.contains(Sensor.latitude, Sensor.longitude)
+            )
+        rows = np.array(
+            [
+                tuple(row)
+                for row in query.with_entities(
+                    Sensor.id,
+                    Sensor.latitude,
+                    Sensor.longitude,
+                    Sensor.latest_reading,
+                    Sensor.humidity,
+                    Sensor.pm_cf_1,
+                    Sensor.updated_at,
+                ).all()
+            ],
+            dtype=SENSORS_SNAPSHOT_DTYPE,
+        )
+        if generation is None:
+            generation = Sync.query.bump_generation(SyncType.PURPLEAIR, region)
+        snapshot = SensorsSnapshot.from_rows(rows, generation)
 
-    trie: Trie[Zipcode] = Trie()
-    for zipcode in Zipcode.query.all():
-        trie.insert(zipcode.geohash, zipcode)
-
-    new_relations = []
-
-    # Delete the old relations before rebuilding them
-    deleted_relations_count = SensorZipcodeRelation.query.filter(
-        SensorZipcodeRelation.sensor_id.in_(moved_sensor_ids)
-    ).delete(synchronize_session=False)
-    logger.info("Deleting %s relations", deleted_relations_count)
-
-    sensors = Sensor.query.filter(Sensor.id.in_(moved_sensor_ids)).all()
-    for sensor in sensors:
-        gh = sensor.geohash
-        latitude = sensor.latitude
-        longitude = sensor.longitude
-        done = False
-        zipcode_ids: typing.Set[int] = set()
-        # TODO: Use Postgres' native geolocation extension.
-        while gh and not done:
-            zipcodes = [
-                zipcode for zipcode in trie.get(gh) if zipcode.id not in zipcode_ids
-            ]
-
-            for zipcode_id, distance in sorted(
-                [
-                    (
-                        z.id,
-                        haversine_distance(
-                            longitude, latitude, z.longitude, z.latitude
-                        ),
-                    )
-                    for z in zipcodes
-                ],
-                key=lambda t: t[1],
-            ):
-                if distance >= 25:
-                    done = True
-                    break
-                if len(zipcode_ids) >= 25:
-                    done = True
-                    break
-                zipcode_ids.add(zipcode_id)
-                data = {
-                    "zipcode_id": zipcode_id,
-                    "sensor_id": sensor.id,
-                    "distance": distance,
-                }
-                new_relations.append(SensorZipcodeRelation(**data))
-            gh = gh[:-1]
-
-    if new_relations:
-        logger.info("Creating %s relations", len(new_relations))
-        for objs in chunk_list(new_relations):
-            db.session.bulk_save_objects(objs)
-            db.session.commit()
-
-
-def _metrics_sync():
+    _sensors_snapshots[region] = snapshot
+    return snapshot
+
+
+def _save_sensors_snapshot(snapshot: SensorsSnapshot, region: str = ""):
+    _sensors_snapshots[region] = snapshot
+    try:
+        snapshot.save(_get_snapshot_dir(region))
+    except OSError as e:
+        # We can always rebuild the snapshot from the database.
+        get_celery_logger().warning("Failed to save sensors snapshot: %s", e)
+
+
+def _sensors_sync(
+    purpleair_data: SensorsBatch,
+    snapshot: SensorsSnapshot,
+    digest: str,
+    region: str = "",
+) -> typing.Tuple[typing.List[int], typing.List[int]]:
+    """Write the given sensors.
+
+    Returns the ids of the sensors which moved, and of the sensors which
+    moved or have a new reading.
+    """
     logger = get_celery_logger()
-    updates = []
-    ts = now()
 
-    zipcodes_to_sensors = collections.defaultdict(list)
-    for zipcode_id, latest_reading, humidity, pm_cf_1, sensor_id, distance in (
-        Sensor.query.join(SensorZipcodeRelation)
-        .filter(Sensor.updated_at > ts.timestamp() - (30 * 60))
-        .with_entities(
-            SensorZipcodeRelation.zipcode_id,
-            Sensor.latest_reading,
-            Sensor.humidity,
-            Sensor.pm_cf_1,
-            Sensor.id,
-            SensorZipcodeRelation.distance,
-        )
-        .all()
-    ):
-        zipcodes_to_sensors[zipcode_id].append(
-            (latest_reading, humidity, pm_cf_1, sensor_id, distance)
+    has_locations = "latitude" in purpleair_data
+    if not has_locations:
+        # Sensors keep the locations from the last metadata sync. We can't add
+        # sensors without a location, so new ones wait for the next one.
+        indices, is_known = snapshot.locate(purpleair_data["sensor_index"])
+        if not is_known.all():
+            logger.info(
+                "Skipping %s new sensors until the next metadata sync",
+                np.count_nonzero(~is_known),
+            )
+            purpleair_data = purpleair_data.take(is_known)
+            indices = indices[is_known]
+
+    rows = np.empty(len(purpleair_data), dtype=SENSORS_SNAPSHOT_DTYPE)
+    rows["id"] = purpleair_data["sensor_index"]
+    if has_locations:
+        rows["latitude"] = purpleair_data["latitude"]
+        rows["longitude"] = purpleair_data["longitude"]
+    else:
+        rows["latitude"] = snapshot.rows["latitude"][indices]
+        rows["longitude"] = snapshot.rows["longitude"][indices]
+    rows["latest_reading"] = purpleair_data["pm25"]
+    rows["humidity"] = purpleair_data["humidity"]
+    rows["pm_cf_1"] = purpleair_data["pm_cf_1"]
+    rows["updated_at"] = purpleair_data["last_seen"]
+
+    # Only sensors which are new or whose readings or location changed
+    # since the last sync need to be written.
+    is_new, is_moved, is_changed, has_new_reading = snapshot.diff(rows)
+    changed_rows = rows[is_changed]
+    if len(changed_rows):
+        logger.info(
+            "Writing %s of %s sensors (%s new)",
+            len(changed_rows),
+            len(rows),
+            np.count_nonzero(is_new),
         )
+        if has_locations:
+            num_written = bulk_upsert(
+                Sensor.__table__,
+                _SENSOR_COLUMNS,
+                (
+                    (*row, geohash.encode(latitude, longitude))
+                    for row, latitude, longitude in zip(
+                        changed_rows.tolist(),
+                        changed_rows["latitude"].tolist(),
+                        changed_rows["longitude"].tolist(),
+                    )
+                ),
+            )
+        else:
+            num_written = bulk_update(
+                Sensor.__table__,
+                _READINGS_COLUMNS,
+                changed_rows[_READINGS_COLUMNS].tolist(),
+            )
+        logger.info("Wrote %s sensors", num_written)
+        # This also commits the sensors we just wrote.
+        generation = Sync.query.bump_generation(SyncType.PURPLEAIR, region)
+    else:
+        generation = snapshot.generation
+    _save_sensors_snapshot(snapshot.update(changed_rows, generation, digest), region)
+
+    return rows["id"][is_moved].tolist(), rows["id"][has_new_reading].tolist()
+
+
+def _relations_sync(moved_sensor_ids: typing.List[int]):
+    logger = get_celery_logger()
 
-    for zipcode_id, sensor_tuples in zipcodes_to_sensors.items():
-        pm_25_readings: typing.List[float] = []
-        pm_cf_1_readings: typing.List[float] = []
-        humidities: typing.List[float] = []
-        closest_reading = float("inf")
-        farthest_reading = 0.0
-        sensor_ids: typing.List[int] = []
-        for pm_25, humidity, pm_cf_1, sensor_id, distance in sorted(
-            sensor_tuples, key=lambda s: s[-1]
-        ):
-            if (
-                len(pm_25_readings) < DESIRED_NUM_READINGS
-                or distance < DESIRED_READING_DISTANCE_KM
-            ):
-                pm_25_readings.append(pm_25)
-                humidities.append(humidity)
-                pm_cf_1_readings.append(pm_cf_1)
-                sensor_ids.append(sensor_id)
-                closest_reading = min(distance, closest_reading)
-                farthest_reading = max(distance, farthest_reading)
-            else:
-                break
-
-        if pm_25_readings:
-            num_sensors = len(pm_25_readings)
-            pm25 = round(sum(pm_25_readings) / num_sensors, ndigits=3)
-            humidity = round(sum(humidities) / num_sensors, ndigits=3)
-            pm_cf_1 = round(sum(pm_cf_1_readings) / num_sensors, ndigits=3)
-            min_sensor_distance = round(closest_reading, ndigits=3)
-            max_sensor_distance = round(farthest_reading, ndigits=3)
-            details = {
-                "num_sensors": num_sensors,
-                "min_sensor_distance": min_sensor_distance,
-                "max_sensor_distance": max_sensor_distance,
-                "sensor_ids": sensor_ids,
-            }
-            updates.append(
-                {
-                    "id": zipcode_id,
-                    "pm25": pm25,
-                    "humidity": humidity,
-                    "pm_cf_1": pm_cf_1,
-                    "pm25_updated_at": ts.timestamp(),
-                    "metrics_data": details,
-                }
+    # Deleting the old relations and creating the new ones in a single
+    # transaction means readers never see a sensor without its relations.
+    num_deleted, num_created = rebuild_relations_for_sensors(moved_sensor_ids)
+    db.session.commit()
+    logger.info("Replaced %s relations with %s relations", num_deleted, num_created)
+
+
+def _update_metrics_with_numpy(
+    updated_since: float,
+    updated_at: int,
+    zipcode_ids: typing.Optional[typing.List[int]],
+) -> int:
+    relations = SensorZipcodeRelation.query.get_fresh_relations(
+        updated_since, zipcode_ids
+    )
+    metrics, sensor_ids = compute_zipcode_metrics_in_processes(
+        relations,
+        DESIRED_NUM_READINGS,
+        DESIRED_READING_DISTANCE_KM,
+        get_num_processes(),
+    )
+    # Zipcodes whose readings haven't changed only need a new timestamp.
+    return bulk_update(
+        Zipcode.__table__,
+        _METRICS_COLUMNS,
+        ((*row, ids.tolist()) for row, ids in zip(metrics.tolist(), sensor_ids)),
+        touch={"pm25_updated_at": updated_at, "metrics_checked_at": updated_at},
+    )
+
+
+def _update_metrics(
+    updated_since: float,
+    updated_at: int,
+    zipcode_ids: typing.List[int],
+) -> int:
+    if app.config["HAZEBOT_METRICS_ENGINE"] == "numpy":
+        return _update_metrics_with_numpy(updated_since, updated_at, zipcode_ids)
+    return Zipcode.query.update_metrics(
+        updated_since=updated_since,
+        updated_at=updated_at,
+        desired_num_readings=DESIRED_NUM_READINGS,
+        desired_reading_distance_km=DESIRED_READING_DISTANCE_KM,
+        zipcode_ids=zipcode_ids,
+    )
+
+
+def _filter_clients_in_region(query: ClientQuery, region: str = "") -> ClientQuery:
+    """Clients in the given query with zipcodes in the region.
+
+    The query must already be joined with the zipcodes table.
+    """
+    region_bounding_box = _get_region_bounding_box(region)
+    if region_bounding_box is None:
+        return query
+    return query.filter(
+        region_bounding_box.contains(Zipcode.latitude, Zipcode.longitude)
+    )
+
+
+def _send_alerts_with_numpy(
+    query: ClientQuery, timezones_in_send_window: typing.Set[typing.Optional[str]]
+) -> int:
+    logger = get_celery_logger()
+    rows = query.with_entities(
+        Client.id,
+        Client.last_alert_sent_at,
+        Client.preferences,
+        Client.last_pm25,
+        Client.last_pm_cf_1,
+        Client.last_humidity,
+        Zipcode.id,
+        Zipcode.timezone,
+        Zipcode.pm25,
+        Zipcode.pm_cf_1,
+        Zipcode.humidity,
+    ).all()
+
+    candidates = np.empty(len(rows), dtype=ALERT_CANDIDATES_DTYPE)
+    zipcode_indices: typing.Dict[int, int] = {}
+    zipcode_readings: typing.List[typing.Tuple[float, float, float]] = []
+    alert_frequency = ClientPreferencesRegistry.get_by_name("alert_frequency")
+    alert_threshold = ClientPreferencesRegistry.get_by_name("alert_threshold")
+    conversion_factor = ClientPreferencesRegistry.get_by_name("conversion_factor")
+    is_valid = np.ones(len(rows), dtype=bool)
+    for i, row in enumerate(rows):
+        (
+            client_id,
+            last_alert_sent_at,
+            preferences,
+            last_pm25,
+            last_pm_cf_1,
+            last_humidity,
+            zipcode_id,
+            timezone,
+            pm25,
+            pm_cf_1,
+            humidity,
+        ) = row
+        if zipcode_id not in zipcode_indices:
+            zipcode_indices[zipcode_id] = len(zipcode_readings)
+            zipcode_readings.append((pm25, pm_cf_1, humidity))
+        try:
+            candidates[i] = (
+                client_id,
+                zipcode_indices[zipcode_id],
+                timezone in timezones_in_send_window,
+                last_alert_sent_at,
+                alert_frequency.get_value(preferences),
+                alert_threshold.get_value(preferences),
+                CONVERSION_FACTORS.index(conversion_factor.get_value(preferences)),
+                np.nan if last_pm25 is None else last_pm25,
+                np.nan if last_pm_cf_1 is None else last_pm_cf_1,
+                np.nan if last_humidity is None else last_humidity,
+                last_pm_cf_1 is not None,
+                last_humidity is not None,
             )
+        except Exception as e:
+            # Like `maybe_notify` raising, this only skips this client.
+            logger.exception("Failed to check alerts for client %s: %s", client_id, e)
+            is_valid[i] = False
+
+    alerts = get_alerts(
+        candidates[is_valid],
+        np.array(zipcode_readings, dtype=ZIPCODE_READINGS_DTYPE),
+        timestamp(),
+    )
+    if not len(alerts):
+        return 0
 
-    logger.info("Updating %s zipcodes", len(updates))
-    for mappings in chunk_list(updates, batch_size=5000):
-        db.session.bulk_update_mappings(Zipcode, mappings)
-        db.session.commit()
+    num_sent = 0
+    clients = {
+        client.id: client
+        for client in query.filter(Client.id.in_(alerts["client_id"].tolist()))
+    }
+    for client_id, pm25, pm25_level, aqi in alerts.tolist():
+        client = clients[client_id]
+        with force_locale(client.locale):
+            try:
+                if client.send_alert(pm25, Pm25(pm25_level), aqi):
+                    num_sent += 1
+            except Exception as e:
+                logger.exception("Failed to send alert to %s: %s", client, e)
+    return num_sent
 
 
-def _send_alerts():
+def _send_alerts(
+    query: ClientQuery, timezones_in_send_window: typing.Set[typing.Optional[str]]
+) -> int:
+    if app.config["HAZEBOT_ALERTS_ENGINE"] == "numpy":
+        return _send_alerts_with_numpy(query, timezones_in_send_window)
+
     logger = get_celery_logger()
     num_sent = 0
-    for client in Client.query.filter_eligible_for_sending().all():
+    for client in query.all():
         with force_locale(client.locale):
             try:
                 if client.maybe_notify():
                     num_sent += 1
             except Exception as e:
                 logger.exception("Failed to send alert to %s: %s", client, e)
+    return num_sent
+
 
+def _metrics_sync(changed_sensor_ids: typing.List[int], region: str = ""):
+    """Recompute zipcode metrics, and send alerts.
+
+    Zipcodes with clients eligible for alerts are recomputed first, in
+    batches, and the alerts for each batch are sent before moving on to the
+    next one. Everyone else's alerts are sent once the rest of the zipcodes
+    have been recomputed.
+    """
+    logger = get_celery_logger()
+    ts = now()
+    updated_since = ts.timestamp() - SENSOR_FRESHNESS_SECONDS
+    updated_at = int(ts.timestamp())
+
+    # Only zipcodes whose sensors have changed or gone stale since the last
+    # sync need to be recomputed.
+    last_synced_at = Sync.query.get_last_synced_at(SyncType.METRICS, region)
+    if app.config["HAZEBOT_INCREMENTAL_SYNC_ENABLED"] and last_synced_at:
+        zipcode_ids = SensorZipcodeRelation.query.get_affected_zipcode_ids(
+            changed_sensor_ids,
+            updated_since=updated_since,
+            previously_updated_since=last_synced_at - SENSOR_FRESHNESS_SECONDS,
+            refreshed_before=updated_at - ZIPCODE_REFRESH_SECONDS,
+            bounding_box=_get_region_bounding_box(region),
+        )
+    else:
+        # Each region only recomputes its own zipcodes, so that concurrent
+        # region syncs don't all rewrite the whole table.
+        query = Zipcode.query.with_entities(Zipcode.id).order_by(Zipcode.id)
+        region_bounding_box = _get_region_bounding_box(region)
+        if region_bounding_box is not None:
+            query = query.filter(
+                region_bounding_box.contains(Zipcode.latitude, Zipcode.longitude)
+            )
+        zipcode_ids = [zipcode_id for zipcode_id, in query]
+    if app.config["HAZEBOT_LAZY_METRICS_ENABLED"]:
+        # Zipcodes nobody is interested in are computed on demand instead, by
+        # `ZipcodeQuery.refresh_metrics`.
+        zipcodes_in_demand = {
+            zipcode_id
+            for zipcode_id, in Client.query.filter_in_demand(
+                updated_at - DEMAND_ACTIVITY_WINDOW_SECONDS
+            )
+            .with_entities(Client.zipcode_id)
+            .distinct()
+        }
+        zipcode_ids = [z for z in zipcode_ids if z in zipcodes_in_demand]
+    logger.info("Recomputing metrics for %s zipcodes", len(zipcode_ids))
+
+    subscribed_zipcode_ids = {
+        zipcode_id
+        for zipcode_id, in _filter_clients_in_region(
+            Client.query.filter_eligible_for_sending(), region
+        )
+        .with_entities(Client.zipcode_id)
+        .distinct()
+    }
+    # Only clients whose alerts could have changed are loaded.
+    timezones_in_send_window = Client.get_timezones_in_send_window()
+    candidates_query = _filter_clients_in_region(
+        Client.query.filter_alert_candidates(timezones_in_send_window), region
+    )
+    num_updated = 0
+    num_sent = 0
+    for batch in chunk_list(
+        (z for z in zipcode_ids if z in subscribed_zipcode_ids),
+        SUBSCRIBED_ZIPCODES_BATCH_SIZE,
+    ):
+        num_updated += _update_metrics(updated_since, updated_at, batch)
+        db.session.commit()
+        num_sent += _send_alerts(
+            candidates_query.filter(Client.zipcode_id.in_(batch)),
+            timezones_in_send_window,
+        )
+        logger.info("Updated %s zipcodes and sent %s alerts", num_updated, num_sent)
+
+    remaining_zipcode_ids = [z for z in zipcode_ids if z not in subscribed_zipcode_ids]
+    if remaining_zipcode_ids:
+        num_updated += _update_metrics(updated_since, updated_at, remaining_zipcode_ids)
+        db.session.commit()
+    logger.info("Updated %s zipcodes", num_updated)
+    Sync.query.set_last_synced_at(SyncType.METRICS, updated_at, region)
+
+    # Clients whose zipcodes didn't need recomputing may still need an alert,
+    # e.g. because the time of day changed.
+    recomputed_zipcode_ids = subscribed_zipcode_ids.intersection(zipcode_ids)
+    if recomputed_zipcode_ids:
+        candidates_query = candidates_query.filter(
+            Client.zipcode_id.notin_(recomputed_zipcode_ids)
+        )
+    num_sent += _send_alerts(candidates_query, timezones_in_send_window)
     logger.info("Sent %s alerts", num_sent)
 
 
@@ -318,7 +684,10 @@ def _send_share_requests() -> int:
     num_sent = 0
     if app.config["HAZEBOT_SHARE_REQUESTS_ENABLED"]:
         logger = get_celery_logger()
-        for client in Client.query.filter_eligible_for_share_requests().all():
+        timezones_in_send_window = Client.get_timezones_in_send_window()
+        for client in Client.query.filter_eligible_for_share_requests(
+            timezones_in_send_window
+        ).all():
             with force_locale(client.locale):
                 try:
                     if client.request_share():
@@ -331,24 +700,111 @@ def _send_share_requests() -> int:
     return num_sent
 
 
-def purpleair_sync():
+def purpleair_sync(region: str = ""):
+    """Sync sensors, relations and metrics with PurpleAir, and send alerts.
+
+    If a region is given, only sensors in that region and clients with
+    zipcodes in it are synced. Other regions are synced independently.
+    """
     logger = get_celery_logger()
 
-    logger.info("Fetching sensor from purpleair")
-    purpleair_data = _get_purpleair_sensors_data()
+    snapshot = _get_sensors_snapshot(region)
+    sync_metadata = _should_sync_metadata(snapshot, region)
+    sweep = sync_metadata or _should_sweep(region)
+    if sync_metadata:
+        logger.info("Fetching sensors from purpleair")
+    elif sweep:
+        logger.info("Fetching readings from purpleair")
+    else:
+        logger.info("Fetching readings in demand from purpleair")
+    purpleair_data = _get_purpleair_sensors_data(sync_metadata, sweep, region)
+
+    region_bounding_box = _get_region_bounding_box(region)
+    if region_bounding_box is not None and "latitude" in purpleair_data:
+        # Leave sensors on the edge of the region to its neighbors.
+        purpleair_data = purpleair_data.take(
+            region_bounding_box.contains(
+                purpleair_data["latitude"], purpleair_data["longitude"]
+            )
+        )
 
     logger.info("Recieved %s sensors", len(purpleair_data))
-    moved_sensor_ids = _sensors_sync(purpleair_data)
+    synced_at = purpleair_data.timestamp
+    digest = purpleair_data.digest()
+    changed_sensor_ids: typing.List[int] = []
+    if purpleair_data and digest == snapshot.digest:
+        # Nothing has changed, so the sensors and relations are already up to
+        # date. Metrics still depend on sensors going stale though.
+        logger.info("Skipping sensors sync because purpleair data is unchanged")
+    else:
+        purpleair_data = _filter_valid_sensors(purpleair_data)
+        moved_sensor_ids, changed_sensor_ids = _sensors_sync(
+            purpleair_data, snapshot, digest, region
+        )
+
+        if moved_sensor_ids:
+            logger.info("Syncing relations for %s sensors", len(moved_sensor_ids))
+            _relations_sync(moved_sensor_ids)
+
+    logger.info("Syncing metrics and sending alerts")
+    _metrics_sync(changed_sensor_ids, region)
+
+    if synced_at:
+        # The next sync only needs sensors which changed after this one.
+        Sync.query.set_last_synced_at(SyncType.PURPLEAIR, synced_at, region)
+        if sweep:
+            Sync.query.set_last_synced_at(SyncType.PURPLEAIR_SWEEP, synced_at, region)
+        if sync_metadata:
+            Sync.query.set_last_synced_at(
+                SyncType.PURPLEAIR_METADATA, synced_at, region
+            )
+
+    if not region:
+        logger.info("Requesting shares")
+        _send_share_requests()
+
+
+def purpleair_region_sync(region: str):
+    """Sync a single region, recording when it completes."""
+    try:
+        purpleair_sync(region)
+    finally:
+        # Even after a failure, the region is free to be synced again.
+        db.session.rollback()
+        Sync.query.set_last_synced_at(SyncType.REGION_COMPLETED, timestamp(), region)
 
-    if moved_sensor_ids:
-        logger.info("Syncing relations for %s sensors", len(moved_sensor_ids))
-        _relations_sync(moved_sensor_ids)
 
-    logger.info("Syncing metrics")
-    _metrics_sync()
+def dispatch_region_syncs() -> typing.List[str]:
+    """Queue a sync of each region as its own task, and send share requests.
 
-    logger.info("Sending alerts")
-    _send_alerts()
+    Regions whose last sync is still running are skipped, unless it seems to
+    be stuck. Returns the regions which were queued.
+    """
+    from airq.tasks import purpleair_region_sync as purpleair_region_sync_task
+
+    logger = get_celery_logger()
+    ts = timestamp()
+    dispatched_regions = []
+    for region in PURPLEAIR_REGIONS:
+        dispatched_at = Sync.query.get_last_synced_at(
+            SyncType.REGION_DISPATCHED, region
+        )
+        completed_at = Sync.query.get_last_synced_at(SyncType.REGION_COMPLETED, region)
+        if dispatched_at > completed_at:
+            if dispatched_at > ts - REGION_SYNC_TIMEOUT_SECONDS:
+                logger.info("Skipping region %s which is still syncing", region)
+                continue
+            logger.error(
+                "Region %s has been syncing for %s seconds",
+                region,
+                ts - dispatched_at,
+            )
+
+        Sync.query.set_last_synced_at(SyncType.REGION_DISPATCHED, ts, region)
+        purpleair_region_sync_task.delay(region)
+        dispatched_regions.append(region)
 
     logger.info("Requesting shares")
     _send_share_requests()
+
+    return dispatched_regions
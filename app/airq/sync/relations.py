@@ -0,0 +1,170 @@
+import itertools
+import numpy as np
+import time
+import typing
+
+from airq.celery import get_celery_logger
+from airq.lib.parallel import get_num_processes
+from airq.lib.parallel import map_in_processes
+from airq.lib.postgres import bulk_insert
+from airq.lib.postgres import replace_table
+from airq.lib.spatial import SpatialIndex
+from airq.models.relations import SensorZipcodeRelation
+from airq.models.sensors import Sensor
+from airq.models.syncs import Sync
+from airq.models.syncs import SyncType
+from airq.models.zipcodes import Zipcode
+
+
+# Sensors are related to zipcodes within this distance.
+MAX_RELATION_DISTANCE_KM = 25
+
+# Sensors are related to at most this many of their nearest zipcodes.
+MAX_RELATIONS_PER_SENSOR = 25
+
+# Number of sensors handed to a worker process at a time.
+_CHUNK_SIZE = 1000
+
+TRelation = typing.Tuple[int, int, float]
+
+# Built by each worker process when it starts.
+_zipcodes_index: typing.Optional[SpatialIndex] = None
+
+
+def _init_worker(
+    zipcode_ids: np.ndarray, latitudes: np.ndarray, longitudes: np.ndarray
+):
+    global _zipcodes_index
+    _zipcodes_index = SpatialIndex(zipcode_ids, latitudes, longitudes)
+
+
+def _relate_sensors(
+    zipcodes_index: SpatialIndex,
+    sensor_ids: np.ndarray,
+    latitudes: np.ndarray,
+    longitudes: np.ndarray,
+) -> typing.List[TRelation]:
+    """Relate each sensor to its nearest zipcodes in `zipcodes_index`.
+
+    Both the full and the incremental rebuilds go through here, so that they
+    agree on which zipcodes each sensor is related to and how far apart they
+    are.
+    """
+    sensor_indices, zipcode_ids, distances = zipcodes_index.k_nearest_many(
+        latitudes, longitudes, MAX_RELATIONS_PER_SENSOR, MAX_RELATION_DISTANCE_KM
+    )
+    return list(
+        zip(
+            sensor_ids[sensor_indices].tolist(),
+            zipcode_ids.tolist(),
+            distances.tolist(),
+        )
+    )
+
+
+def _compute_relations(
+    sensor_ids: np.ndarray, latitudes: np.ndarray, longitudes: np.ndarray
+) -> typing.List[TRelation]:
+    assert _zipcodes_index is not None, "Worker not initialized"
+    return _relate_sensors(_zipcodes_index, sensor_ids, latitudes, longitudes)
+
+
+def _get_relations(
+    sensors: typing.Tuple[np.ndarray, np.ndarray, np.ndarray],
+    zipcodes: typing.Tuple[np.ndarray, np.ndarray, np.ndarray],
+    num_processes: int,
+) -> typing.List[TRelation]:
+    """Relate each sensor to its nearest zipcodes.
+
+    Both `sensors` and `zipcodes` are given as arrays of ids, latitudes and
+    longitudes.
+    """
+    num_chunks = max(1, -(-len(sensors[0]) // _CHUNK_SIZE))
+    chunks = list(zip(*(np.array_split(array, num_chunks) for array in sensors)))
+    return list(
+        itertools.chain.from_iterable(
+            map_in_processes(
+                _compute_relations,
+                chunks,
+                num_processes,
+                initializer=_init_worker,
+                initargs=zipcodes,
+            )
+        )
+    )
+
+
+def rebuild_relations(num_processes: typing.Optional[int] = None):
+    """Rebuild the relations between every sensor and every zipcode."""
+    logger = get_celery_logger()
+    start_ts = time.perf_counter()
+
+    sensor_rows = Sensor.query.with_entities(
+        Sensor.id, Sensor.latitude, Sensor.longitude
+    ).all()
+    zipcode_rows = Zipcode.query.with_entities(
+        Zipcode.id, Zipcode.latitude, Zipcode.longitude
+    ).all()
+    logger.info(
+        "Rebuilding relations for %s sensors and %s zipcodes",
+        len(sensor_rows),
+        len(zipcode_rows),
+    )
+
+    relations = _get_relations(
+        (
+            np.array([row[0] for row in sensor_rows], dtype=np.int64),
+            np.array([row[1] for row in sensor_rows], dtype=np.float64),
+            np.array([row[2] for row in sensor_rows], dtype=np.float64),
+        ),
+        (
+            np.array([row[0] for row in zipcode_rows], dtype=np.int64),
+            np.array([float(row[1]) for row in zipcode_rows], dtype=np.float64),
+            np.array([float(row[2]) for row in zipcode_rows], dtype=np.float64),
+        ),
+        num_processes or get_num_processes(),
+    )
+
+    replace_table(
+        SensorZipcodeRelation.__table__,
+        ["sensor_id", "zipcode_id", "distance"],
+        relations,
+    )
+    # Every zipcode may have different sensors now.
+    Sync.query.reset_last_synced_at(SyncType.METRICS)
+    logger.info(
+        "Rebuilt %s relations in %s seconds",
+        len(relations),
+        time.perf_counter() - start_ts,
+    )
+
+
+def rebuild_relations_for_sensors(
+    sensor_ids: typing.List[int],
+) -> typing.Tuple[int, int]:
+    """Relate each of the given sensors to its nearest zipcodes.
+
+    Replaces any existing relations of those sensors. Does not commit.
+    Returns the number of relations deleted and created.
+    """
+    sensor_rows = (
+        Sensor.query.filter(Sensor.id.in_(sensor_ids))
+        .with_entities(Sensor.id, Sensor.latitude, Sensor.longitude)
+        .all()
+    )
+    relations = _relate_sensors(
+        Zipcode.query.get_spatial_index(),
+        np.array([row[0] for row in sensor_rows], dtype=np.int64),
+        np.array([row[1] for row in sensor_rows], dtype=np.float64),
+        np.array([row[2] for row in sensor_rows], dtype=np.float64),
+    )
+
+    num_deleted = SensorZipcodeRelation.query.filter(
+        SensorZipcodeRelation.sensor_id.in_(sensor_ids)
+    ).delete(synchronize_session=False)
+    num_created = bulk_insert(
+        SensorZipcodeRelation.__table__,
+        ["sensor_id", "zipcode_id", "distance"],
+        relations,
+    )
+    return num_deleted, num_created
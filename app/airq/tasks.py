@@ -13,6 +13,13 @@ def models_sync():
     models_sync()
 
 
+@celery.task()
+def purpleair_region_sync(region: str):
+    from airq.sync.purpleair import purpleair_region_sync
+
+    purpleair_region_sync(region)
+
+
 @celery.task()
 def bulk_send(
     *,
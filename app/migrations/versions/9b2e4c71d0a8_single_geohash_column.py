@@ -0,0 +1,56 @@
+"""single geohash column
+
+Revision ID: 9b2e4c71d0a8
+Revises: 5ddc17419d75
+Create Date: 2026-10-18 14:08:51.402733
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = "9b2e4c71d0a8"
+down_revision = "5ddc17419d75"
+branch_labels = None
+depends_on = None
+
+
+_TABLES = ["sensors", "zipcodes"]
+
+
+def upgrade():
+    for table in _TABLES:
+        op.add_column(table, sa.Column("geohash", sa.String(), nullable=True))
+        op.execute(
+            f"UPDATE {table} SET geohash = "
+            + " || ".join(f"geohash_bit_{i}" for i in range(1, 13))
+        )
+        op.alter_column(table, "geohash", nullable=False)
+        op.create_index(
+            f"idx_{table}_geohash",
+            table,
+            ["geohash"],
+            unique=False,
+            postgresql_ops={"geohash": "text_pattern_ops"},
+        )
+        for i in range(1, 13):
+            op.drop_column(table, f"geohash_bit_{i}")
+
+
+def downgrade():
+    for table in _TABLES:
+        for i in range(1, 13):
+            op.add_column(
+                table, sa.Column(f"geohash_bit_{i}", sa.String(), nullable=True)
+            )
+        op.execute(
+            f"UPDATE {table} SET "
+            + ", ".join(
+                f"geohash_bit_{i} = substr(geohash, {i}, 1)" for i in range(1, 13)
+            )
+        )
+        for i in range(1, 13):
+            op.alter_column(table, f"geohash_bit_{i}", nullable=False)
+        op.drop_index(f"idx_{table}_geohash", table_name=table)
+        op.drop_column(table, "geohash")
@@ -9,6 +9,8 @@ from unittest import mock
 
 
 class MockResponse(abc.ABC):
+    headers: typing.Dict[str, str] = {}
+
     @abc.abstractmethod
     def raise_for_status(self):
         pass
@@ -21,6 +23,9 @@ class MockResponse(abc.ABC):
     def json(self) -> dict:
         pass
 
+    def close(self):
+        pass
+
 
 class SuccessResponse(MockResponse):
     def __init__(self, file_path: str):
@@ -64,9 +69,20 @@ class ErrorResponse(MockResponse):
 
 
 class MockRequests:
-    def __init__(self, fixtures: typing.Dict[str, MockResponse]):
+    """Patch requests to return fixtures by URL.
+
+    A URL may map to a list of responses, which are returned in order; the
+    last one is returned for any further requests.
+    """
+
+    def __init__(
+        self,
+        fixtures: typing.Dict[
+            str, typing.Union[MockResponse, typing.List[MockResponse]]
+        ],
+    ):
         self._fixtures = fixtures
-        self._patch = None
+        self._patches: typing.List[typing.Any] = []
 
     @classmethod
     def for_urls(cls, fixtures: typing.Dict[str, str]):
@@ -75,17 +91,27 @@ class MockRequests:
         )
 
     def __enter__(self):
-        self._patch = mock.patch.object(requests, "get", self.get)
-        self._patch.start()
+        self._patches = [
+            mock.patch.object(requests, "get", self.get),
+            mock.patch.object(requests.Session, "get", self.get),
+        ]
+        for patch in self._patches:
+            patch.start()
 
     def __exit__(self, exc_type, exc, tb):
-        if self._patch:
-            self._patch.stop()
+        for patch in self._patches:
+            patch.stop()
+        self._patches = []
 
     def get(self, url, *args, **kwargs) -> MockResponse:
         if url in self._fixtures:
-            print(f"Using {self._fixtures[url]} for {url}")
-            return self._fixtures[url]
+            fixture = self._fixtures[url]
+            if isinstance(fixture, list):
+                resp = fixture.pop(0) if len(fixture) > 1 else fixture[0]
+            else:
+                resp = fixture
+            print(f"Using {resp} for {url}")
+            return resp
         raise Exception(
             f"Cannot find a fixture for {url}.\nAvailable fixtures: {self._fixtures}"
         )
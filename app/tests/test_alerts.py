@@ -0,0 +1,120 @@
+import numpy as np
+
+from unittest import mock
+
+from airq.lib.alerts import ALERT_CANDIDATES_DTYPE
+from airq.lib.alerts import CONVERSION_FACTORS
+from airq.lib.alerts import get_alerts
+from airq.lib.alerts import ZIPCODE_READINGS_DTYPE
+from airq.lib.clock import timestamp
+from airq.lib.readings import ConversionFactor
+from airq.lib.readings import Pm25
+from airq.models.clients import Client
+from airq.models.zipcodes import Zipcode
+from tests.base import BaseTestCase
+
+
+def _make_clients():
+    rng = np.random.default_rng(0)
+    zipcodes = [
+        Zipcode(
+            id=i,
+            zipcode=str(10000 + i),
+            timezone=rng.choice(["America/New_York", "Pacific/Honolulu", None]),
+            pm25=rng.uniform(0, 300),
+            pm_cf_1=rng.uniform(0, 300),
+            humidity=rng.uniform(0, 100),
+        )
+        for i in range(20)
+    ]
+    zipcodes[0].pm25 = float("nan")
+    zipcodes[1].pm_cf_1 = float("nan")
+
+    clients = []
+    for i in range(2000):
+        zipcode = zipcodes[rng.integers(len(zipcodes))]
+        preferences = {}
+        if rng.random() < 0.5:
+            preferences["alert_frequency"] = int(rng.integers(0, 4))
+        if rng.random() < 0.5:
+            preferences["alert_threshold"] = int(rng.choice(list(Pm25)))
+        if rng.random() < 0.5:
+            preferences["conversion_factor"] = str(
+                rng.choice([c.value for c in ConversionFactor])
+            )
+        # Mostly close to the zipcode's readings, so that some levels match.
+        last_readings = [
+            rng.choice(
+                [
+                    None,
+                    float("nan"),
+                    rng.uniform(0, 300),
+                    value + rng.uniform(-20, 20),
+                ],
+                p=[0.05, 0.05, 0.2, 0.7],
+            )
+            for value in (zipcode.pm25, zipcode.pm_cf_1, zipcode.humidity)
+        ]
+        clients.append(
+            Client(
+                id=i,
+                zipcode_id=zipcode.id,
+                zipcode=zipcode,
+                last_alert_sent_at=int(
+                    rng.choice([0, timestamp() - rng.integers(0, 10 * 60 * 60)])
+                ),
+                preferences=preferences,
+                last_pm25=last_readings[0],
+                last_pm_cf_1=last_readings[1],
+                last_humidity=last_readings[2],
+            )
+        )
+    return zipcodes, clients
+
+
+class AlertsTestCase(BaseTestCase):
+    def test_get_alerts(self):
+        zipcodes, clients = _make_clients()
+
+        expected = []
+        with mock.patch.object(Client, "send_alert", return_value=True) as send_alert:
+            for client in clients:
+                try:
+                    if client.maybe_notify():
+                        pm25, pm25_level, aqi = send_alert.call_args[0]
+                        expected.append((client.id, pm25, pm25_level, aqi))
+                except (TypeError, ValueError, OverflowError):
+                    pass
+        self.assertGreater(len(expected), 10)
+
+        candidates = np.empty(len(clients), dtype=ALERT_CANDIDATES_DTYPE)
+        for i, client in enumerate(clients):
+            candidates[i] = (
+                client.id,
+                client.zipcode.id,
+                client.is_in_send_window,
+                client.last_alert_sent_at,
+                client.alert_frequency,
+                client.alert_threshold,
+                CONVERSION_FACTORS.index(client.conversion_factor),
+                np.nan if client.last_pm25 is None else client.last_pm25,
+                np.nan if client.last_pm_cf_1 is None else client.last_pm_cf_1,
+                np.nan if client.last_humidity is None else client.last_humidity,
+                client.last_pm_cf_1 is not None,
+                client.last_humidity is not None,
+            )
+        zipcode_readings = np.array(
+            [(z.pm25, z.pm_cf_1, z.humidity) for z in zipcodes],
+            dtype=ZIPCODE_READINGS_DTYPE,
+        )
+
+        alerts = get_alerts(candidates, zipcode_readings, timestamp())
+        self.assertListEqual(expected, alerts.tolist())
+
+    def test_get_alerts_empty(self):
+        alerts = get_alerts(
+            np.empty(0, dtype=ALERT_CANDIDATES_DTYPE),
+            np.empty(0, dtype=ZIPCODE_READINGS_DTYPE),
+            timestamp(),
+        )
+        self.assertEqual(0, len(alerts))
@@ -199,6 +199,87 @@ class ClientTestCase(BaseTestCase):
         self.db.session.commit()
         self.assertEqual(0, Client.query.filter_eligible_for_sending().count())
 
+    def test_filter_alert_candidates(self):
+        zipcode = self.zipcode
+        assert zipcode is not None, "Mypy is unhappy"
+        zipcode.pm25 = 11
+        self.db.session.commit()
+
+        # Not a candidate until the level changes
+        client = self._make_client(
+            last_pm25=11,
+            last_pm_cf_1=zipcode.pm_cf_1,
+            last_humidity=zipcode.humidity,
+        )
+        self.assertEqual(0, Client.query.filter_alert_candidates().count())
+        zipcode.pm25 = 13
+        self.db.session.commit()
+        self.assertEqual(1, Client.query.filter_alert_candidates().count())
+
+        # Levels are compared using the client's conversion factor
+        client.conversion_factor = ConversionFactor.US_EPA
+        self.db.session.commit()
+        self.assertEqual(0, Client.query.filter_alert_candidates().count())
+        client.conversion_factor = ConversionFactor.NONE
+        self.db.session.commit()
+
+        # Not a candidate within the alert frequency
+        client.last_alert_sent_at = self.timestamp - 60
+        self.db.session.commit()
+        self.assertEqual(0, Client.query.filter_alert_candidates().count())
+        client.alert_frequency = 0
+        self.db.session.commit()
+        self.assertEqual(1, Client.query.filter_alert_candidates().count())
+
+        # Not a candidate outside of the send window
+        self.clock.advance(60 * 60 * 6)
+        self.assertEqual(0, Client.query.filter_alert_candidates().count())
+
+    def test_get_timezones_in_send_window(self):
+        zipcode = self.zipcode
+        assert zipcode is not None, "Mypy is unhappy"
+        self._make_client()
+
+        # Zipcodes without a timezone use Pacific time.
+        zipcode.timezone = None
+        self.db.session.commit()
+        self.assertIn(None, Client.get_timezones_in_send_window())
+        self.assertEqual(
+            1,
+            Client.query.filter_eligible_for_sending()
+            .filter_in_send_window({None})
+            .count(),
+        )
+
+        self.clock.advance(60 * 60 * 6)
+        self.assertNotIn(None, Client.get_timezones_in_send_window())
+        self.assertEqual(
+            0,
+            Client.query.filter_eligible_for_sending()
+            .filter_in_send_window(set())
+            .count(),
+        )
+
+    def test_filter_in_demand(self):
+        active_since = self.timestamp - 60
+
+        # Subscribed clients are in demand
+        client = self._make_client()
+        self.assertEqual(1, Client.query.filter_in_demand(active_since).count())
+
+        # Unsubscribed clients are in demand if they've been active recently
+        client.alerts_disabled_at = self.timestamp - 120
+        self.db.session.commit()
+        self.assertEqual(0, Client.query.filter_in_demand(active_since).count())
+        client.last_activity_at = self.timestamp
+        self.db.session.commit()
+        self.assertEqual(1, Client.query.filter_in_demand(active_since).count())
+
+        # Clients without a zipcode are never in demand
+        client.zipcode_id = None
+        self.db.session.commit()
+        self.assertEqual(0, Client.query.filter_in_demand(active_since).count())
+
     def test_enable_alerts(self):
         client = self._make_client(alerts_disabled_at=self.timestamp)
         client.enable_alerts()
@@ -0,0 +1,108 @@
+import math
+import numpy as np
+
+from airq.lib.geo import BoundingBox
+from airq.lib.geo import EARTH_RADIUS_KM
+from airq.lib.geo import get_covering_bounding_boxes
+from airq.lib.geo import haversine_distance
+from tests.base import BaseTestCase
+
+
+def _destination(latitude, longitude, bearing, km):
+    # The point `km` away from the given point along a great circle.
+    lat1, lng1, theta = map(math.radians, [latitude, longitude, bearing])
+    delta = km / EARTH_RADIUS_KM
+    lat2 = math.asin(
+        math.sin(lat1) * math.cos(delta)
+        + math.cos(lat1) * math.sin(delta) * math.cos(theta)
+    )
+    lng2 = lng1 + math.atan2(
+        math.sin(theta) * math.sin(delta) * math.cos(lat1),
+        math.cos(delta) - math.sin(lat1) * math.sin(lat2),
+    )
+    return math.degrees(lat2), math.degrees(lng2)
+
+
+class GeoTestCase(BaseTestCase):
+    def test_split(self):
+        bounding_box = BoundingBox(nwlat=50, nwlng=-120, selat=40, selng=-100)
+        self.assertListEqual(
+            [
+                BoundingBox(nwlat=50, nwlng=-120, selat=45, selng=-110),
+                BoundingBox(nwlat=50, nwlng=-110, selat=45, selng=-100),
+                BoundingBox(nwlat=45, nwlng=-120, selat=40, selng=-110),
+                BoundingBox(nwlat=45, nwlng=-110, selat=40, selng=-100),
+            ],
+            bounding_box.split(2, 2),
+        )
+
+    def test_contains(self):
+        bounding_box = BoundingBox(nwlat=50, nwlng=-120, selat=40, selng=-100)
+        latitudes = np.array([45, 40, 50, 45, 45, 30])
+        longitudes = np.array([-110, -120, -110, -100, -130, -110])
+        self.assertListEqual(
+            [True, True, False, False, False, False],
+            bounding_box.contains(latitudes, longitudes).tolist(),
+        )
+
+        # Each point is in exactly one box of a split.
+        counts = sum(
+            box.contains(latitudes, longitudes).astype(int)
+            for box in bounding_box.split(2, 2)
+        )
+        self.assertListEqual(
+            bounding_box.contains(latitudes, longitudes).astype(int).tolist(),
+            counts.tolist(),
+        )
+
+    def test_intersection(self):
+        bounding_box = BoundingBox(nwlat=50, nwlng=-120, selat=40, selng=-100)
+        self.assertEqual(
+            BoundingBox(nwlat=50, nwlng=-110, selat=45, selng=-100),
+            bounding_box.intersection(
+                BoundingBox(nwlat=55, nwlng=-110, selat=45, selng=-90)
+            ),
+        )
+        self.assertIsNone(
+            bounding_box.intersection(
+                BoundingBox(nwlat=40, nwlng=-110, selat=30, selng=-90)
+            )
+        )
+
+    def test_get_covering_bounding_boxes(self):
+        points = [
+            (45.5, -122.6),  # Portland
+            (45.1, -121.2),  # Adjacent cell to the east
+            (45.9, -122.9),  # Same cell as Portland
+            (37.8, -122.4),  # San Francisco
+        ]
+        bounding_boxes = get_covering_bounding_boxes(points, radius_km=0)
+        self.assertListEqual(
+            [
+                BoundingBox(nwlat=38, nwlng=-123, selat=37, selng=-122),
+                BoundingBox(nwlat=46, nwlng=-123, selat=45, selng=-121),
+            ],
+            bounding_boxes,
+        )
+
+        # Padding grows every side of the box.
+        (bounding_box,) = get_covering_bounding_boxes([(45.5, -122.6)], radius_km=25)
+        self.assertAlmostEqual(46.225, bounding_box.nwlat, places=3)
+        self.assertAlmostEqual(44.775, bounding_box.selat, places=3)
+        self.assertLess(bounding_box.nwlng, -123.3)
+        self.assertGreater(bounding_box.selng, -121.7)
+
+        self.assertListEqual([], get_covering_bounding_boxes([], radius_km=25))
+
+    def test_get_covering_bounding_boxes_edges(self):
+        # Points just inside the radius of a point in the corner of its cell,
+        # as measured by `haversine_distance`, are always covered.
+        latitude, longitude = 45.99999, -122.99999
+        (bounding_box,) = get_covering_bounding_boxes(
+            [(latitude, longitude)], radius_km=25
+        )
+        for bearing in range(0, 360, 15):
+            with self.subTest(bearing=bearing):
+                lat, lng = _destination(latitude, longitude, bearing, 24.999)
+                self.assertLess(haversine_distance(longitude, latitude, lng, lat), 25)
+                self.assertTrue(bounding_box.contains(lat, lng))
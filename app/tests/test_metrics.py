@@ -0,0 +1,92 @@
+import collections
+import numpy as np
+
+from unittest import mock
+
+from airq.lib.metrics import compute_zipcode_metrics
+from airq.lib.metrics import compute_zipcode_metrics_in_processes
+from airq.lib.metrics import partition_relations
+from airq.lib.metrics import RELATIONS_DTYPE
+from tests.base import BaseTestCase
+
+
+def _compute_zipcode_metrics(relations):
+    # The per-zipcode loop which `compute_zipcode_metrics` replaced.
+    zipcodes_to_sensors = collections.defaultdict(list)
+    for zipcode_id, sensor_id, distance, pm25, humidity, pm_cf_1 in relations.tolist():
+        zipcodes_to_sensors[zipcode_id].append(
+            (distance, sensor_id, pm25, humidity, pm_cf_1)
+        )
+
+    metrics = {}
+    for zipcode_id, sensor_tuples in zipcodes_to_sensors.items():
+        selected = []
+        for sensor_tuple in sorted(sensor_tuples):
+            if len(selected) < 8 or sensor_tuple[0] < 2.5:
+                selected.append(sensor_tuple)
+            else:
+                break
+        num_sensors = len(selected)
+        metrics[zipcode_id] = (
+            round(sum(s[2] for s in selected) / num_sensors, ndigits=3),
+            round(sum(s[3] for s in selected) / num_sensors, ndigits=3),
+            round(sum(s[4] for s in selected) / num_sensors, ndigits=3),
+            num_sensors,
+            round(selected[0][0], ndigits=3),
+            round(selected[-1][0], ndigits=3),
+            [s[1] for s in selected],
+        )
+    return metrics
+
+
+def _make_relations():
+    rng = np.random.default_rng(0)
+    relations = np.empty(5000, dtype=RELATIONS_DTYPE)
+    relations["zipcode_id"] = rng.integers(0, 300, len(relations))
+    relations["sensor_id"] = rng.permutation(len(relations))
+    # Rounded so that some distances are tied.
+    relations["distance"] = np.round(rng.uniform(0, 25, len(relations)), 1)
+    relations["latest_reading"] = rng.uniform(0, 500, len(relations))
+    relations["humidity"] = rng.uniform(0, 100, len(relations))
+    relations["pm_cf_1"] = rng.uniform(0, 500, len(relations))
+    return relations
+
+
+class MetricsTestCase(BaseTestCase):
+    def test_compute_zipcode_metrics(self):
+        relations = _make_relations()
+        expected = _compute_zipcode_metrics(relations)
+        metrics, sensor_ids = compute_zipcode_metrics(relations, 8, 2.5)
+        self.assertListEqual(sorted(expected), metrics["zipcode_id"].tolist())
+        for row, ids in zip(metrics.tolist(), sensor_ids):
+            self.assertEqual(expected[row[0]], (*row[1:], ids.tolist()))
+
+    def test_compute_zipcode_metrics_empty(self):
+        metrics, sensor_ids = compute_zipcode_metrics(
+            np.empty(0, dtype=RELATIONS_DTYPE), 8, 2.5
+        )
+        self.assertEqual(0, len(metrics))
+        self.assertListEqual([], sensor_ids)
+
+    def test_partition_relations(self):
+        relations = _make_relations()
+        partitions = partition_relations(relations, 4)
+        self.assertEqual(4, len(partitions))
+        self.assertEqual(len(relations), sum(len(p) for p in partitions))
+        for prev, curr in zip(partitions, partitions[1:]):
+            self.assertLess(prev["zipcode_id"].max(), curr["zipcode_id"].min())
+
+        self.assertEqual(1, len(partition_relations(relations[:1], 4)))
+
+    @mock.patch("airq.lib.metrics._MIN_RELATIONS_PER_PARTITION", 1000)
+    def test_compute_zipcode_metrics_in_processes(self):
+        relations = _make_relations()
+        expected_metrics, expected_sensor_ids = compute_zipcode_metrics(
+            relations, 8, 2.5
+        )
+        metrics, sensor_ids = compute_zipcode_metrics_in_processes(relations, 8, 2.5, 3)
+        self.assertListEqual(expected_metrics.tolist(), metrics.tolist())
+        self.assertListEqual(
+            [ids.tolist() for ids in expected_sensor_ids],
+            [ids.tolist() for ids in sensor_ids],
+        )
@@ -0,0 +1,27 @@
+from airq.config import db
+from airq.lib.postgres import bulk_update
+from airq.models.zipcodes import Zipcode
+from tests.base import BaseTestCase
+
+
+class PostgresTestCase(BaseTestCase):
+    def test_bulk_update(self):
+        changed, unchanged = Zipcode.query.order_by(Zipcode.id).limit(2).all()
+        rows = [
+            (changed.id, changed.pm25 + 1, changed.sensor_ids),
+            (unchanged.id, unchanged.pm25, unchanged.sensor_ids),
+        ]
+        expected_pm25 = [changed.pm25 + 1, unchanged.pm25]
+
+        num_updated = bulk_update(
+            Zipcode.__table__,
+            ["id", "pm25", "sensor_ids"],
+            rows,
+            touch={"pm25_updated_at": 1234},
+        )
+        self.assertEqual(1, num_updated)
+        for zipcode, pm25 in zip([changed, unchanged], expected_pm25):
+            db.session.refresh(zipcode)
+            self.assertEqual(pm25, zipcode.pm25)
+            self.assertEqual(1234, zipcode.pm25_updated_at)
+        db.session.rollback()
@@ -0,0 +1,173 @@
+import json
+import math
+import numpy as np
+import os
+import typing
+
+from requests.exceptions import ConnectionError
+from requests.exceptions import HTTPError
+from unittest import mock
+
+from airq.lib.purpleair import PURPLEAIR_SENSORS_API_URL
+from airq.lib.geo import BoundingBox
+from airq.lib.purpleair import PurpleAirClient
+from airq.lib.purpleair import SensorsBatch
+from airq.lib.purpleair import parse_sensors_response
+from tests.base import BaseTestCase
+from tests.mocks.requests import ErrorResponse
+from tests.mocks.requests import MockRequests
+from tests.mocks.requests import SuccessResponse
+
+
+FIXTURE_PATH = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)),
+    "fixtures",
+    "purpleair",
+    "purpleair.json",
+)
+
+
+def _chunks(data: bytes, chunk_size: int) -> typing.Iterator[bytes]:
+    for i in range(0, len(data), chunk_size):
+        yield data[i : i + chunk_size]
+
+
+class PurpleAirTestCase(BaseTestCase):
+    def test_parse_sensors_response(self):
+        with open(FIXTURE_PATH, "rb") as f:
+            raw = f.read()
+        expected = json.loads(raw)
+        fields = expected["fields"]
+
+        # Tiny chunks split numbers, strings and multibyte characters.
+        for chunk_size in (1, 7, 4096, len(raw)):
+            with self.subTest(chunk_size=chunk_size):
+                batch = parse_sensors_response(_chunks(raw, chunk_size))
+                self.assertEqual(len(expected["data"]), len(batch))
+                self.assertEqual(expected["data_time_stamp"], batch.timestamp)
+                for i, row in enumerate(expected["data"]):
+                    data = dict(zip(fields, row))
+                    self.assertEqual(data["sensor_index"], batch["sensor_index"][i])
+                    self.assertEqual(
+                        expected["channel_flags"][data["channel_flags"]],
+                        batch["channel_flags"][i],
+                    )
+                    for field, name in (
+                        ("pm2.5", "pm25"),
+                        ("pm2.5_cf_1", "pm_cf_1"),
+                        ("humidity", "humidity"),
+                        ("latitude", "latitude"),
+                    ):
+                        if data[field] is None:
+                            self.assertTrue(math.isnan(batch[name][i]))
+                        else:
+                            self.assertEqual(data[field], batch[name][i])
+
+    def test_parse_sensors_response_unknown_channel_flag(self):
+        raw = json.dumps(
+            {
+                "fields": ["sensor_index", "channel_flags", "pm2.5"],
+                "channel_flags": ["Normal"],
+                "data": [[1, 0, 1.5], [2, 3, None], [3, None, 2.0]],
+            }
+        ).encode()
+        batch = parse_sensors_response([raw])
+        self.assertListEqual([1, 2, 3], batch["sensor_index"].tolist())
+        self.assertListEqual(["Normal", None, None], batch["channel_flags"].tolist())
+        self.assertTrue(math.isnan(batch["pm25"][1]))
+
+    def test_parse_sensors_response_truncated(self):
+        with open(FIXTURE_PATH, "rb") as f:
+            raw = f.read()
+        with self.assertRaises(json.JSONDecodeError):
+            parse_sensors_response(_chunks(raw[: len(raw) // 2], 1024))
+
+    @mock.patch("time.sleep")
+    def test_get_sensors_retries(self, mock_sleep):
+        throttled = mock.Mock(status_code=429, headers={"Retry-After": "7"})
+        with MockRequests(
+            {
+                PURPLEAIR_SENSORS_API_URL: [
+                    ErrorResponse(ConnectionError("foo")),
+                    ErrorResponse(HTTPError("bar", response=throttled)),
+                    SuccessResponse("purpleair/purpleair.json"),
+                ]
+            }
+        ):
+            batch = PurpleAirClient("key").get_sensors()
+        self.assertGreater(len(batch), 0)
+        self.assertEqual(2, mock_sleep.call_count)
+        mock_sleep.assert_called_with(7.0)
+
+    @mock.patch("time.sleep")
+    def test_get_sensors_does_not_retry_client_errors(self, mock_sleep):
+        forbidden = mock.Mock(status_code=403, headers={})
+        with MockRequests(
+            {
+                PURPLEAIR_SENSORS_API_URL: ErrorResponse(
+                    HTTPError("foo", response=forbidden)
+                )
+            }
+        ):
+            with self.assertRaises(HTTPError):
+                PurpleAirClient("key").get_sensors()
+        mock_sleep.assert_not_called()
+
+    def test_get_sensors_sharded(self):
+        with open(FIXTURE_PATH) as f:
+            expected = json.load(f)
+        sensor_indices = sorted({row[0] for row in expected["data"]})
+        bounding_boxes = BoundingBox(nwlat=50, nwlng=-125, selat=25, selng=-65).split(
+            2, 2
+        )
+
+        # Every shard returns the same sensors, so they're all duplicates.
+        with MockRequests.for_urls(
+            {PURPLEAIR_SENSORS_API_URL: "purpleair/purpleair.json"}
+        ):
+            batch = PurpleAirClient("key").get_sensors_sharded(bounding_boxes)
+        self.assertListEqual(sensor_indices, batch["sensor_index"].tolist())
+        self.assertEqual(expected["data_time_stamp"], batch.timestamp)
+
+        # A failed shard only loses its own sensors, but we can't trust the
+        # timestamp anymore.
+        forbidden = mock.Mock(status_code=403, headers={})
+        with MockRequests(
+            {
+                PURPLEAIR_SENSORS_API_URL: [
+                    ErrorResponse(HTTPError("foo", response=forbidden)),
+                    SuccessResponse("purpleair/purpleair.json"),
+                ]
+            }
+        ):
+            batch = PurpleAirClient("key").get_sensors_sharded(bounding_boxes)
+        self.assertListEqual(sensor_indices, batch["sensor_index"].tolist())
+        self.assertEqual(0, batch.timestamp)
+
+        with MockRequests(
+            {
+                PURPLEAIR_SENSORS_API_URL: ErrorResponse(
+                    HTTPError("foo", response=forbidden)
+                )
+            }
+        ):
+            with self.assertRaises(HTTPError):
+                PurpleAirClient("key").get_sensors_sharded(bounding_boxes)
+
+    def test_concatenate(self):
+        def make_batch(sensor_indices, timestamp):
+            return SensorsBatch(
+                {
+                    "sensor_index": np.array(sensor_indices, dtype=np.int64),
+                    "pm25": np.array(sensor_indices, dtype=np.float64) / 10,
+                },
+                timestamp=timestamp,
+            )
+
+        batch = SensorsBatch.concatenate(
+            [make_batch([3, 1], 200), make_batch([], 0), make_batch([2, 3], 100)]
+        )
+        self.assertListEqual([1, 2, 3], batch["sensor_index"].tolist())
+        self.assertListEqual([0.1, 0.2, 0.3], batch["pm25"].tolist())
+        self.assertEqual(100, batch.timestamp)
+        self.assertEqual(0, len(SensorsBatch.concatenate([])))
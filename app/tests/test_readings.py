@@ -1,4 +1,10 @@
+import numpy as np
+
 from airq.lib.readings import ConversionFactor
+from airq.lib.readings import get_aqi_array
+from airq.lib.readings import get_pm25_array
+from airq.lib.readings import get_pm25_level_array
+from airq.lib.readings import Pm25
 from airq.lib.readings import Readings
 from airq.lib.readings import _pm25_to_aqi
 from tests.base import BaseTestCase
@@ -34,3 +40,32 @@ class ReadingsTestCase(BaseTestCase):
                 )
             ),
         )
+
+    def test_array_helpers(self):
+        concentrations = np.concatenate(
+            [
+                np.random.default_rng(0).uniform(-10, 600, 1000),
+                [0, 12, 12.1, 35.5, 55.5, 150.5, 250.5, 350.5, np.nan, np.inf],
+            ]
+        )
+        levels = get_pm25_level_array(concentrations)
+        aqis = get_aqi_array(concentrations)
+        for concentration, level, aqi in zip(
+            concentrations.tolist(), levels.tolist(), aqis.tolist()
+        ):
+            self.assertEqual(Pm25.from_measurement(concentration), level)
+            if np.isfinite(concentration):
+                self.assertEqual(_pm25_to_aqi(concentration), aqi)
+            else:
+                self.assertTrue(np.isnan(aqi))
+
+        np.testing.assert_array_equal(
+            [ConversionFactor.US_EPA.convert(Readings(20.3, 24.0, 28)), 20.3],
+            get_pm25_array(
+                np.array([20.3, 20.3]),
+                np.array([24.0, 24.0]),
+                np.array([28.0, 28.0]),
+                ConversionFactor.US_EPA,
+                has_humidity=np.array([True, False]),
+            ),
+        )
@@ -0,0 +1,119 @@
+import collections
+import numpy as np
+
+from unittest import mock
+
+from airq.lib.geo import haversine_distance
+from airq.models.relations import SensorZipcodeRelation
+from airq.sync.relations import _get_relations
+from airq.sync.relations import rebuild_relations
+from airq.sync.relations import rebuild_relations_for_sensors
+from tests.base import BaseTestCase
+
+
+class RelationsTestCase(BaseTestCase):
+    # Small enough chunks that the processes each get some.
+    @mock.patch("airq.sync.relations._CHUNK_SIZE", 50)
+    def test_get_relations(self):
+        rng = np.random.default_rng(0)
+        sensors = (
+            np.arange(200),
+            rng.uniform(45, 46, 200),
+            rng.uniform(-123, -122, 200),
+        )
+        zipcodes = (
+            np.arange(300) + 1000,
+            rng.uniform(45, 46, 300),
+            rng.uniform(-123, -122, 300),
+        )
+
+        relations = _get_relations(sensors, zipcodes, num_processes=1)
+
+        expected = []
+        for sensor_id, sensor_lat, sensor_lng in zip(*(a.tolist() for a in sensors)):
+            distances = sorted(
+                (haversine_distance(sensor_lng, sensor_lat, lng, lat), zipcode_id)
+                for zipcode_id, lat, lng in zip(*(a.tolist() for a in zipcodes))
+            )
+            expected.extend(
+                (sensor_id, zipcode_id) for d, zipcode_id in distances[:25] if d <= 25
+            )
+        self.assertListEqual(expected, [r[:2] for r in relations])
+        self.assertListEqual(
+            relations, _get_relations(sensors, zipcodes, num_processes=2)
+        )
+
+    def test_rebuild_relations(self):
+        sensor_ids = {r.sensor_id for r in SensorZipcodeRelation.query.all()}
+        self.assertGreater(len(sensor_ids), 0)
+
+        rebuild_relations(num_processes=1)
+
+        relations = SensorZipcodeRelation.query.all()
+        self.assertSetEqual(sensor_ids, {r.sensor_id for r in relations})
+        self.assertTrue(all(r.distance <= 25 for r in relations))
+        counts = collections.Counter(r.sensor_id for r in relations)
+        self.assertLessEqual(max(counts.values()), 25)
+
+    def test_rebuild_relations_for_sensors(self):
+        rebuild_relations(num_processes=1)
+        sensor_id = SensorZipcodeRelation.query.first().sensor_id
+        expected = sorted(
+            (r.zipcode_id, r.distance)
+            for r in SensorZipcodeRelation.query.filter_by(sensor_id=sensor_id)
+        )
+
+        # Matches the full rebuild exactly, including at the distance cutoff.
+        self.assertTupleEqual(
+            (len(expected), len(expected)), rebuild_relations_for_sensors([sensor_id])
+        )
+        self.db.session.commit()
+        self.assertListEqual(
+            expected,
+            sorted(
+                (r.zipcode_id, r.distance)
+                for r in SensorZipcodeRelation.query.filter_by(sensor_id=sensor_id)
+            ),
+        )
+
+    def test_get_fresh_relations(self):
+        relations = SensorZipcodeRelation.query.get_fresh_relations(0)
+        self.assertEqual(SensorZipcodeRelation.query.count(), len(relations))
+        relation = SensorZipcodeRelation.query.get(
+            (int(relations["sensor_id"][0]), int(relations["zipcode_id"][0]))
+        )
+        self.assertEqual(relation.distance, relations["distance"][0])
+        self.assertEqual(0, len(SensorZipcodeRelation.query.get_fresh_relations(2e9)))
+
+    def test_get_affected_zipcode_ids(self):
+        relation = SensorZipcodeRelation.query.first()
+        expected = [
+            r.zipcode_id
+            for r in SensorZipcodeRelation.query.filter_by(sensor_id=relation.sensor_id)
+        ]
+        self.assertCountEqual(
+            expected,
+            SensorZipcodeRelation.query.get_affected_zipcode_ids(
+                [relation.sensor_id],
+                updated_since=2e9,
+                previously_updated_since=2e9,
+                refreshed_before=0,
+            ),
+        )
+
+        # Every sensor has gone stale.
+        all_zipcode_ids = {r.zipcode_id for r in SensorZipcodeRelation.query}
+        self.assertCountEqual(
+            all_zipcode_ids,
+            SensorZipcodeRelation.query.get_affected_zipcode_ids(
+                [], updated_since=2e9, previously_updated_since=0, refreshed_before=0
+            ),
+        )
+
+        # Every sensor is fresh, and every zipcode needs a refresh.
+        self.assertCountEqual(
+            all_zipcode_ids,
+            SensorZipcodeRelation.query.get_affected_zipcode_ids(
+                [], updated_since=0, previously_updated_since=0, refreshed_before=2e9
+            ),
+        )
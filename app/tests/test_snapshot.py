@@ -0,0 +1,85 @@
+import numpy as np
+import tempfile
+
+from airq.lib.snapshot import SENSORS_SNAPSHOT_DTYPE
+from airq.lib.snapshot import SensorsSnapshot
+from tests.base import BaseTestCase
+
+
+def _make_rows(*rows) -> np.ndarray:
+    return np.array(list(rows), dtype=SENSORS_SNAPSHOT_DTYPE)
+
+
+class SensorsSnapshotTestCase(BaseTestCase):
+    def test_diff(self):
+        snapshot = SensorsSnapshot.from_rows(
+            _make_rows(
+                (3, 45.5, -122.6, 10.0, 50.0, 12.0, 100),
+                (1, 45.5, -122.6, 10.0, 50.0, 12.0, 100),
+                (2, 45.5, -122.6, 10.0, 50.0, 12.0, 100),
+                (5, 45.5, -122.6, 10.0, 50.0, 12.0, 100),
+            ),
+            "foo",
+        )
+        rows = _make_rows(
+            (1, 45.5, -122.6, 10.0, 50.0, 12.0, 100),  # Unchanged
+            (2, 45.5, -122.6, 11.0, 50.0, 12.0, 200),  # New reading
+            (3, 45.6, -122.6, 10.0, 50.0, 12.0, 100),  # Moved
+            (4, 45.5, -122.6, 10.0, 50.0, 12.0, 100),  # New
+            (0, 45.5, -122.6, 10.0, 50.0, 12.0, 100),  # New
+            (5, 45.5, -122.6, 10.0, 50.0, 12.0, 200),  # Same reading, taken later
+        )
+
+        is_new, is_moved, is_changed, has_new_reading = snapshot.diff(rows)
+
+        self.assertListEqual([False, False, False, True, True, False], is_new.tolist())
+        self.assertListEqual([False, False, True, True, True, False], is_moved.tolist())
+        self.assertListEqual([False, True, True, True, True, True], is_changed.tolist())
+        self.assertListEqual(
+            [False, True, True, True, True, False], has_new_reading.tolist()
+        )
+
+        updated = snapshot.update(rows[is_changed], "bar", "baz")
+        self.assertEqual("bar", updated.generation)
+        self.assertListEqual([0, 1, 2, 3, 4, 5], updated.rows["id"].tolist())
+        self.assertListEqual(
+            [10.0, 10.0, 11.0, 10.0, 10.0, 10.0],
+            updated.rows["latest_reading"].tolist(),
+        )
+        self.assertFalse(updated.diff(rows)[2].any())
+
+    def test_diff_empty(self):
+        snapshot = SensorsSnapshot.from_rows(_make_rows(), "foo")
+        rows = _make_rows((1, 45.5, -122.6, 10.0, 50.0, 12.0, 100))
+        for mask in snapshot.diff(rows):
+            self.assertListEqual([True], mask.tolist())
+
+    def test_locate(self):
+        snapshot = SensorsSnapshot.from_rows(
+            _make_rows(
+                (3, 45.5, -122.6, 10.0, 50.0, 12.0, 100),
+                (1, 45.5, -122.6, 10.0, 50.0, 12.0, 100),
+            ),
+            "foo",
+        )
+        indices, is_known = snapshot.locate(np.array([3, 2, 1, 4]))
+        self.assertListEqual([True, False, True, False], is_known.tolist())
+        self.assertListEqual([3, 1], snapshot.rows["id"][indices[is_known]].tolist())
+
+        empty = SensorsSnapshot.from_rows(_make_rows(), "foo")
+        self.assertFalse(empty.locate(np.array([1]))[1].any())
+
+    def test_save_and_load(self):
+        with tempfile.TemporaryDirectory() as directory:
+            self.assertIsNone(SensorsSnapshot.load(directory))
+
+            snapshot = SensorsSnapshot.from_rows(
+                _make_rows((1, 45.5, -122.6, 10.0, 50.0, 12.0, 100)), "foo", "bar"
+            )
+            snapshot.save(directory)
+
+            loaded = SensorsSnapshot.load(directory)
+            assert loaded is not None, "Mypy is unhappy"
+            self.assertEqual("foo", loaded.generation)
+            self.assertEqual("bar", loaded.digest)
+            self.assertListEqual(snapshot.rows.tolist(), loaded.rows.tolist())
@@ -0,0 +1,99 @@
+import numpy as np
+
+from airq.lib.geo import haversine_distance
+from airq.lib.spatial import SpatialIndex
+from tests.base import BaseTestCase
+
+
+class SpatialIndexTestCase(BaseTestCase):
+    def setUp(self):
+        super().setUp()
+        rng = np.random.default_rng(0)
+        self.latitudes = np.concatenate(
+            [rng.uniform(44, 47, 500), rng.uniform(-89, 89, 500)]
+        )
+        self.longitudes = np.concatenate(
+            [rng.uniform(-124, -121, 500), rng.uniform(-180, 180, 500)]
+        )
+        self.ids = np.arange(1000) + 100
+        self.index = SpatialIndex(self.ids, self.latitudes, self.longitudes)
+
+    def _brute_force(self, latitude, longitude):
+        return sorted(
+            (haversine_distance(longitude, latitude, lng, lat), point_id)
+            for point_id, lat, lng in zip(
+                self.ids.tolist(), self.latitudes.tolist(), self.longitudes.tolist()
+            )
+        )
+
+    def test_within_radius(self):
+        # Includes points near the antimeridian and the poles.
+        for latitude, longitude, km in [
+            (45.5, -122.6, 25),
+            (45.5, -122.6, 300),
+            (0.0, 179.9, 2000),
+            (88.0, 10.0, 1500),
+            (-30.0, -179.5, 5000),
+        ]:
+            with self.subTest(latitude=latitude, longitude=longitude, km=km):
+                expected = [
+                    (d, i) for d, i in self._brute_force(latitude, longitude) if d <= km
+                ]
+                ids, distances = self.index.within_radius(latitude, longitude, km)
+                self.assertListEqual([i for _, i in expected], ids.tolist())
+                np.testing.assert_allclose([d for d, _ in expected], distances)
+
+    def test_k_nearest(self):
+        for latitude, longitude in [(45.5, -122.6), (10.0, 60.0), (-89.0, 0.0)]:
+            with self.subTest(latitude=latitude, longitude=longitude):
+                expected = self._brute_force(latitude, longitude)[:25]
+                ids, distances = self.index.k_nearest(latitude, longitude, 25)
+                self.assertListEqual([i for _, i in expected], ids.tolist())
+                np.testing.assert_allclose([d for d, _ in expected], distances)
+
+        ids, distances = self.index.k_nearest(45.5, -122.6, 1000, max_km=25)
+        self.assertTrue((distances <= 25).all())
+        self.assertListEqual(
+            ids.tolist(), self.index.within_radius(45.5, -122.6, 25)[0].tolist()
+        )
+
+        self.assertEqual(1000, len(self.index.k_nearest(0, 0, 2000)[0]))
+        self.assertEqual(0, len(SpatialIndex([], [], []).k_nearest(0, 0, 5)[0]))
+
+    def test_k_nearest_many(self):
+        latitudes = [45.5, 0.0, 88.0, -30.0, 10.0]
+        longitudes = [-122.6, 179.9, 10.0, -179.5, 60.0]
+        query_indices, ids, distances = self.index.k_nearest_many(
+            latitudes, longitudes, 5, max_km=2000
+        )
+        for i, (latitude, longitude) in enumerate(zip(latitudes, longitudes)):
+            with self.subTest(latitude=latitude, longitude=longitude):
+                expected_ids, expected_distances = self.index.k_nearest(
+                    latitude, longitude, 5, max_km=2000
+                )
+                self.assertListEqual(
+                    expected_ids.tolist(), ids[query_indices == i].tolist()
+                )
+                self.assertListEqual(
+                    expected_distances.tolist(),
+                    distances[query_indices == i].tolist(),
+                )
+
+        query_indices, ids, distances = self.index.k_nearest_many([], [], 5, 25)
+        self.assertEqual(0, len(ids))
+
+    def test_cell_edges(self):
+        # Just across a cell boundary from the query point, and just inside
+        # the radius, both north-south and east-west.
+        index = SpatialIndex([1, 2], [45.00001, 0.0], [-100.0, -99.99999])
+        for latitude, longitude, point_id in [
+            (44.7753, -100.0, 1),
+            (0.0, -100.2247, 2),
+        ]:
+            with self.subTest(latitude=latitude, longitude=longitude):
+                ids, distances = index.within_radius(latitude, longitude, 25)
+                self.assertListEqual([point_id], ids.tolist())
+                self.assertGreater(distances[0], 24.9)
+                self.assertListEqual(
+                    [point_id], index.k_nearest(latitude, longitude, 1, 25)[0].tolist()
+                )
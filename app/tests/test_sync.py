@@ -1,19 +1,36 @@
 import datetime
 import os
 import logging
+import numpy as np
 
 from requests.exceptions import HTTPError
 from unittest import mock
 
+from airq.lib.purpleair import PURPLEAIR_REGIONS
 from airq.lib.purpleair import PURPLEAIR_SENSORS_API_URL
+from airq.lib.purpleair import SensorsBatch
+from airq.lib.snapshot import SENSORS_SNAPSHOT_DTYPE
+from airq.lib.snapshot import SensorsSnapshot
 from airq.models.cities import City
 from airq.models.clients import Client
 from airq.models.clients import ClientIdentifierType
 from airq.models.relations import SensorZipcodeRelation
 from airq.models.sensors import Sensor
+from airq.models.syncs import Sync
+from airq.models.syncs import SyncType
 from airq.models.zipcodes import Zipcode
 from airq.sync import models_sync
+from airq.sync.purpleair import _filter_valid_sensors
+from airq.sync.purpleair import _get_modified_since
+from airq.sync.purpleair import _send_alerts
 from airq.sync.purpleair import _send_share_requests
+from airq.sync.purpleair import _should_sweep
+from airq.sync.purpleair import _should_sync_metadata
+from airq.sync.purpleair import dispatch_region_syncs
+from airq.sync.purpleair import purpleair_region_sync
+from airq.sync.purpleair import purpleair_sync
+from airq.sync.purpleair import SENSOR_FRESHNESS_SECONDS
+from airq.sync.purpleair import SWEEP_INTERVAL_SECONDS
 from airq.sync.geonames import GEONAMES_URL
 from airq.sync.geonames import ZIP_2_TIMEZONES_URL
 from tests.base import BaseTestCase
@@ -45,13 +62,19 @@ class SyncTestCase(BaseTestCase):
         self.assertGreater(Zipcode.query.count(), 0)
         self.assertGreater(Sensor.query.count(), 0)
         self.assertGreater(SensorZipcodeRelation.query.count(), 0)
+        self.assertEqual(
+            0,
+            SensorZipcodeRelation.query.filter(
+                SensorZipcodeRelation.distance > 25
+            ).count(),
+        )
 
-        # Assert that zipcodes with a valid pm25 have a metrics_data blob
+        # Assert that zipcodes with a valid pm25 have metrics
         zipcodes = Zipcode.query.filter(Zipcode.pm25_updated_at > 0).all()
         self.assertGreater(len(zipcodes), 0)
         for zipcode in zipcodes:
-            self.assertIsNotNone(zipcode.metrics_data)
-            self.assertTrue(len(zipcode.metrics_data["sensor_ids"]) > 0)
+            self.assertGreater(zipcode.num_sensors, 0)
+            self.assertEqual(zipcode.num_sensors, len(zipcode.sensor_ids))
 
     def test_sync_disabled(self):
         with self.mock_config(HAZEBOT_ENABLED=False):
@@ -63,6 +86,112 @@ class SyncTestCase(BaseTestCase):
             ):
                 self.assertFalse(models_sync(force_rebuild_geography=True))
 
+    def test_filter_valid_sensors(self):
+        nan = float("nan")
+        ts = self.timestamp
+        rows = [
+            # sensor_index, last_seen, channel_flags, pm25, pm_cf_1, humidity, lat, lon
+            (1, ts, "Normal", 10.0, 10.0, 50.0, 45.5, -122.6),
+            (2, ts - 60 * 60 - 1, "Normal", 10.0, 10.0, 50.0, 45.5, -122.6),
+            (3, nan, "Normal", 10.0, 10.0, 50.0, 45.5, -122.6),
+            (4, ts, "A-Downgraded", 10.0, 10.0, 50.0, 45.5, -122.6),
+            (5, ts, None, 10.0, 10.0, 50.0, 45.5, -122.6),
+            (6, ts, "Normal", nan, nan, 50.0, 45.5, -122.6),
+            (7, ts, "Normal", 0.0, 0.0, 50.0, 45.5, -122.6),
+            (8, ts, "Normal", 1000.1, 1000.1, 50.0, 45.5, -122.6),
+            (9, ts, "Normal", 1000.0, 1000.0, nan, 45.5, -122.6),
+            (10, ts, "Normal", 1000.0, 1000.0, 50.0, nan, -122.6),
+            (11, ts, "Normal", 1000.0, nan, 50.0, 45.5, -122.6),
+            (12, ts, "Normal", 1000.0, 1000.0, 50.0, 45.5, -122.6),
+        ]
+        columns = list(zip(*rows))
+        purpleair_data = SensorsBatch(
+            {
+                "sensor_index": np.array(columns[0], dtype=np.int64),
+                "last_seen": np.array(columns[1], dtype=np.float64),
+                "channel_flags": np.array(columns[2], dtype=np.object_),
+                "pm25": np.array(columns[3], dtype=np.float64),
+                "pm_cf_1": np.array(columns[4], dtype=np.float64),
+                "humidity": np.array(columns[5], dtype=np.float64),
+                "latitude": np.array(columns[6], dtype=np.float64),
+                "longitude": np.array(columns[7], dtype=np.float64),
+            }
+        )
+
+        valid_data = _filter_valid_sensors(purpleair_data)
+
+        self.assertListEqual([1, 12], valid_data["sensor_index"].tolist())
+        self.assertListEqual([1000.0], valid_data["pm25"].tolist()[1:])
+        self.assertEqual(0, len(_filter_valid_sensors(SensorsBatch.empty())))
+
+        # Readings-only batches can't be missing coordinates.
+        readings_data = SensorsBatch(
+            {
+                field: purpleair_data[field]
+                for field in purpleair_data.fields
+                if field not in ("latitude", "longitude")
+            }
+        )
+        self.assertListEqual(
+            [1, 10, 12],
+            _filter_valid_sensors(readings_data)["sensor_index"].tolist(),
+        )
+
+    def test_get_modified_since(self):
+        # We've never synced, so fetch everything.
+        self.assertIsNone(_get_modified_since())
+
+        Sync.query.set_last_synced_at(SyncType.PURPLEAIR, self.timestamp - 60)
+        self.assertEqual(self.timestamp - 60, _get_modified_since())
+
+        with self.mock_config(HAZEBOT_INCREMENTAL_SYNC_ENABLED=False):
+            self.assertIsNone(_get_modified_since())
+
+        # The last sync is too old to build on.
+        Sync.query.set_last_synced_at(SyncType.PURPLEAIR, self.timestamp - 60 * 61)
+        self.assertIsNone(_get_modified_since())
+
+    def test_should_sync_metadata(self):
+        snapshot = SensorsSnapshot.from_rows(
+            np.array(
+                [(1, 45.5, -122.6, 10.0, 50.0, 12.0, self.timestamp)],
+                dtype=SENSORS_SNAPSHOT_DTYPE,
+            ),
+            "foo",
+        )
+        self.assertTrue(_should_sync_metadata(snapshot))
+
+        Sync.query.set_last_synced_at(SyncType.PURPLEAIR_METADATA, self.timestamp - 60)
+        self.assertFalse(_should_sync_metadata(snapshot))
+
+        # We don't know where any sensors are yet.
+        empty_snapshot = SensorsSnapshot.from_rows(
+            np.array([], dtype=SENSORS_SNAPSHOT_DTYPE), "foo"
+        )
+        self.assertTrue(_should_sync_metadata(empty_snapshot))
+
+        Sync.query.set_last_synced_at(
+            SyncType.PURPLEAIR_METADATA, self.timestamp - 60 * 61
+        )
+        self.assertTrue(_should_sync_metadata(snapshot))
+
+    def test_should_sweep(self):
+        # Sweeps must refresh sensors well before they go stale.
+        self.assertLessEqual(SWEEP_INTERVAL_SECONDS, SENSOR_FRESHNESS_SECONDS // 2)
+
+        self.assertTrue(_should_sweep())
+
+        Sync.query.set_last_synced_at(SyncType.PURPLEAIR_SWEEP, self.timestamp - 60)
+        self.assertFalse(_should_sweep())
+
+        with self.mock_config(HAZEBOT_DEMAND_DRIVEN_SYNC_ENABLED=False):
+            self.assertTrue(_should_sweep())
+
+        Sync.query.set_last_synced_at(
+            SyncType.PURPLEAIR_SWEEP, self.timestamp - 60 * 16
+        )
+        self.assertTrue(_should_sweep())
+
     def test_send_share_requests(self):
         zipcode = Zipcode.query.first()
         client = Client(
@@ -88,6 +217,136 @@ class SyncTestCase(BaseTestCase):
         with self.mock_config(HAZEBOT_SHARE_REQUESTS_ENABLED=False):
             self.assertEqual(_send_share_requests(), 0)
 
+    @mock.patch.object(Client, "send_alert", autospec=True, return_value=True)
+    def test_send_alerts_with_numpy_skips_bad_preferences(self, mock_send_alert):
+        zipcode = Zipcode.query.filter_by(zipcode="97204").first()
+        zipcode.pm25 = 200.0
+        zipcode.pm_cf_1 = 200.0
+        zipcode.humidity = 50.0
+        clients = [
+            Client(
+                identifier=identifier,
+                type_code=ClientIdentifierType.PHONE_NUMBER,
+                last_activity_at=0,
+                zipcode_id=zipcode.id,
+                last_pm25=1.0,
+                last_pm_cf_1=1.0,
+                last_humidity=50.0,
+                alerts_disabled_at=0,
+                created_at=self.clock.now(),
+                preferences=preferences,
+            )
+            for identifier, preferences in [
+                ("+12222222222", {}),
+                ("+13333333333", {"alert_threshold": "abc"}),
+            ]
+        ]
+        self.db.session.add_all(clients)
+        self.db.session.commit()
+
+        # The client with a malformed preference doesn't stop the others from
+        # being alerted.
+        with self.mock_config(HAZEBOT_ALERTS_ENGINE="numpy"):
+            num_sent = _send_alerts(
+                Client.query.filter_alert_candidates().filter(
+                    Client.id.in_([client.id for client in clients])
+                ),
+                Client.get_timezones_in_send_window(),
+            )
+        self.assertEqual(1, num_sent)
+        mock_send_alert.assert_called_once()
+        self.assertEqual(clients[0].id, mock_send_alert.call_args[0][0].id)
+
+    def test_sync_alerts_subscribed_zipcodes_first(self):
+        zipcode = Zipcode.query.filter_by(zipcode="97204").first()
+        client = Client(
+            identifier="+12222222222",
+            type_code=ClientIdentifierType.PHONE_NUMBER,
+            last_activity_at=0,
+            zipcode_id=zipcode.id,
+            created_at=self.clock.now(),
+        )
+        self.db.session.add(client)
+        self.db.session.commit()
+
+        calls = []
+
+        def update_metrics(updated_since, updated_at, zipcode_ids):
+            calls.append(("update_metrics", zipcode_ids))
+            return len(zipcode_ids)
+
+        def maybe_notify(client):
+            calls.append(("maybe_notify", client.zipcode_id))
+            return False
+
+        with self.mock_config(HAZEBOT_INCREMENTAL_SYNC_ENABLED=False):
+            with mock.patch(
+                "airq.sync.purpleair._update_metrics", side_effect=update_metrics
+            ), mock.patch.object(
+                Client, "maybe_notify", autospec=True, side_effect=maybe_notify
+            ), MockRequests.for_urls(
+                {PURPLEAIR_SENSORS_API_URL: "purpleair/purpleair.json"}
+            ):
+                purpleair_sync()
+
+        # The client's zipcode is recomputed, and the client alerted, before
+        # any other zipcode. The client isn't alerted twice.
+        self.assertEqual(3, len(calls))
+        self.assertEqual(("update_metrics", [zipcode.id]), calls[0])
+        self.assertEqual(("maybe_notify", zipcode.id), calls[1])
+        self.assertEqual("update_metrics", calls[2][0])
+        self.assertNotIn(zipcode.id, calls[2][1])
+        self.assertEqual(Zipcode.query.count() - 1, len(calls[2][1]))
+
+    @mock.patch("airq.tasks.purpleair_region_sync.delay")
+    def test_dispatch_region_syncs(self, mock_delay):
+        self.assertListEqual(list(PURPLEAIR_REGIONS), dispatch_region_syncs())
+        self.assertEqual(len(PURPLEAIR_REGIONS), mock_delay.call_count)
+
+        # None of those have finished, so there's nothing to do.
+        mock_delay.reset_mock()
+        self.clock.advance(60 * 10)
+        self.assertListEqual([], dispatch_region_syncs())
+        mock_delay.assert_not_called()
+
+        # Regions which finished, or seem to be stuck, get synced again.
+        Sync.query.set_last_synced_at(
+            SyncType.REGION_COMPLETED, int(self.clock.now().timestamp()), "alaska"
+        )
+        self.clock.advance(60 * 5)
+        self.assertListEqual(["alaska"], dispatch_region_syncs())
+        mock_delay.assert_called_once_with("alaska")
+        self.clock.advance(60 * 10)
+        self.assertListEqual(
+            [r for r in PURPLEAIR_REGIONS if r != "alaska"], dispatch_region_syncs()
+        )
+
+    def test_region_sync(self):
+        region = "contiguous-0"
+        with MockRequests.for_urls(
+            {PURPLEAIR_SENSORS_API_URL: "purpleair/purpleair.json"}
+        ):
+            purpleair_region_sync(region)
+
+        self.assertGreater(Sync.query.get_last_synced_at(SyncType.PURPLEAIR, region), 0)
+        self.assertGreater(
+            Sync.query.get_last_synced_at(SyncType.REGION_COMPLETED, region), 0
+        )
+        self.assertEqual(0, Sync.query.get_last_synced_at(SyncType.PURPLEAIR))
+        self.assertGreater(Sync.query.get_last_synced_at(SyncType.METRICS, region), 0)
+
+        # Zipcodes outside of the region are left to their own region's sync.
+        bounding_box = PURPLEAIR_REGIONS[region]
+        updated_at = Sync.query.get_last_synced_at(SyncType.METRICS, region)
+        self.assertEqual(
+            0,
+            Zipcode.query.filter(
+                ~bounding_box.contains(Zipcode.latitude, Zipcode.longitude)
+            )
+            .filter(Zipcode.metrics_checked_at == updated_at)
+            .count(),
+        )
+
     @mock.patch.object(logging.Logger, "log")
     def test_sync_error(self, mock_log):
         error = HTTPError("foo")
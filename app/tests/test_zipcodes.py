@@ -1,4 +1,13 @@
+import collections
+import geohash
+
+from airq.config import db
+from airq.lib.metrics import SENSOR_FRESHNESS_SECONDS
 from airq.lib.readings import ConversionFactor
+from airq.models.relations import SensorZipcodeRelation
+from airq.models.sensors import Sensor
+from airq.models.syncs import Sync
+from airq.models.syncs import SyncType
 from airq.models.zipcodes import Zipcode
 from tests.base import BaseTestCase
 
@@ -50,3 +59,174 @@ class ZipcodeTestCase(BaseTestCase):
             ],
             zipcode.get_recommendations(3, ConversionFactor.NONE),
         )
+
+    def test_get_recommendations_refresh_metrics(self):
+        zipcode = Zipcode.query.filter_by(zipcode="97038").first()
+        candidates = zipcode.get_recommendations(3, ConversionFactor.NONE)
+        candidate_ids = [z.id for z in candidates]
+        self.assertEqual(3, len(candidate_ids))
+
+        # Candidates the syncs skipped are left out...
+        Zipcode.query.filter(Zipcode.id.in_(candidate_ids)).update(
+            {Zipcode.pm25_updated_at: 0, Zipcode.metrics_checked_at: 0},
+            synchronize_session=False,
+        )
+        sensor_ids = [
+            r.sensor_id
+            for r in SensorZipcodeRelation.query.filter(
+                SensorZipcodeRelation.zipcode_id.in_(candidate_ids)
+            )
+        ]
+        Sensor.query.filter(Sensor.id.in_(sensor_ids)).update(
+            {Sensor.updated_at: self.timestamp}, synchronize_session=False
+        )
+        for candidate in zipcode.get_recommendations(3, ConversionFactor.NONE):
+            self.assertNotIn(candidate.id, candidate_ids)
+
+        # ...unless they're refreshed first.
+        db.session.begin_nested()
+        zipcode.get_recommendations(3, ConversionFactor.NONE, refresh_metrics=True)
+        self.assertEqual(
+            3,
+            Zipcode.query.filter(Zipcode.id.in_(candidate_ids))
+            .filter(Zipcode.pm25_updated_at == self.timestamp)
+            .count(),
+        )
+        db.session.rollback()
+
+    def test_get_spatial_index(self):
+        zipcode = Zipcode.query.filter_by(zipcode="97204").first()
+        index = Zipcode.query.get_spatial_index()
+        self.assertEqual(Zipcode.query.count(), len(index))
+        self.assertIs(index, Zipcode.query.get_spatial_index())
+
+        zipcode_ids, distances = index.k_nearest(
+            float(zipcode.latitude), float(zipcode.longitude), 1
+        )
+        self.assertListEqual([zipcode.id], zipcode_ids.tolist())
+        self.assertAlmostEqual(0, distances[0])
+
+        # The index is rebuilt when the zipcodes change.
+        Sync.query.bump_generation(SyncType.GEONAMES)
+        self.assertIsNot(index, Zipcode.query.get_spatial_index())
+
+    def test_filter_by_geohash_prefix(self):
+        zipcode = Zipcode.query.filter_by(zipcode="97204").first()
+        self.assertEqual(12, len(zipcode.geohash))
+        zipcodes = Zipcode.query.filter_by_geohash_prefix(zipcode.geohash[:4]).all()
+        self.assertIn(zipcode, zipcodes)
+        for other in zipcodes:
+            self.assertTrue(other.geohash.startswith(zipcode.geohash[:4]))
+
+        neighbors = Zipcode.query.filter_by_geohash_neighbors(zipcode.geohash[:4]).all()
+        self.assertLessEqual(set(zipcodes), set(neighbors))
+        cells = set(geohash.expand(zipcode.geohash[:4]))
+        for other in neighbors:
+            self.assertIn(other.geohash[:4], cells)
+
+    def test_update_metrics(self):
+        sensors_by_zipcode = collections.defaultdict(list)
+        for zipcode_id, sensor_id, distance, pm25 in (
+            SensorZipcodeRelation.query.join(Sensor)
+            .with_entities(
+                SensorZipcodeRelation.zipcode_id,
+                SensorZipcodeRelation.sensor_id,
+                SensorZipcodeRelation.distance,
+                Sensor.latest_reading,
+            )
+            .all()
+        ):
+            sensors_by_zipcode[zipcode_id].append((distance, sensor_id, pm25))
+
+        num_updated = Zipcode.query.update_metrics(
+            updated_since=0,
+            updated_at=1234,
+            desired_num_readings=8,
+            desired_reading_distance_km=2.5,
+        )
+        self.assertLessEqual(num_updated, len(sensors_by_zipcode))
+        for zipcode_id, sensors in list(sensors_by_zipcode.items())[:100]:
+            sensors = sorted(sensors)
+            sensors = [s for i, s in enumerate(sensors) if i < 8 or s[0] < 2.5]
+            zipcode = Zipcode.query.get(zipcode_id)
+            db.session.refresh(zipcode)
+            self.assertEqual(1234, zipcode.pm25_updated_at)
+            self.assertEqual(1234, zipcode.metrics_checked_at)
+            self.assertAlmostEqual(
+                sum(s[2] for s in sensors) / len(sensors), zipcode.pm25, places=2
+            )
+            self.assertEqual(len(sensors), zipcode.num_sensors)
+            self.assertListEqual([s[1] for s in sensors], zipcode.sensor_ids)
+            self.assertAlmostEqual(sensors[0][0], zipcode.min_sensor_distance, places=2)
+            self.assertAlmostEqual(
+                sensors[-1][0], zipcode.max_sensor_distance, places=2
+            )
+
+        # Zipcodes whose readings haven't changed only get a new timestamp.
+        zipcode_id = next(iter(sensors_by_zipcode))
+        zipcode = Zipcode.query.get(zipcode_id)
+        db.session.refresh(zipcode)
+        pm25, sensor_ids = zipcode.pm25, zipcode.sensor_ids
+        self.assertEqual(
+            0,
+            Zipcode.query.update_metrics(
+                updated_since=0,
+                updated_at=5678,
+                desired_num_readings=8,
+                desired_reading_distance_km=2.5,
+            ),
+        )
+        self.assertEqual(
+            len(sensors_by_zipcode),
+            Zipcode.query.filter(Zipcode.pm25_updated_at == 5678)
+            .filter(Zipcode.metrics_checked_at == 5678)
+            .count(),
+        )
+        db.session.refresh(zipcode)
+        self.assertEqual(pm25, zipcode.pm25)
+        self.assertListEqual(sensor_ids, zipcode.sensor_ids)
+        db.session.rollback()
+
+    def test_refresh_metrics(self):
+        zipcode = Zipcode.query.filter_by(zipcode="97204").first()
+        sensor_ids = [
+            r.sensor_id
+            for r in SensorZipcodeRelation.query.filter_by(zipcode_id=zipcode.id)
+        ]
+        Sensor.query.filter(Sensor.id.in_(sensor_ids)).update(
+            {Sensor.updated_at: self.timestamp - 60}, synchronize_session=False
+        )
+        zipcode.metrics_checked_at = 0
+
+        def refresh() -> int:
+            db.session.begin_nested()
+            num_refreshed = Zipcode.query.refresh_metrics([zipcode.id])
+            db.session.refresh(zipcode)
+            return num_refreshed
+
+        self.assertEqual(1, refresh())
+        self.assertEqual(self.timestamp, zipcode.metrics_checked_at)
+        self.assertEqual(self.timestamp, zipcode.pm25_updated_at)
+
+        # Zipcodes whose sensors haven't changed aren't recomputed.
+        self.clock.advance(60)
+        self.assertEqual(0, refresh())
+        self.assertEqual(self.timestamp - 60, zipcode.pm25_updated_at)
+
+        # New readings are picked up.
+        Sensor.query.filter_by(id=sensor_ids[0]).update(
+            {Sensor.updated_at: self.timestamp}, synchronize_session=False
+        )
+        self.clock.advance(60)
+        self.assertEqual(1, refresh())
+        self.assertEqual(self.timestamp, zipcode.pm25_updated_at)
+        self.assertEqual(0, refresh())
+
+        # So are sensors going stale, even if that leaves no fresh sensors.
+        pm25_updated_at = zipcode.pm25_updated_at
+        self.clock.advance(SENSOR_FRESHNESS_SECONDS)
+        self.assertEqual(1, refresh())
+        self.assertEqual(self.timestamp, zipcode.metrics_checked_at)
+        self.assertEqual(pm25_updated_at, zipcode.pm25_updated_at)
+        self.assertEqual(0, refresh())
+        db.session.rollback()